@@ -3,26 +3,62 @@
 import os
 import shutil
 import glob
+import shlex
+import itertools
+import functools
+import json
+import time
+import errno
+import hashlib
+import tempfile
+import filecmp
+import traceback
 import subprocess
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 try:
     from astropy.io import fits as pyfits
 except ImportError:
     import pyfits
+import numpy as np
 
 from imagelog import ImageLog
 from dbtools import reach
+from executor import Job, JobResult, CostModel, default_executor
+from fileops import file_checksum, file_size
+from fitsheader import scan_headers
+from footprint import linear_footprints
+from pipeline import Stage
 
 
 class Astromatic(object):
     """Abstract base class for the Astromatic software wrappers
     (SExtractor, SCAMP, Swarp).
+    
+    Programs are run through a :class:`moastro.executor.JobExecutor`; the
+    ``cpus`` and ``memory`` (MB) attributes declare what a run needs from
+    the executor's budget.
+    
+    Unless ``NTHREADS`` is set in the configs, the executor picks
+    ``NTHREADS`` when the run starts: a share of the free CPUs, at most
+    ``maxThreads`` (``0`` for no limit). Tools that parallelize well over
+    one large input (Swarp, SCAMP) default to no limit, while tools usually
+    run as many concurrent jobs use few threads each.
     """
+    maxThreads = 0
+    
+    # If True, run fingerprints hash the contents of input files instead of
+    # using their size and modification time
+    hashInputs = False
+    
     def __init__(self, configs=None, workDir=".", defaultsPath=None):
         self.configs = configs
         self.workDir = workDir
         self.defaultsPath = defaultsPath
+        self.cpus = 1
+        self.memory = 0.
+        self.result = None
         
         # Initialize the working directory
         if os.path.exists(self.workDir) is not True:
@@ -32,9 +68,10 @@ class Astromatic(object):
     def add_default_param_to_configs(self, defaultsCommand,
             name="defaults.txt"):
         """Adds the default parameters filepath to the configs dictionary.
-        Writes a new defaults file is one is not found/available.
+        Uses the cached defaults file of the program if one is not
+        found/available.
         """
-        # Write new defaults file if necessary
+        # Use the program's cached defaults if necessary
         if self.defaultsPath is None:
             self.write_defaults_file(defaultsCommand)
         elif os.path.exists(self.defaultsPath) is False:
@@ -43,13 +80,12 @@ class Astromatic(object):
         self.add_to_configs("c", self.defaultsPath)
     
     def write_defaults_file(self, defaultsCommand):
-        """Writes the Swarp internal defaults and returns its path."""
-        self.defaultsPath = os.path.join(self.workDir, "defaults.txt")
-        print self.defaultsPath
-        command = "%s > %s" % (defaultsCommand, self.defaultsPath)
-        p = subprocess.Popen(command, shell=True)
-        p.wait()
-        
+        """Sets `defaultsPath` to the program's internal defaults (the
+        output of e.g. ``swarp -d``), from the cache shared by all runs
+        (see :func:`cached_defaults`), and returns its path.
+        """
+        program = shlex.split(defaultsCommand)[0]
+        self.defaultsPath = cached_defaults(program)
         return self.defaultsPath
     
     def write_input_file_list(self, inputFITSPaths, name="inputlist"):
@@ -113,34 +149,294 @@ class Astromatic(object):
         """
         pass
     
-    def run(self, virtualHost=None):
-        """Runs the command process.
+    def make_job(self, virtualHost=None):
+        """Make the :class:`moastro.executor.Job` that runs the program.
+        The program is run directly, not through a shell.
+        
         The optional virtualHost is a tuple with format:
             (user@host, rootPath)
         """
         # Make the terapix program command
         command = self.make_command()
+        argv = shlex.split(command)
+        name = os.path.basename(argv[0])
         
-        # Append the ssh call if we run on a virtual machine
+        # Wrap in an ssh call if we run on a virtual machine
         if virtualHost is not None:
-            command = " ".join(["ssh",
-                virtualHost[0],
-                "'cd %s;%s'" % (virtualHost[1], command)])
+            argv = ["ssh", virtualHost[0],
+                "cd %s;%s" % (virtualHost[1], command)]
+        
+        # Threading policy: explicit NTHREADS, or a share from the executor
+        maxCpus = self.maxThreads or multiprocessing.cpu_count()
+        threadArg = "-NTHREADS"
+        if self.configs is not None and "NTHREADS" in self.configs:
+            nthreads = int(self.configs["NTHREADS"])
+            maxCpus = nthreads or multiprocessing.cpu_count()
+            threadArg = None
+        return Job(argv, cpus=min(self.cpus, maxCpus), memory=self.memory,
+            name=name, max_cpus=maxCpus, thread_arg=threadArg)
+    
+    def run(self, virtualHost=None, executor=None, force=False):
+        """Runs the command process.
+        The optional virtualHost is a tuple with format:
+            (user@host, rootPath)
         
-        print command
-        p = subprocess.Popen(command, shell=True)
-        p.wait()
+        The run is skipped if a previous run with the same fingerprint (see
+        :meth:`fingerprint`) produced outputs that are unchanged since.
+        
+        :param executor: (optional) :class:`moastro.executor.JobExecutor` to
+            run on. By default the process-wide executor is used.
+        :param force: if ``True``, run even if the outputs are up to date.
+        :return: the :class:`moastro.executor.JobResult`, also kept as the
+            ``result`` attribute.
+        """
+        job = self.make_job(virtualHost=virtualHost)
+        fingerprint = None
+        if virtualHost is None:
+            fingerprint = self.fingerprint(job.name)
+            if not force and self.is_current(fingerprint, job.name):
+                return self.skip(job)
+        self.execute(job, executor=executor)
+        if self.result.ok and fingerprint is not None:
+            self.save_fingerprint(fingerprint, job.name)
+        return self.result
+    
+    def execute(self, job, executor=None):
+        """Run a job on the executor, without checking its fingerprint.
+        
+        :return: the :class:`moastro.executor.JobResult`, also kept as the
+            ``result`` attribute.
+        """
+        print " ".join(job.argv)
+        if executor is None:
+            executor = default_executor()
+        self.result = executor.run(job)
+        return self.result
+    
+    def skip(self, job):
+        """Record a job as skipped because its outputs are up to date."""
+        print "Skipping %s; outputs are up to date" % job.name
+        self.result = JobResult(job, 0, "", 0, time.time(), 0., 0.,
+            skipped=True)
+        return self.result
+    
+    def input_paths(self):
+        """Paths of the input files of a run, used for its fingerprint.
+        Implemented by subclasses.
+        """
+        return []
+    
+    def output_paths(self):
+        """Paths of the files a run produces. Runs of subclasses that do not
+        declare outputs are never skipped.
+        """
+        return []
+    
+    def fingerprint(self, program):
+        """Fingerprint of a run, from the tool version, the configuration
+        (including the contents of the defaults file) and the identity of
+        each input file. Call after :meth:`make_command`.
+        """
+        inputs = []
+        for path in self.input_paths():
+            if not os.path.exists(path):
+                inputs.append((path, None))
+            elif self.hashInputs:
+                inputs.append((path, file_checksum(path)))
+            else:
+                st = os.stat(path)
+                inputs.append((path, st.st_size, st.st_mtime))
+        if self.defaultsPath is not None and os.path.exists(self.defaultsPath):
+            defaults = file_checksum(self.defaultsPath)
+        else:
+            defaults = None
+        configs = dict((str(k), str(v))
+            for k, v in self.fingerprint_configs().iteritems())
+        state = {"program": program, "version": tool_version(program),
+            "configs": configs, "defaults": defaults, "inputs": inputs}
+        return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+    
+    def fingerprint_configs(self):
+        """Configs that identify a run in its fingerprint."""
+        return self.configs or {}
+    
+    def fingerprint_path(self, program):
+        """Path of the record of the last successful run of ``program``,
+        written next to the first output as
+        ``<stem>.<program>.fingerprint.json``, so tools writing outputs with
+        the same stem keep records of their own. ``None`` if the run
+        declares no outputs.
+        """
+        outputs = self.output_paths()
+        if len(outputs) == 0:
+            return None
+        return "%s.%s.fingerprint.json" % (os.path.splitext(outputs[0])[0],
+            program)
+    
+    def is_current(self, fingerprint, program):
+        """``True`` if the last successful run of ``program`` had this
+        fingerprint and its outputs still exist, unchanged.
+        """
+        path = self.fingerprint_path(program)
+        if path is None or not os.path.exists(path):
+            return False
+        with open(path) as f:
+            try:
+                record = json.load(f)
+            except ValueError:
+                return False
+        if record.get('fingerprint') != fingerprint:
+            return False
+        outputs = record.get('outputs', {})
+        for outputPath in self.output_paths():
+            if outputPath not in outputs or not os.path.exists(outputPath):
+                return False
+            st = os.stat(outputPath)
+            if [st.st_size, st.st_mtime] != outputs[outputPath]:
+                return False
+        return True
+    
+    def save_fingerprint(self, fingerprint, program):
+        """Record the fingerprint and outputs of a successful run of
+        ``program``.
+        """
+        path = self.fingerprint_path(program)
+        if path is None:
+            return
+        outputs = {}
+        for outputPath in self.output_paths():
+            if os.path.exists(outputPath):
+                st = os.stat(outputPath)
+                outputs[outputPath] = [st.st_size, st.st_mtime]
+        with open(path, 'w') as f:
+            json.dump({"fingerprint": fingerprint, "outputs": outputs}, f)
+
+
+_toolVersions = {}
+
+
+def tool_version(program):
+    """Version string printed by ``program -v``, cached per program. ``None``
+    if the program could not be run.
+    """
+    if program not in _toolVersions:
+        try:
+            p = subprocess.Popen([program, "-v"], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            _toolVersions[program] = p.communicate()[0].strip()
+        except OSError:
+            _toolVersions[program] = None
+    return _toolVersions[program]
+
+
+def defaults_cache_dir():
+    """Directory of cached astromatic defaults files; set with the
+    ``$MOASTROCACHE`` environment variable (default ``~/.moastro_cache``).
+    """
+    root = os.getenv('MOASTROCACHE', os.path.expanduser("~/.moastro_cache"))
+    return os.path.join(root, "astromatic")
+
+
+def cached_defaults(program):
+    """Path to the internal defaults of `program` (the output of
+    ``program -d``), generated once per program binary and version.
+    
+    The file is written to a temporary file and renamed into place, so
+    concurrent processes and threads never see a partial file.
+    """
+    binary = _find_program(program)
+    key = hashlib.sha1("%s\n%s" % (binary, tool_version(program)))
+    cacheDir = defaults_cache_dir()
+    path = os.path.join(cacheDir, "%s-%s.txt" % (os.path.basename(program),
+        key.hexdigest()[:16]))
+    if os.path.exists(path):
+        return path
+    try:
+        os.makedirs(cacheDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmpPath = tempfile.mkstemp(dir=cacheDir, prefix=".defaults")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            status = subprocess.call([program, "-d"], stdout=f)
+        if status != 0:
+            raise RuntimeError("%s -d exited with status %i"
+                % (program, status))
+        os.rename(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    return path
+
+
+def _find_program(program):
+    """Resolved path of `program` on the ``$PATH``."""
+    if os.path.dirname(program):
+        return os.path.realpath(program)
+    for directory in os.getenv('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.realpath(path)
+    return program
+
+
+def cost_model():
+    """The :class:`moastro.executor.CostModel` of batch runs, with rates
+    saved in the astromatic cache directory.
+    """
+    return CostModel(path=os.path.join(defaults_cache_dir(), "runtimes.json"))
+
+
+def logged_pixels(doc, exts):
+    """Number of pixels of an image from the ``NAXIS1`` and ``NAXIS2``
+    values of its image log document, recorded at ingest for each extension
+    in `exts` or in the base document. ``None`` if they were not recorded.
+    """
+    npix = 0
+    for ext in exts:
+        extDoc = doc.get(str(ext))
+        if isinstance(extDoc, dict) and 'NAXIS1' in extDoc \
+                and 'NAXIS2' in extDoc:
+            npix += extDoc['NAXIS1'] * extDoc['NAXIS2']
+    if npix == 0 and 'NAXIS1' in doc and 'NAXIS2' in doc:
+        npix = doc['NAXIS1'] * doc['NAXIS2']
+    return npix or None
+
+
+def image_pixels(path):
+    """Number of pixels in the images of a FITS file, read from its headers.
+    Falls back to the file size if the headers cannot be read.
+    """
+    try:
+        headers = scan_headers(path)
+    except (IOError, OSError, ValueError):
+        return file_size(path)
+    npix = 0
+    for header in headers:
+        if header.get('NAXIS', 0) < 2:
+            continue
+        n = 1
+        for i in range(1, header['NAXIS'] + 1):
+            n *= header.get('NAXIS%i' % i, 0)
+        npix += n
+    return npix or file_size(path)
 
 
 class Swarp(Astromatic):
     """This class wraps the functionality of Astromatic's Swarp mosaic
     software.
     """
+    program = "swarp"
+    
     def __init__(self, imagePaths, mosaicName, scampHeadPaths=None,
             weightPaths=None, defaultsPath=None, configs=None,
             workDir="mosaic", uniqueExt=""):
         self.imagePaths = imagePaths
         self.uniqueExt = uniqueExt
+        self.imageLog = None  # set by from_db, for resampled records
+        self.imageKeys = None
         mosaicBasename = os.path.splitext(mosaicName)[0]
         self.mosaicPath = os.path.join(workDir, mosaicBasename + ".fits")
         self.mosaicWeightPath = os.path.join(workDir,
@@ -196,9 +492,12 @@ class Swarp(Astromatic):
         else:
             weightPaths = None
         
-        return cls(imagePaths, mosaicName, scampHeadPaths=scampHeadPaths,
+        swarp = cls(imagePaths, mosaicName, scampHeadPaths=scampHeadPaths,
             weightPaths=weightPaths, defaultsPath=defaultsPath,
-            configs=configs, workDir=workDir, uniqueExt="")
+            configs=configs, workDir=workDir, uniqueExt=uniqueExt)
+        swarp.imageLog = imageLog
+        swarp.imageKeys = list(imageKeys)
+        return swarp
     
     def set_target_fits(self, targetFITSPath):
         """Use the header of `targetFITSPath` to define output pixel space.
@@ -224,6 +523,9 @@ class Swarp(Astromatic):
         """docstring for _write_target_header"""
         path = os.path.splitext(self.mosaicPath)[0] + ".head"
         if os.path.exists(path):
+            with open(path) as f:
+                if f.read() == headerText:
+                    return  # unchanged; keep its mtime for fingerprints
             os.remove(path)
         f = open(path, 'w')
         f.write(headerText)
@@ -262,6 +564,9 @@ class Swarp(Astromatic):
             if (origHeaderPath is not None) \
                     and (origHeaderPath != newHeaderPath):
                 if os.path.exists(newHeaderPath):
+                    if filecmp.cmp(origHeaderPath, newHeaderPath,
+                            shallow=False):
+                        continue  # already in place; leave it for others
                     os.remove(newHeaderPath)  # clean out old copies at dest.
                 shutil.copy(origHeaderPath, newHeaderPath)
 
@@ -287,6 +592,118 @@ class Swarp(Astromatic):
         
         return command
     
+    def run(self, virtualHost=None, executor=None, force=False, stager=None):
+        """Run Swarp (see :meth:`Astromatic.run`).
+        
+        :param stager: (optional) :class:`moastro.staging.Stager`. The input
+            images, weights and external headers are staged to its scratch
+            space, where external headers are also copied next to the
+            images, and the mosaic is written there and moved to
+            `mosaicPath` in the background. Call the stager's ``finish()``
+            to wait for it. The fingerprint of a staged run is checked and
+            saved against the final paths, once the mosaic is moved.
+        """
+        if stager is None:
+            return super(Swarp, self).run(virtualHost=virtualHost,
+                executor=executor, force=force)
+        # The command is only made for the staged inputs, since it copies
+        # external headers next to the images
+        self.add_default_param_to_configs("swarp -d")
+        fingerprint = None
+        if virtualHost is None:
+            fingerprint = self.fingerprint(self.program)
+            if not force and self.is_current(fingerprint, self.program):
+                return self.skip(Job([self.program], name=self.program))
+        sources = []
+        for key in sorted(self.swarpInputs):
+            for name in ('path', 'weight', 'head'):
+                value = self.swarpInputs[key][name]
+                if type(value) is list:
+                    sources.extend(value)
+                elif value is not None:
+                    sources.append(value)
+        stager.prefetch(sources)
+        try:
+            staged = stager.acquire_all(sources)
+        except:
+            stager.cancel(sources)
+            raise
+        
+        def local(value):
+            if type(value) is list:
+                return [local(v) for v in value]
+            return staged.get(value, value)
+        
+        swarpInputs = self.swarpInputs
+        mosaicPaths = self.mosaic_paths()
+        configs = None if self.configs is None else dict(self.configs)
+        moves = []
+        try:
+            outDir = stager.output_dir(os.path.basename(mosaicPaths[0]))
+            self.swarpInputs = dict((key, dict((name, local(value))
+                for name, value in db.iteritems()))
+                for key, db in swarpInputs.iteritems())
+            self.mosaicPath = os.path.join(outDir,
+                os.path.basename(mosaicPaths[0]))
+            self.mosaicWeightPath = os.path.join(outDir,
+                os.path.basename(mosaicPaths[1]))
+            targetPath = os.path.splitext(mosaicPaths[0])[0] + ".head"
+            if os.path.exists(targetPath):
+                shutil.copy(targetPath,
+                    os.path.splitext(self.mosaicPath)[0] + ".head")
+            job = self.make_job(virtualHost=virtualHost)
+            result = self.execute(job, executor=executor)
+            if result.ok:
+                moves.append((self.mosaicPath, mosaicPaths[0], None))
+                if os.path.exists(self.mosaicWeightPath):
+                    moves.append((self.mosaicWeightPath, mosaicPaths[1],
+                        None))
+        finally:
+            self.swarpInputs = swarpInputs
+            self.mosaicPath, self.mosaicWeightPath = mosaicPaths
+            self.configs = configs  # without the scratch output names
+            for path in staged:
+                stager.release(path)
+        if len(moves) > 0:
+            callback = None
+            if fingerprint is not None:
+                callback = functools.partial(self.save_fingerprint,
+                    fingerprint, self.program)
+            stager.move_all(moves, callback=callback)
+        return result
+    
+    def input_paths(self):
+        """Input images, weights and external headers, and the target
+        header of the mosaic if there is one.
+        """
+        paths = []
+        for key in sorted(self.swarpInputs):
+            db = self.swarpInputs[key]
+            for name in ('path', 'weight', 'head'):
+                if type(db[name]) is list:
+                    paths.extend(db[name])
+                elif db[name] is not None:
+                    paths.append(db[name])
+        targetPath = os.path.splitext(self.mosaicPath)[0] + ".head"
+        if os.path.exists(targetPath):
+            paths.append(targetPath)
+        return paths
+    
+    def output_paths(self):
+        """The mosaic and its weight map."""
+        return [self.mosaicPath, self.mosaicWeightPath]
+    
+    def fingerprint_configs(self):
+        """Configs of the run, without those :meth:`make_command` derives
+        from the inputs and outputs, so that the fingerprint can be computed
+        before the command is made (see :meth:`run`).
+        """
+        configs = _run_configs(self.configs)
+        configs.pop("c", None)
+        if not self.useWeights:
+            configs["WEIGHT_TYPE"] = "NONE"
+        return configs
+    
     def mosaic_paths(self):
         """:return: tuple of (mosaic path, mosaic weight path)."""
         return self.mosaicPath, self.mosaicWeightPath
@@ -342,6 +759,171 @@ class Swarp(Astromatic):
             resamp_wpaths.append(im_wpaths)
         return resamp_paths, resamp_wpaths
     
+    def target_fingerprint(self):
+        """Fingerprint of the output pixel grid: the WCS of the target header
+        (see :meth:`set_target_header`) and the resampling configs. Resampled
+        images recorded under the same fingerprint can be reused.
+        """
+        path = os.path.splitext(self.mosaicPath)[0] + ".head"
+        if not os.path.exists(path):
+            raise ValueError("Resampled images are only reused for a fixed "
+                "target; call set_target_header() first")
+        if os.path.islink(path):
+            header = pyfits.getheader(os.path.realpath(path))
+        else:
+            with open(path) as f:
+                text = f.read()
+            if "\n" in text:
+                header = pyfits.Header.fromstring(text, sep="\n")
+            else:
+                header = pyfits.Header.fromstring(text)
+        wcs = dict((key, str(header[key])) for key in header.keys()
+            if _is_wcs_key(key))
+        configs = dict((key, str(value))
+            for key, value in (self.configs or {}).iteritems()
+            if key in _RESAMPLING_CONFIGS)
+        state = {"wcs": wcs, "configs": configs}
+        return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()[:16]
+    
+    def resampled_records(self, resampKey="resamp"):
+        """Valid resampled products of the input images, from the image log.
+        
+        A record is valid if its resampled images and weights exist and the
+        input image, weight and external header are unchanged since it was
+        made. Requires a run made with :meth:`from_db`.
+        
+        :param resampKey: image log key of the resampled products; records
+            are stored under ``<resampKey>.<target fingerprint>``.
+        :return: dictionary of records keyed by image key; the record is
+            ``None`` for images that need to be resampled. A record has
+            ``image`` and ``weight`` dictionaries of resampled paths keyed by
+            extension (see :meth:`resampled_paths`).
+        """
+        if self.imageLog is None:
+            raise ValueError("Resampled images are recorded for runs made "
+                "with Swarp.from_db()")
+        recordKey = "%s.%s" % (resampKey, self.target_fingerprint())
+        recs = self.imageLog.find_dict({}, images=self.imageKeys,
+            fields=[recordKey])
+        records = {}
+        for imageKey, name in zip(self.imageKeys, self.imageNames):
+            try:
+                record = reach(recs[imageKey], recordKey)
+            except (KeyError, TypeError):
+                record = None
+            if record is not None \
+                    and not _resampled_valid(record, self.swarpInputs[name]):
+                record = None
+            records[imageKey] = record
+        return records
+    
+    def resample(self, resampKey="resamp", executor=None,
+            nthreads=multiprocessing.cpu_count(), force=False):
+        """Resample each input image onto the target grid, skipping images
+        with valid resampled products (see :meth:`resampled_records`).
+        
+        Each image is resampled by its own Swarp run (``COMBINE N``), and
+        the runs share the executor. The resampled paths are written to the
+        image log under ``<resampKey>.<target fingerprint>``, and the images
+        go to ``<workDir>/resamp/<target fingerprint>/<image key>``, so that
+        inputs sharing a file name do not overwrite each other.
+        
+        :param executor: (optional) :class:`moastro.executor.JobExecutor`.
+        :param nthreads: maximum number of images submitted at once.
+        :param force: if ``True``, resample all images.
+        :return: dictionary of errors keyed by image key.
+        """
+        fingerprint = self.target_fingerprint()
+        recordKey = "%s.%s" % (resampKey, fingerprint)
+        records = self.resampled_records(resampKey)
+        resampRoot = os.path.join(self.workDir, "resamp", fingerprint)
+        runs = []
+        for imageKey, name in zip(self.imageKeys, self.imageNames):
+            if force or records[imageKey] is None:
+                resampDir = os.path.join(resampRoot, str(imageKey))
+                if not os.path.exists(resampDir):
+                    os.makedirs(resampDir)
+                runs.append((imageKey, self.swarpInputs[name],
+                    self._resample_swarp(name, resampDir), executor))
+        
+        failures = {}
+        updates = {}
+        pool = ThreadPool(processes=max(1, min(nthreads, len(runs))))
+        try:
+            for imageKey, record, error in pool.imap_unordered(
+                    _resample_worker, runs, chunksize=1):
+                if error is not None:
+                    failures[imageKey] = error
+                    continue
+                updates[imageKey] = {recordKey: record}
+        finally:
+            pool.close()
+            pool.join()
+            if len(updates) > 0:
+                self.imageLog.set_images(updates)
+        return failures
+    
+    def combine(self, resampKey="resamp", executor=None,
+            nthreads=multiprocessing.cpu_count(), force=False):
+        """Make the mosaic from resampled images, resampling only the images
+        without valid resampled products. Iterating on combine parameters
+        (``COMBINE_TYPE``, clipping, ...) then only re-runs the combination.
+        
+        :return: the :class:`moastro.executor.JobResult` of the combination,
+            also kept as the ``result`` attribute.
+        """
+        failures = self.resample(resampKey=resampKey, executor=executor,
+            nthreads=nthreads, force=force)
+        if len(failures) > 0:
+            raise RuntimeError("Resampling failed for %s"
+                % ", ".join(sorted(failures)))
+        records = self.resampled_records(resampKey)
+        imagePaths = []
+        weightPaths = []
+        for imageKey in self.imageKeys:
+            record = records[imageKey]
+            for ext in sorted(record['image'], key=int):
+                imagePaths.append(record['image'][ext])
+                weightPaths.append(record['weight'][ext])
+        
+        configs = _run_configs(self.configs)
+        configs.update({"RESAMPLE": "N", "COMBINE": "Y"})
+        configs.pop("RESAMPLE_DIR", None)
+        if self.useWeights:
+            configs["WEIGHT_TYPE"] = "MAP_WEIGHT"  # as written by Swarp
+        else:
+            weightPaths = None
+        combiner = Swarp(imagePaths, os.path.basename(self.mosaicPath),
+            weightPaths=weightPaths, defaultsPath=self.defaultsPath,
+            configs=configs, workDir=self.workDir,
+            uniqueExt=self.uniqueExt + "_combine")
+        combiner.cpus = self.cpus
+        combiner.memory = self.memory
+        self.result = combiner.run(executor=executor, force=force)
+        return self.result
+    
+    def _resample_swarp(self, name, resampDir):
+        """The Swarp run resampling one input image onto the target."""
+        db = self.swarpInputs[name]
+        configs = _run_configs(self.configs)
+        configs.update({"RESAMPLE": "Y", "COMBINE": "N",
+            "RESAMPLE_DIR": resampDir})
+        mosaicBase = os.path.splitext(os.path.basename(self.mosaicPath))[0]
+        swarp = Swarp([db['path']], "%s_%s" % (mosaicBase, name),
+            scampHeadPaths=None if db['head'] is None else [db['head']],
+            weightPaths=None if db['weight'] is None else [db['weight']],
+            defaultsPath=self.defaultsPath, configs=configs,
+            workDir=os.path.join(resampDir, "runs"), uniqueExt="_" + name)
+        swarp.cpus = self.cpus
+        swarp.memory = self.memory
+        targetPath = os.path.splitext(self.mosaicPath)[0] + ".head"
+        if os.path.islink(targetPath):
+            swarp.set_target_fits(os.path.realpath(targetPath))
+        else:
+            with open(targetPath) as f:
+                swarp._write_target_header(f.read())
+        return swarp
+    
     def write_input_file_list(self, paths, name="list"):
         """Override the Terapix class's method so that lists of imagePaths,
         associated with a single image image key can be expanded.
@@ -408,6 +990,346 @@ class Swarp(Astromatic):
         mosaicFITS.close()
 
 
+# Swarp configs that change the resampled images of an input
+_RESAMPLING_CONFIGS = ('RESAMPLING_TYPE', 'OVERSAMPLING', 'INTERPOLATE',
+    'FSCALASTRO_TYPE', 'FSCALE_KEYWORD', 'FSCALE_DEFAULT', 'GAIN_KEYWORD',
+    'GAIN_DEFAULT', 'SATLEV_KEYWORD', 'SATLEV_DEFAULT', 'SUBTRACT_BACK',
+    'BACK_TYPE', 'BACK_DEFAULT', 'BACK_SIZE', 'BACK_FILTERSIZE',
+    'BACK_FILTTHRESH', 'BACK_MODE', 'WEIGHT_TYPE', 'RESCALE_WEIGHTS',
+    'WEIGHT_THRESH', 'WEIGHT_SUFFIX', 'CELESTIAL_TYPE', 'PROJECTION_TYPE',
+    'PROJECTION_ERR', 'CENTER_TYPE', 'CENTER', 'PIXELSCALE_TYPE',
+    'PIXEL_SCALE', 'IMAGE_SIZE', 'HEADER_SUFFIX')
+
+# Swarp configs that make_command sets for each run
+_RUN_CONFIGS = ('IMAGEOUT_NAME', 'WEIGHTOUT_NAME', 'WEIGHT_IMAGE')
+
+
+def _run_configs(configs):
+    """Copy of `configs` for a derived Swarp run, without the configs that
+    name the inputs and outputs of the original run.
+    """
+    configs = dict(configs or {})
+    for key in _RUN_CONFIGS:
+        configs.pop(key, None)
+    return configs
+
+
+def _is_wcs_key(key):
+    """``True`` for header keywords defining the output pixel grid."""
+    if key in ('NAXIS1', 'NAXIS2', 'EQUINOX', 'RADESYS', 'RADECSYS',
+            'LONPOLE', 'LATPOLE'):
+        return True
+    return key[:5] in ('CTYPE', 'CUNIT', 'CRVAL', 'CRPIX', 'CDELT') \
+        or (key[:2] in ('CD', 'PC', 'PV') and '_' in key)
+
+
+def _file_state(path):
+    """``[size, mtime]`` of a file, or ``None`` if it does not exist."""
+    if path is None or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def _input_states(db):
+    """States of the image, weight and external header of a Swarp input."""
+    return dict((name, _file_state(db[name]))
+        for name in ('path', 'weight', 'head') if db[name] is not None)
+
+
+def _resampled_valid(record, db):
+    """``True`` if a resampled record is usable for a Swarp input."""
+    if record.get('inputs') != _input_states(db):
+        return False
+    for paths in (record.get('image'), record.get('weight')):
+        if not paths:
+            return False
+        for path in paths.values():
+            if not os.path.exists(path):
+                return False
+    return True
+
+
+def _image_exts(path):
+    """Extensions of a FITS file that Swarp resamples: ``[0]`` for a simple
+    image, otherwise the image extensions of the MEF.
+    """
+    headers = scan_headers(path)
+    if len(headers) == 1:
+        return [0]
+    return [i for i, header in enumerate(headers)
+        if i > 0 and header.get('NAXIS', 0) >= 2]
+
+
+def _resample_worker(args):
+    """Worker resampling one Swarp input in a pool thread, returning
+    ``(imageKey, record, error)``.
+    """
+    imageKey, db, swarp, executor = args
+    try:
+        states = _input_states(db)
+        result = swarp.run(executor=executor, force=True)
+        if not result.ok:
+            return imageKey, None, result.log
+        paths, wpaths = swarp.resampled_paths(_image_exts(db['path']))
+        missing = [p for p in paths[0].values() + wpaths[0].values()
+            if not os.path.exists(p)]
+        if len(missing) > 0:
+            return imageKey, None, "Swarp did not write %s" % ", ".join(
+                missing)
+    except Exception:
+        return imageKey, None, traceback.format_exc()
+    return imageKey, {"image": paths[0], "weight": wpaths[0],
+        "inputs": states}, None
+
+
+class TiledSwarp(object):
+    """Build a large mosaic as a set of overlapping tiles, each made by its
+    own Swarp run.
+    
+    The target header (the WCS and size of the whole mosaic) is split into
+    tiles of `tileSize` pixels that overlap their neighbours by `overlap`
+    pixels. Each tile only gets the images whose footprint overlaps it (see
+    :meth:`moastro.imagelog.ImageLog.find_overlapping`), and the tiles are
+    run concurrently on the executor. Tiles are named
+    ``<mosaicName>_<i>_<j>`` and written to their own directory under
+    `workDir`, so a failed or outdated tile can be run again alone::
+    
+        tiled = TiledSwarp(imageLog, targetHeader, "path", "field",
+            scampHeadPathKey="scamp", selector={"FILTER": "Ks"})
+        failures = tiled.run()
+        tiled.run(tiles=failures.keys())  # retry failed tiles
+        tiled.assemble()
+    
+    :param imageLog: the :class:`moastro.imagelog.ImageLog`.
+    :param targetHeader: header (:class:`astropy.io.fits.Header`) of the
+        full mosaic, with its ``NAXIS1``/``NAXIS2`` and WCS.
+    :param pathKey: image log key of the image paths.
+    :param mosaicName: name of the mosaic; tiles are named after it.
+    :param tileSize: ``(nx, ny)`` size of the tiles in pixels, before the
+        overlap is added.
+    :param overlap: pixels by which each tile extends into its neighbours.
+    :param selector: (optional) image log selector for the input images.
+    :param images: (optional) image keys to draw the inputs from.
+    The other arguments are passed to :meth:`Swarp.from_db`.
+    """
+    def __init__(self, imageLog, targetHeader, pathKey, mosaicName,
+            tileSize=(4096, 4096), overlap=100, scampHeadPathKey=None,
+            weightPathKey=None, selector=None, images=None, defaultsPath=None,
+            configs=None, workDir="mosaic"):
+        super(TiledSwarp, self).__init__()
+        self.imageLog = imageLog
+        self.targetHeader = targetHeader
+        self.pathKey = pathKey
+        self.mosaicName = os.path.splitext(mosaicName)[0]
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self.scampHeadPathKey = scampHeadPathKey
+        self.weightPathKey = weightPathKey
+        self.selector = selector
+        self.images = images
+        self.defaultsPath = defaultsPath
+        self.configs = configs
+        self.workDir = workDir
+        self.mosaicPath = os.path.join(workDir, self.mosaicName + ".fits")
+        self.mosaicWeightPath = os.path.join(workDir,
+            self.mosaicName + "_weight.fits")
+        self.tilePaths = {}  # tile name: (mosaic path, weight path)
+    
+    def tiles(self):
+        """Split the target header into tiles.
+        
+        :return: list of tile dictionaries with the tile's ``name``, its
+            target ``header``, its ``core`` pixel range ``(x0, x1, y0, y1)``
+            in the full mosaic (0-based, end exclusive), and its ``extent``,
+            the core grown by the overlap.
+        """
+        nx = self.targetHeader['NAXIS1']
+        ny = self.targetHeader['NAXIS2']
+        tileX, tileY = self.tileSize
+        tiles = []
+        for j, y0 in enumerate(xrange(0, ny, tileY)):
+            for i, x0 in enumerate(xrange(0, nx, tileX)):
+                x1 = min(x0 + tileX, nx)
+                y1 = min(y0 + tileY, ny)
+                ex0 = max(x0 - self.overlap, 0)
+                ex1 = min(x1 + self.overlap, nx)
+                ey0 = max(y0 - self.overlap, 0)
+                ey1 = min(y1 + self.overlap, ny)
+                header = self.targetHeader.copy()
+                header['NAXIS1'] = ex1 - ex0
+                header['NAXIS2'] = ey1 - ey0
+                header['CRPIX1'] = self.targetHeader['CRPIX1'] - ex0
+                header['CRPIX2'] = self.targetHeader['CRPIX2'] - ey0
+                tiles.append({"name": "%s_%i_%i" % (self.mosaicName, i, j),
+                    "header": header, "core": (x0, x1, y0, y1),
+                    "extent": (ex0, ex1, ey0, ey1)})
+        return tiles
+    
+    def tile_images(self, tile):
+        """Keys of the images overlapping a tile."""
+        polygon = linear_footprints([tile['header']])[0]
+        if polygon is None:
+            from astropy.wcs import WCS
+            polygon = WCS(tile['header']).calc_footprint(
+                header=tile['header']).tolist()
+        return self.imageLog.find_overlapping(polygon,
+            selector=self.selector, images=self.images)
+    
+    def tile_swarp(self, tile, imageKeys):
+        """The :class:`Swarp` run of a tile, with its target header written.
+        Resampled images go to the tile's directory so that concurrent tiles
+        do not overwrite each other's.
+        """
+        tileDir = os.path.join(self.workDir, tile['name'])
+        if not os.path.exists(tileDir):
+            os.makedirs(tileDir)
+        configs = dict(self.configs or {})
+        configs.setdefault("RESAMPLE_DIR", os.path.join(tileDir, "resamp"))
+        swarp = Swarp.from_db(self.imageLog, imageKeys, self.pathKey,
+            tile['name'], scampHeadPathKey=self.scampHeadPathKey,
+            weightPathKey=self.weightPathKey, defaultsPath=self.defaultsPath,
+            configs=configs, workDir=tileDir)
+        swarp.set_target_header(tile['header'])
+        return swarp
+    
+    def run(self, tiles=None, executor=None,
+            nthreads=multiprocessing.cpu_count(), force=False):
+        """Run Swarp on the tiles.
+        
+        Tiles whose outputs are up to date (see :meth:`Astromatic.run`) are
+        skipped, so running again only redoes failed or changed tiles.
+        
+        :param tiles: (optional) names of the tiles to run; all by default.
+        :param executor: (optional) :class:`moastro.executor.JobExecutor`
+            sharing CPU slots and memory between the tiles.
+        :param nthreads: maximum number of tiles submitted at once.
+        :param force: if ``True``, tiles are run even if up to date.
+        :return: dictionary of errors keyed by tile name, for failed tiles.
+        """
+        runs = []
+        for tile in self.tiles():
+            if tiles is not None and tile['name'] not in tiles:
+                continue
+            imageKeys = self.tile_images(tile)
+            if len(imageKeys) == 0:
+                continue
+            swarp = self.tile_swarp(tile, imageKeys)
+            # Copy external headers next to the inputs before the tiles run,
+            # since tiles share input images
+            swarp.make_command()
+            runs.append((tile['name'], swarp, executor, force))
+        
+        failures = {}
+        pool = ThreadPool(processes=max(1, min(nthreads, len(runs))))
+        try:
+            for name, swarp, error in pool.imap_unordered(_run_swarp_tile,
+                    runs, chunksize=1):
+                if error is not None:
+                    failures[name] = error
+                    continue
+                self.tilePaths[name] = swarp.mosaic_paths()
+        finally:
+            pool.close()
+            pool.join()
+        return failures
+    
+    def assemble(self, path=None, weightPath=None):
+        """Write the tiles into a single mosaic.
+        
+        The output image is allocated on disk and memory-mapped, and the core
+        of each tile (without its overlap) is copied into place, so the full
+        mosaic is never held in memory. Pixels of tiles without inputs are
+        zero.
+        
+        :param path: (optional) path of the mosaic; defaults to
+            ``<workDir>/<mosaicName>.fits``.
+        :param weightPath: (optional) path of the mosaic weight map; defaults
+            to ``<workDir>/<mosaicName>_weight.fits``. Pass ``False`` to skip
+            the weight map.
+        :return: tuple of (mosaic path, mosaic weight path).
+        """
+        if path is None:
+            path = self.mosaicPath
+        if weightPath is None:
+            weightPath = self.mosaicWeightPath
+        outputs = [(path, 0)]
+        if weightPath:
+            outputs.append((weightPath, 1))
+        tiles = self.tiles()
+        for outputPath, index in outputs:
+            data = _allocate_fits_image(outputPath, self.targetHeader)
+            for tile in tiles:
+                tileDir = os.path.join(self.workDir, tile['name'])
+                paths = self.tilePaths.get(tile['name'], (
+                    os.path.join(tileDir, tile['name'] + ".fits"),
+                    os.path.join(tileDir, tile['name'] + "_weight.fits")))
+                if not os.path.exists(paths[index]):
+                    continue
+                x0, x1, y0, y1 = tile['core']
+                ex0, ex1, ey0, ey1 = tile['extent']
+                tileFITS = pyfits.open(paths[index], memmap=True)
+                tileData = tileFITS[0].data
+                data[y0:y1, x0:x1] = tileData[y0 - ey0:y1 - ey0,
+                    x0 - ex0:x1 - ex0]
+                del tileData
+                tileFITS.close()
+            data.flush()
+            del data
+        if not weightPath:
+            weightPath = None
+        return path, weightPath
+
+
+def _run_swarp_tile(args):
+    """Worker running the Swarp of one tile in a pool thread."""
+    name, swarp, executor, force = args
+    try:
+        result = swarp.run(executor=executor, force=force)
+    except Exception:
+        return name, swarp, traceback.format_exc()
+    if not result.ok:
+        return name, swarp, result.log
+    return name, swarp, None
+
+
+# Structural keywords not carried over from a target header to the
+# primary header of an assembled mosaic
+_STRUCTURAL_KEYS = ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1',
+    'NAXIS2', 'EXTEND', 'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'END')
+
+
+def _allocate_fits_image(path, targetHeader):
+    """Create a float32 FITS image with the size and WCS of `targetHeader`,
+    returning a writable memory map of its pixels.
+    """
+    nx = targetHeader['NAXIS1']
+    ny = targetHeader['NAXIS2']
+    header = pyfits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = -32
+    header['NAXIS'] = 2
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    for card in targetHeader.cards:
+        if card.keyword in _STRUCTURAL_KEYS \
+                or card.keyword in ('', 'COMMENT', 'HISTORY'):
+            continue
+        header[card.keyword] = (card.value, card.comment)
+    headerText = header.tostring()
+    nbytes = nx * ny * 4
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(headerText.encode('ascii'))
+        # Sparse allocation of the data, padded to a whole FITS block
+        f.seek(len(headerText) + nbytes + (-nbytes % 2880) - 1)
+        f.write(b"\0")
+    return np.memmap(path, dtype='>f4', mode='r+', offset=len(headerText),
+        shape=(ny, nx))
+
+
 class Scamp(Astromatic):
     """Python wrapper class for Terapix's SCAMP application for astrometric
     and photometric registration of mosaics.
@@ -520,6 +1442,15 @@ class Scamp(Astromatic):
         
         return command
     
+    def input_paths(self):
+        """The Source Extractor catalogs."""
+        return list(self.catalogPaths)
+    
+    def output_paths(self):
+        """The .head files produced for each catalog."""
+        return [os.path.splitext(path)[0] + ".head"
+            for path in self.catalogPaths]
+    
     def save_scamp_headers(self, scampKey="scamp"):
         """Insert the SExtractor objects from the `self.headDB` dictionary to
         the given `imageLog` under the key `scampKey`. Must have instantiated
@@ -534,6 +1465,7 @@ class Scamp(Astromatic):
 
 class SourceExtractor(Astromatic):
     """Represents a run of Terapix's Source Extractor."""
+    maxThreads = 2
     
     def __init__(self, fitsPath, catalogName, weightPath=None,
             weightType=None, psfPath=None, configs=None, workDir="sex",
@@ -637,6 +1569,18 @@ class SourceExtractor(Astromatic):
     def catalog_path(self):
         """Returns the path to the SE catalog."""
         return self.catalogPath
+    
+    def input_paths(self):
+        """The image, and its weight map and PSF model if used."""
+        return [path for path in (self.inputPath, self.weightPath,
+            self.psfPath) if path is not None]
+    
+    def output_paths(self):
+        """The catalog and check images."""
+        paths = [self.catalogPath]
+        if len(self.checkList) > 0:
+            paths.extend(self.checkPaths)
+        return paths
 
 
 class BatchSourceExtractor(object):
@@ -672,55 +1616,245 @@ class BatchSourceExtractor(object):
             os.makedirs(self.checkDir)
         self.checkKeyDict = checkKeyDict
     
-    def run(self, nthreads=multiprocessing.cpu_count(), debug=False):
-        """docstring for run"""
-        args = []
+    def run(self, nthreads=multiprocessing.cpu_count(), debug=False,
+            executor=None, force=False, batch_size=50, costModel=None,
+            stager=None):
+        """Run Source Extractor on all images.
+        
+        Catalog and check image paths are written to the image log in bulk
+        as runs finish, `batch_size` images at a time, so finished images
+        are recorded even if the batch is interrupted. A failed image does
+        not stop the batch.
+        
+        Images are submitted longest-first, according to their pixel count
+        (and whether a weight map or PSF is used) and the runtimes measured
+        in earlier batches, and handed to threads one at a time. Pixel
+        counts come from the ``NAXIS1``/``NAXIS2`` values recorded at
+        ingest (see :func:`logged_pixels`); the headers of images without
+        them are read on `nthreads` threads.
+        
+        :param nthreads: number of Source Extractor runs submitted at once.
+            The runs share the CPU and memory limits of `executor`.
+        :param executor: (optional) :class:`moastro.executor.JobExecutor`
+            to run on.
+        :param force: if ``True``, images whose catalogs are up to date are
+            extracted again.
+        :param batch_size: number of finished images per image log write.
+        :param costModel: (optional) :class:`moastro.executor.CostModel`.
+            By default runtimes are shared through :func:`cost_model`.
+        :param stager: (optional) :class:`moastro.staging.Stager`. Images,
+            weights and PSFs are prefetched to its scratch space in the order
+            they are run, and catalogs and check images are written there
+            and moved back to `workDir` in the background. Their paths are
+            written to the image log once moved. Fingerprints of staged runs
+            are checked against the final paths before staging, and saved
+            once the outputs are moved.
+        :return: dictionary of `imageKey: error` for images that failed,
+            where `error` is the traceback or the Source Extractor output.
+            Also kept as the `failures` attribute.
+        """
+        fields = [self.pathKey, "NAXIS1", "NAXIS2"]
+        for ext in self.imageLog.exts:
+            fields.extend(("%s.NAXIS1" % ext, "%s.NAXIS2" % ext))
+        if self.weightKey is not None:
+            fields.append(self.weightKey)
+        if self.psfKey is not None:
+            fields.append(self.psfKey)
+        recs = self.imageLog.find_dict({}, images=self.imageKeys,
+            fields=fields)
+        if self.checkKeyDict is None:
+            checkList = None
+        else:
+            checkList = self.checkKeyDict.keys()
+        if costModel is None:
+            costModel = cost_model()
+        inputs = []
+        pixels = {}
+        self.failures = {}
         for imageKey in self.imageKeys:
-            imagePath = self.imageLog[imageKey][self.pathKey]
+            if imageKey not in recs:
+                self.failures[imageKey] = "Image not found in image log"
+                continue
+            rec = recs[imageKey]
+            imagePath = reach(rec, self.pathKey)
             if self.weightKey is not None:
-                weightPath = self.imageLog[imageKey][self.weightKey]
+                weightPath = reach(rec, self.weightKey)
             else:
                 weightPath = None
             if self.psfKey is not None:
-                psfPath = self.imageLog[imageKey][self.psfKey]
+                psfPath = reach(rec, self.psfKey)
             else:
                 psfPath = None
-            if self.checkKeyDict is None:
-                checkList = None
+            inputs.append((imageKey, imagePath, weightPath, psfPath))
+            pixels[imageKey] = logged_pixels(rec, self.imageLog.exts)
+        
+        # Read the sizes of images ingested without NAXIS values from their
+        # headers, concurrently
+        unknown = [(k, path) for k, path, w, p in inputs
+            if pixels[k] is None]
+        if len(unknown) > 0:
+            paths = [path for k, path in unknown]
+            if debug is False and nthreads > 1:
+                pool = ThreadPool(processes=nthreads)
+                try:
+                    npix = pool.map(image_pixels, paths, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
             else:
-                checkList = self.checkKeyDict.keys()
-            args.append((imageKey, imagePath, weightPath, self.weightType,
-                psfPath, self.configs, checkList, self.catPostfix,
-                self.workDir, self.defaultsPath))
+                npix = [image_pixels(path) for path in paths]
+            pixels.update(zip([k for k, path in unknown], npix))
+        
+        args = []
+        costs = {}
+        for imageKey, imagePath, weightPath, psfPath in inputs:
+            kind = "sex"
+            if weightPath is not None:
+                kind += "+weight"
+            if psfPath is not None:
+                kind += "+psf"
+            costs[imageKey] = (kind, pixels[imageKey])
+            args.append(costs[imageKey] + ((imageKey, imagePath, weightPath,
+                self.weightType, psfPath, self.configs, checkList,
+                self.catPostfix, self.workDir, self.defaultsPath, executor,
+                force, stager),))
+        args = costModel.longest_first(args)
+        if stager is not None:
+            stager.prefetch(path for a in args for path in (a[1], a[2], a[4]))
         
         if debug is False:
-            pool = multiprocessing.Pool(processes=nthreads)
-            results = pool.map(_workSE, args)
+            # Threads only wait on the executor's child processes
+            pool = ThreadPool(processes=nthreads)
+            results = pool.imap_unordered(_workSE, args, chunksize=1)
         else:
-            results = map(_workSE, args)
-        
-        # Insert results into the image log
-        for (imageKey, se) in results:
-            print imageKey, se
-            self.imageLog.set(imageKey, self.catalogKey, se.catalog_path())
-            for checkType, checkKey in self.checkKeyDict.iteritems():
-                self.imageLog.set(imageKey, checkKey, se.check_path(checkType))
+            pool = None
+            results = itertools.imap(_workSE, args)
+        
+        # Insert results into the image log as they arrive
+        updates = {}
+        nMoved = 0
+        try:
+            for result in results:
+                imageKey = result['image']
+                if result['error'] is not None:
+                    print "Source Extractor failed on %s" % imageKey
+                    self.failures[imageKey] = result['error']
+                    continue
+                if not result['skipped']:
+                    costModel.record(costs[imageKey][0], costs[imageKey][1],
+                        result['wall_time'])
+                if stager is not None and not result['skipped']:
+                    self._move_back(stager, result)
+                    nMoved += 1
+                    if nMoved >= batch_size:
+                        stager.flush(self.imageLog)
+                        nMoved = 0
+                    continue
+                fields = {self.catalogKey: result['catalog']}
+                for checkType, checkKey in self.checkKeyDict.iteritems():
+                    fields[checkKey] = result['checks'].get(checkType)
+                updates[imageKey] = fields
+                if len(updates) >= batch_size:
+                    self.imageLog.set_images(updates)
+                    updates = {}
+        finally:
+            if len(updates) > 0:
+                self.imageLog.set_images(updates)
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if stager is not None:
+                self.failures.update(stager.finish(self.imageLog))
+            costModel.save()
+        return self.failures
+    
+    def _move_back(self, stager, result):
+        """Move the outputs of a staged run to their final paths."""
+        final = result['final']
+        moves = [(result['catalog'], final['catalog'], self.catalogKey)]
+        for checkType, checkKey in self.checkKeyDict.iteritems():
+            if result['checks'].get(checkType) is not None:
+                moves.append((result['checks'][checkType],
+                    final['checks'][checkType], checkKey))
+        stager.move_all(moves, imageKey=result['image'],
+            callback=result['callback'])
 
 
 def _workSE(args):
-    """Worker function for batch source extraction."""
-    imageKey, imagePath, weightPath, weightType, psfPath, configs, \
-        checkImages, catPostfix, workDir, defaultsPath = args
+    """Worker function for batch source extraction.
     
-    catalogName = "_".join((str(imageKey), catPostfix))
-    se = SourceExtractor(imagePath, catalogName, weightPath=weightPath,
-        weightType=weightType, psfPath=psfPath, configs=configs,
-        workDir=workDir,
-        defaultsPath=defaultsPath)
-    if checkImages is not None:
-        se.set_check_images(checkImages, workDir)
-    se.run()
-    return imageKey, se
+    :return: a result record with the `image` key, the `catalog` path, the
+        `checks` image paths by check type, the `returncode`, `wall_time`
+        and `skipped` status of the run, and an `error` (``None`` on
+        success). Outputs of staged runs are in the scratch space; their
+        final paths are in `final`, with the same `catalog` and `checks`
+        keys, and `callback` records the run's fingerprint once they are
+        moved.
+    """
+    imageKey, imagePath, weightPath, weightType, psfPath, configs, \
+        checkImages, catPostfix, workDir, defaultsPath, executor, force, \
+        stager = args
+    record = {"image": imageKey, "catalog": None, "checks": {},
+        "returncode": None, "wall_time": 0., "skipped": False,
+        "error": None, "final": None, "callback": None}
+    sources = [path for path in (imagePath, weightPath, psfPath)
+        if path is not None]
+    staged = {}
+    acquired = stager is None
+    try:
+        catalogName = "_".join((str(imageKey), catPostfix))
+        # Runs in a thread; make_command() adds run-specific configs
+        se = SourceExtractor(imagePath, catalogName, weightPath=weightPath,
+            weightType=weightType, psfPath=psfPath,
+            configs=None if configs is None else dict(configs),
+            workDir=workDir, defaultsPath=defaultsPath)
+        if checkImages is not None:
+            se.set_check_images(checkImages, workDir)
+        if stager is not None:
+            # Fingerprints are checked and saved against the final paths
+            job = se.make_job()
+            fingerprint = se.fingerprint(job.name)
+            if not force and se.is_current(fingerprint, job.name):
+                result = se.skip(job)
+            else:
+                staged = stager.acquire_all(sources)
+                acquired = True
+                record['final'] = _se_outputs(se)
+                record['callback'] = functools.partial(se.save_fingerprint,
+                    fingerprint, job.name)
+                outDir = stager.output_dir(imageKey)
+                se = SourceExtractor(staged.get(imagePath, imagePath),
+                    catalogName, weightPath=staged.get(weightPath, weightPath),
+                    weightType=weightType,
+                    psfPath=staged.get(psfPath, psfPath),
+                    configs=None if configs is None else dict(configs),
+                    workDir=outDir, defaultsPath=defaultsPath)
+                if checkImages is not None:
+                    se.set_check_images(checkImages, outDir)
+                result = se.execute(se.make_job(), executor=executor)
+        else:
+            result = se.run(executor=executor, force=force)
+        record['returncode'] = result.returncode
+        record['wall_time'] = result.wall_time
+        record['skipped'] = result.skipped
+        if not result.ok:
+            record['error'] = result.log
+        else:
+            record.update(_se_outputs(se))
+    except Exception:
+        record['error'] = traceback.format_exc()
+    finally:
+        if not acquired:
+            stager.cancel(sources)
+        for path in staged:
+            stager.release(path)
+    return record
+
+
+def _se_outputs(se):
+    """Catalog and check image paths of a Source Extractor run."""
+    checks = dict(zip(se.checkList, getattr(se, 'checkPaths', [])))
+    return {"catalog": se.catalog_path(), "checks": checks}
 
 
 class BatchPSFex(object):
@@ -758,54 +1892,126 @@ class BatchPSFex(object):
         else:
             self.nThreads = multiprocessing.cpu_count()
     
-    def run(self, debug=False):
-        """Executes the multiprocessing PSFex run."""
+    def run(self, debug=False, executor=None, force=False, costModel=None):
+        """Executes the PSFex runs, `nThreads` groups at a time.
+        
+        Groups are submitted longest-first, according to the total size of
+        their catalogs and the runtimes measured in earlier batches, and
+        handed to threads one at a time.
+        
+        :param executor: (optional) :class:`moastro.executor.JobExecutor`
+            to run on.
+        :param force: if ``True``, groups whose PSFs are up to date are
+            run again.
+        :param costModel: (optional) :class:`moastro.executor.CostModel`.
+            By default runtimes are shared through :func:`cost_model`.
+        :return: dictionary of `groupName: error` for groups that failed.
+        """
+        if costModel is None:
+            costModel = cost_model()
+        allKeys = []
+        for imageKeys in self.groupedImageKeys.itervalues():
+            allKeys.extend(imageKeys)
+        recs = self.imageLog.find_dict({}, images=allKeys,
+            fields=[self.catalogPathKey])
         dbArgs = {"url": self.imageLog.url,
                   "port": self.imageLog.port,
                   "dbname": self.imageLog.dbname,
                   "cname": self.imageLog.cname}
         
         args = []
+        sizes = {}
         for groupName, imageKeys in self.groupedImageKeys.iteritems():
-            args.append((groupName, imageKeys, self.catalogPathKey,
-                self.psfKey, self.configs, self.checkImages, self.checkPlots,
-                self.defaultsPath, self.xmlKey, self.workDir, dbArgs))
+            sizes[groupName] = sum(
+                file_size(reach(recs[k], self.catalogPathKey))
+                for k in imageKeys if k in recs)
+            args.append(("psfex", sizes[groupName], (groupName, imageKeys,
+                self.catalogPathKey, self.psfKey, self.configs,
+                self.checkImages, self.checkPlots, self.defaultsPath,
+                self.xmlKey, self.workDir, dbArgs, executor, force)))
+        args = costModel.longest_first(args)
         
         if debug:
-            map(_run_batch_psfex, args)
+            pool = None
+            results = itertools.imap(_run_batch_psfex, args)
         else:
-            pool = multiprocessing.Pool(processes=self.nThreads)
-            pool.map(_run_batch_psfex, args)
+            # Threads only wait on the executor's child processes
+            pool = ThreadPool(processes=self.nThreads)
+            results = pool.imap_unordered(_run_batch_psfex, args,
+                chunksize=1)
+        failures = {}
+        try:
+            for result in results:
+                if result['error'] is not None:
+                    print "PSFex failed on group %s" % result['group']
+                    failures[result['group']] = result['error']
+                elif not result['skipped']:
+                    costModel.record("psfex", sizes[result['group']],
+                        result['wall_time'])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            costModel.save()
+        return failures
 
 
 def _run_batch_psfex(args):
     """Worker function for executing PSFex from BatchPSFex.
     
-    The path to the PSF is stored under `psfKey`."""
-    groupName, imageKeys, catalogPathKey, psfKey, configs, checkImages, \
-        checkPlots, defaultsPath, xmlKey, workDir, dbArgs = args
+    The path to the PSF is stored under `psfKey`.
+    
+    :return: a result record with the `group` name, the `wall_time` and
+        `skipped` status of the run, and an `error` (``None`` on success).
+    """
+    groupName = args[0]
+    record = {"group": groupName, "wall_time": 0., "skipped": False,
+        "error": None}
+    try:
+        result = _run_psfex_group(*args)
+        record['wall_time'] = result.wall_time
+        record['skipped'] = result.skipped
+        if not result.ok:
+            record['error'] = result.log
+    except Exception:
+        record['error'] = traceback.format_exc()
+    return record
+
+
+def _run_psfex_group(groupName, imageKeys, catalogPathKey, psfKey, configs,
+        checkImages, checkPlots, defaultsPath, xmlKey, workDir, dbArgs,
+        executor, force):
+    """Run PSFex on one group of images and save its outputs."""
     dbArgs = dict(dbArgs)  # in case we run in debug mode
     dbname = dbArgs.pop('dbname')
     cname = dbArgs.pop('cname')
     imageLog = ImageLog(dbname, cname, **dbArgs)
     
     print "Running imageKeys:", imageKeys
+    # Runs in a thread; make_command() adds run-specific configs
+    if configs is not None:
+        configs = dict(configs)
     psfex = PSFex.from_db(imageLog, imageKeys, catalogPathKey, configs=configs,
-        xmlKey=xmlKey, defaultsPath=None, workDir=workDir)
+        xmlKey=xmlKey, defaultsPath=defaultsPath, workDir=workDir)
     if checkImages is not None:
         psfex.set_check_images(checkImages, "psfex",
                 os.path.join(workDir, "checks"))
     if checkPlots is not None:
         psfex.set_check_plots(checkPlots, "psfex",
                 os.path.join(workDir, "plots"), plotType="PSC")
-    psfex.run()
+    result = psfex.run(executor=executor, force=force)
+    if not result.ok:
+        return result
     psfex.save_psf_paths(psfKey)
     if xmlKey is not None:
         psfex.save_xml_paths()
+    return result
 
 
 class PSFex(Astromatic):
     """Wrapper on the PSFex PSF-modelling software."""
+    maxThreads = 4
+    
     def __init__(self, catalogPaths, imageLog=None, imageKeys=None,
             defaultsPath=None, configs=None, xmlKey=None,
             workDir='psfex', groupName=None):
@@ -817,6 +2023,7 @@ class PSFex(Astromatic):
         self.imageLog = imageLog
         self.imageKeys = imageKeys
         self.configs = configs
+        self.defaultsPath = defaultsPath
         self.xmlKey = xmlKey
         self.workDir = workDir
         # allows the input list to be named different in batch mode
@@ -856,7 +2063,7 @@ class PSFex(Astromatic):
         catalogPaths = []
         for d in docs:
             imageKeys.append(d['_id'])
-            catalogPaths.append(d[catalogPathKey])
+            catalogPaths.append(reach(d, catalogPathKey))
         return cls(catalogPaths, imageLog=imageLog, imageKeys=imageKeys,
             defaultsPath=defaultsPath, configs=configs, xmlKey=xmlKey,
             workDir=workDir)
@@ -995,6 +2202,14 @@ class PSFex(Astromatic):
             for path in self.catalogPaths]
         return psfPaths
     
+    def input_paths(self):
+        """The Source Extractor catalogs."""
+        return list(self.catalogPaths)
+    
+    def output_paths(self):
+        """The PSF models of each catalog."""
+        return self.psf_paths()
+    
     def save_psf_paths(self, psfKey):
         """Files the psf file paths into the image log under `psfKey` for
         all images.
@@ -1010,3 +2225,88 @@ class PSFex(Astromatic):
         if self.xmlKey is None: return
         for imageKey in self.imageKeys:
             self.imageLog.set(imageKey, self.xmlKey, self.xmlPath)
+
+
+def source_extractor_stage(name, pathKey, catalogKey, weightKey=None,
+        weightType=None, psfKey=None, configs=None, workDir="se",
+        defaultsPath="se/config.sex", catPostfix="se_cat"):
+    """Make a :class:`moastro.pipeline.Stage` running Source Extractor on
+    each image, storing the catalog path under `catalogKey`.
+    
+    Use a different `catPostfix` for a second pass with a PSF model
+    (`psfKey`), so that the first-pass catalogs are kept.
+    """
+    inputs = [pathKey] + [k for k in (weightKey, psfKey) if k is not None]
+    costModel = cost_model()
+    
+    def run(imageLog, unitName, imageKeys, executor):
+        batch = BatchSourceExtractor(imageLog, imageKeys, pathKey,
+            catalogKey, weightKey=weightKey, weightType=weightType,
+            psfKey=psfKey, configs=dict(configs or {}), workDir=workDir,
+            defaultsPath=defaultsPath, catPostfix=catPostfix)
+        failures = batch.run(nthreads=1, executor=executor,
+            costModel=costModel)
+        if len(failures) > 0:
+            raise RuntimeError(failures.values()[0])
+    
+    return Stage(name, run, inputs=inputs, outputs=[catalogKey])
+
+
+def psfex_stage(name, catalogKey, psfKey, group_by, configs=None,
+        defaultsPath=None, workDir="psfex"):
+    """Make a :class:`moastro.pipeline.Stage` running PSFex on each group
+    of catalogs, storing PSF paths under `psfKey`.
+    """
+    def run(imageLog, unitName, imageKeys, executor):
+        psfex = PSFex.from_db(imageLog, imageKeys, catalogKey,
+            configs=dict(configs or {}), defaultsPath=defaultsPath,
+            workDir=workDir)
+        result = psfex.run(executor=executor)
+        if not result.ok:
+            raise RuntimeError(result.log)
+        psfex.save_psf_paths(psfKey)
+    
+    return Stage(name, run, inputs=[catalogKey], outputs=[psfKey],
+        group_by=group_by)
+
+
+def scamp_stage(name, catalogKey, scampKey, group_by, configs=None,
+        defaultsPath=None, workDir="scamp"):
+    """Make a :class:`moastro.pipeline.Stage` running SCAMP on each group
+    of catalogs, storing the .head paths under `scampKey`.
+    """
+    def run(imageLog, unitName, imageKeys, executor):
+        scamp = Scamp.from_db(imageLog, imageKeys, catalogKey,
+            defaultsPath=defaultsPath, configs=dict(configs or {}),
+            workDir=os.path.join(workDir, str(unitName)))
+        result = scamp.run(executor=executor)
+        if not result.ok:
+            raise RuntimeError(result.log)
+        scamp.save_scamp_headers(scampKey)
+    
+    return Stage(name, run, inputs=[catalogKey], outputs=[scampKey],
+        group_by=group_by)
+
+
+def swarp_stage(name, pathKey, mosaicKey, group_by, scampHeadKey=None,
+        weightKey=None, configs=None, defaultsPath=None, workDir="mosaic"):
+    """Make a :class:`moastro.pipeline.Stage` mosaicking each group of
+    images with Swarp. The mosaic is named after the group, and its path
+    is stored under `mosaicKey` for every image of the group.
+    """
+    inputs = [pathKey] + [k for k in (scampHeadKey, weightKey)
+        if k is not None]
+    
+    def run(imageLog, unitName, imageKeys, executor):
+        swarp = Swarp.from_db(imageLog, imageKeys, pathKey, str(unitName),
+            scampHeadPathKey=scampHeadKey, weightPathKey=weightKey,
+            defaultsPath=defaultsPath, configs=dict(configs or {}),
+            workDir=workDir)
+        result = swarp.run(executor=executor)
+        if not result.ok:
+            raise RuntimeError(result.log)
+        imageLog.set_images(dict((k, {mosaicKey: swarp.mosaicPath})
+            for k in imageKeys))
+    
+    return Stage(name, run, inputs=inputs, outputs=[mosaicKey],
+        group_by=group_by)
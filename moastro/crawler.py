@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Fast discovery of files in large directory trees.
+
+:func:`crawl` lists a directory tree with a pool of threads, so that the
+latency of listing directories on network filesystems overlaps. Paths are
+yielded as soon as their directory has been listed. Directory entries are
+read with ``scandir`` (from :mod:`os`, or the ``scandir`` package on older
+Pythons) where available, which avoids a ``stat`` call per file.
+
+:func:`read_manifest` reads paths from a precomputed file list instead.
+
+Functions
+---------
+
+- :func:`crawl`
+- :func:`read_manifest`
+- :func:`list_dir`
+"""
+
+import os
+import threading
+import logging
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def crawl(root, suffix=".fits", recursive=True, nthreads=8):
+    """Yield paths of files under ``root`` whose names end with ``suffix``.
+
+    Parameters
+    ----------
+
+    root : str
+        Directory to search.
+    suffix : str or tuple
+        File name suffix, or tuple of suffixes, to match.
+    recursive : bool
+        If ``True``, sub-directories are searched too.
+    nthreads : int
+        Number of threads listing directories concurrently.
+
+    Returns
+    -------
+
+    paths : generator
+        File paths. Paths within a directory are sorted, but directories
+        are yielded in the order their listings complete.
+    """
+    if not isinstance(suffix, tuple):
+        suffix = (suffix,)
+    if not recursive:
+        files, subdirs = list_dir(root, suffix)
+        return iter(files)
+    if nthreads <= 1:
+        return _crawl_serial(root, suffix)
+    return _crawl_threaded(root, suffix, nthreads)
+
+
+def read_manifest(path, suffix=None, root=None):
+    """Yield file paths listed in a manifest file.
+
+    The manifest lists one path per line. Blank lines and lines starting
+    with ``#`` are ignored.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to the manifest file.
+    suffix : str or tuple
+        (optional) Only paths ending with this suffix (or tuple of
+        suffixes) are yielded.
+    root : str
+        (optional) Directory that relative paths are relative to.
+    """
+    if suffix is not None and not isinstance(suffix, tuple):
+        suffix = (suffix,)
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            if suffix is not None and not line.endswith(suffix):
+                continue
+            if root is not None:
+                line = os.path.join(root, line)
+            yield line
+
+
+def list_dir(path, suffix):
+    """List a directory, returning sorted matching file paths and the paths
+    of sub-directories. Symbolic links to directories are not followed.
+
+    Parameters
+    ----------
+
+    path : str
+        Directory to list.
+    suffix : tuple
+        Tuple of file name suffixes to match.
+
+    Returns
+    -------
+
+    files : list
+        Paths of matching files.
+    subdirs : list
+        Paths of sub-directories.
+    """
+    files = []
+    subdirs = []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.name.endswith(suffix) and entry.is_file():
+                    files.append(entry.path)
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+        else:
+            for name in os.listdir(path):
+                p = os.path.join(path, name)
+                if name.endswith(suffix) and os.path.isfile(p):
+                    files.append(p)
+                elif os.path.isdir(p) and not os.path.islink(p):
+                    subdirs.append(p)
+    except OSError as e:
+        log = logging.getLogger('moastro')
+        log.warning("Could not list {path}: {e}".format(path=path, e=e))
+    files.sort()
+    subdirs.sort()
+    return files, subdirs
+
+
+def _crawl_serial(root, suffix):
+    """Depth-first crawl in the calling thread."""
+    stack = [root]
+    while len(stack) > 0:
+        files, subdirs = list_dir(stack.pop(), suffix)
+        for path in files:
+            yield path
+        stack.extend(reversed(subdirs))
+
+
+def _crawl_threaded(root, suffix, nthreads):
+    """Crawl with ``nthreads`` threads listing directories concurrently."""
+    dirs = queue.Queue()
+    results = queue.Queue()
+    state = {"pending": 1, "stop": False}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            path = dirs.get()
+            if path is None or state['stop']:
+                break
+            files, subdirs = list_dir(path, suffix)
+            with lock:
+                state['pending'] += len(subdirs)
+            for subdir in subdirs:
+                dirs.put(subdir)
+            results.put(files)
+            # Only count this directory as done once its results are queued
+            with lock:
+                state['pending'] -= 1
+                done = state['pending'] == 0
+            if done:
+                results.put(None)
+
+    threads = [threading.Thread(target=worker) for i in range(nthreads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    dirs.put(root)
+    try:
+        while True:
+            files = results.get()
+            if files is None:
+                break
+            for path in files:
+                yield path
+    finally:
+        state['stop'] = True
+        for t in threads:
+            dirs.put(None)
+        for t in threads:
+            t.join()
@@ -3,10 +3,20 @@
 """
 Utility classes/functions for using MongoDB
 """
+import os
+import threading
+
 from pymongo.son_manipulator import SONManipulator
 import pymongo
 
-from .settings import locate_server
+from .settings import locate_server, client_options
+
+
+# Registry of MongoClient instances for this process, keyed by
+# (server, url, port). The registry is discarded when a fork is detected.
+_clients = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
 
 
 def make_connection(server=None, url='localhost', port=27017):
@@ -14,6 +24,13 @@ def make_connection(server=None, url='localhost', port=27017):
 
     This function will attempt to connect to the named server, and fall back
     to the URL and port settings if a server is not named.
+
+    Clients are shared: repeated calls with the same arguments within a
+    process return the same client (and its connection pool). A child
+    process created with ``fork`` (e.g. by :mod:`multiprocessing`) gets new
+    clients rather than the ones inherited from its parent, which are not
+    fork-safe. Pool sizes and timeouts are read from the ``client`` options
+    in ``.moastro.json`` (see :func:`moastro.settings.client_options`).
     
     Parameters
     ----------
@@ -31,10 +48,103 @@ def make_connection(server=None, url='localhost', port=27017):
     connection : obj
         A PyMongo connection instance.
     """
-    if server:
-        return pymongo.MongoClient(*locate_server(server))
+    _check_fork()
+    key = (server, url, port)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if server:
+                url, port = locate_server(server)
+            client = pymongo.MongoClient(url, port,
+                    **client_options(server))
+            _clients[key] = client
+    return client
+
+
+def close_connections():
+    """Close all MongoDB clients opened by :func:`make_connection` in this
+    process.
+    """
+    _check_fork()
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def _check_fork():
+    """Reset the client registry if this process was forked since it was
+    populated. Inherited clients are dropped without being closed, since
+    their sockets are shared with the parent process.
+    """
+    global _clients_pid, _clients_lock
+    pid = os.getpid()
+    if pid != _clients_pid:
+        _clients_lock = threading.Lock()
+        _clients.clear()
+        _clients_pid = pid
+
+
+def bulk_update(collection, updates, upsert=False, ordered=False):
+    """Apply a sequence of updates to a collection as one bulk write.
+
+    Parameters
+    ----------
+
+    collection : obj
+        A PyMongo collection.
+    updates : iterable
+        Sequence of ``(selector, document)`` pairs. If ``document`` contains
+        update operators (e.g. ``$set``) the first matching document is
+        updated, otherwise it is replaced by ``document``.
+    upsert : bool
+        Insert documents that do not match ``selector``.
+    ordered : bool
+        If ``False`` (default) the server may apply the writes in any order,
+        and continues past individual failures.
+
+    Returns
+    -------
+
+    result : dict
+        The bulk write result, or ``None`` if ``updates`` was empty.
+    """
+    if ordered:
+        bulk = collection.initialize_ordered_bulk_op()
     else:
-        return pymongo.MongoClient(url, port)
+        bulk = collection.initialize_unordered_bulk_op()
+    n = 0
+    for selector, document in updates:
+        op = bulk.find(selector)
+        if upsert:
+            op = op.upsert()
+        if any(k.startswith('$') for k in document):
+            op.update_one(document)
+        else:
+            op.replace_one(document)
+        n += 1
+    if n == 0:
+        return None
+    return bulk.execute()
+
+
+# Cache of dotted keys split into tuples of path components
+_paths = {}
+
+
+def split_path(key):
+    """Split a dot-notation key into a tuple of its components.
+
+    Results are cached, so repeated lookups of the same key do no string
+    work.
+    """
+    try:
+        return _paths[key]
+    except KeyError:
+        path = tuple(key.split("."))
+        if len(_paths) < 10000:
+            _paths[key] = path
+        return path
 
 
 def reach(doc, key):
@@ -53,11 +163,9 @@ def reach(doc, key):
         to refer to values in embedded documents. Root level keys (without
         dots) are perfectly safe with this function.
     """
-    parts = key.split(".")
-    if len(parts) > 1:
-        return reach(doc[parts[0]], ".".join(parts[1:]))
-    else:
-        return doc[parts[0]]
+    for part in split_path(key):
+        doc = doc[part]
+    return doc
 
 
 class ReachableDoc(dict):
@@ -68,16 +176,17 @@ class ReachableDoc(dict):
     * https://jira.mongodb.org/browse/PYTHON-175
     * http://groups.google.com/group/mongodb-user/browse_thread/thread/e9f8c19a0d9e4a33
     """
-    def __init__(self, *args, **kwargs):
-        super(ReachableDoc, self).__init__(*args, **kwargs)
-    
     def __getitem__(self, key):
-        if "." in key:
-            parts = key.split(".")
-            return reach(super(ReachableDoc, self).__getitem__(parts[0]),
-                    ".".join(parts[1:]))
-        else:
-            return super(ReachableDoc, self).__getitem__(key)
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            if "." not in key:
+                raise
+        parts = split_path(key)
+        doc = dict.__getitem__(self, parts[0])
+        for part in parts[1:]:
+            doc = doc[part]
+        return doc
 
     def what_am_i(self):
         return "I'm an instance of MyDoc!"
@@ -88,11 +197,44 @@ class DotReachable(SONManipulator):
     documents can be addressed with dot notation directory.
     
     e.g., doc['firstkey.secondkey'] = value
+
+    .. note:: This copies every outgoing document. Use
+       :func:`reachable_collection` instead, which has BSON decoded directly
+       into :class:`ReachableDoc` where PyMongo supports it.
     """
     def transform_outgoing(self, son, collection):
         return ReachableDoc(son)
 
 
+def reachable_collection(db, cname):
+    """Get a collection whose documents support dot-notation lookups.
+
+    With PyMongo's codec options (PyMongo 3+), documents are decoded
+    directly into :class:`ReachableDoc`, with no per-document copy. Older
+    versions of PyMongo fall back to the :class:`DotReachable` manipulator.
+
+    Parameters
+    ----------
+
+    db : obj
+        A PyMongo database.
+    cname : str
+        Name of the collection.
+
+    Returns
+    -------
+
+    collection : obj
+        A PyMongo collection.
+    """
+    if hasattr(db, 'codec_options'):
+        options = db.codec_options._replace(document_class=ReachableDoc)
+        return db.get_collection(cname, codec_options=options)
+    if 'DotReachable' not in db.outgoing_manipulators:
+        db.add_son_manipulator(DotReachable())
+    return db[cname]
+
+
 def test_reachdoc():
     c = pymongo.Connection()
     db = c.foo
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Run external programs (such as the astromatic.net tools) under shared
+resource limits.
+
+A :class:`JobExecutor` runs :class:`Job` instances (an argument vector plus
+the CPU slots and memory the job needs) directly, without a shell, from a
+pool of threads. Jobs are started as soon as enough CPU slots and memory are
+free, so programs launched by different batch runners share one budget::
+
+    executor = JobExecutor(cpus=16, memory=64000)
+    result = executor.run(Job(["sex", "image.fits", "-c", "config.sex"]))
+    if not result.ok:
+        print(result.log)
+
+:func:`default_executor` returns the process-wide executor used by
+:class:`moastro.astromatic.Astromatic` runs when none is given.
+
+Classes
+-------
+
+- :class:`JobExecutor`
+- :class:`Job`
+- :class:`JobResult`
+- :class:`CostModel`
+
+Functions
+---------
+
+- :func:`default_executor`
+- :func:`set_default_executor`
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+class Job(object):
+    """An external program to run, with its resource requirements.
+
+    Parameters
+    ----------
+
+    argv : list
+        Program and arguments. No shell is involved.
+    cpus : int
+        Number of CPU slots the program needs (at least).
+    max_cpus : int
+        (optional) Maximum number of CPU slots the program can use, for
+        multi-threaded programs. When the job starts it is granted a share
+        of the free CPU slots between ``cpus`` and ``max_cpus``.
+    thread_arg : str
+        (optional) Command line option setting the program's number of
+        threads, e.g. ``"-NTHREADS"``. The granted number of CPU slots is
+        appended to ``argv`` with this option.
+    memory : float
+        Memory the program needs, in MB.
+    cwd : str
+        (optional) Working directory of the program.
+    env : dict
+        (optional) Environment of the program.
+    name : str
+        (optional) Name used in log messages.
+    log_path : str
+        (optional) Path of a file where the program's output is also
+        written.
+    """
+    def __init__(self, argv, cpus=1, memory=0., cwd=None, env=None,
+            name=None, log_path=None, max_cpus=None, thread_arg=None):
+        super(Job, self).__init__()
+        self.argv = list(argv)
+        self.cpus = cpus
+        self.max_cpus = max_cpus
+        self.thread_arg = thread_arg
+        self.memory = memory
+        self.cwd = cwd
+        self.env = env
+        self.name = name or os.path.basename(self.argv[0])
+        self.log_path = log_path
+
+
+class JobResult(object):
+    """Outcome of a :class:`Job`.
+
+    Attributes
+    ----------
+
+    job : :class:`Job`
+        The job that was run.
+    returncode : int
+        Exit status of the program, or ``None`` if it could not be started.
+    log : str
+        Combined standard output and standard error of the program (or the
+        error raised when starting it).
+    cpus : int
+        Number of CPU slots the job was granted.
+    start : float
+        Time the program was started, in seconds since the epoch.
+    wall_time : float
+        Seconds the program ran for.
+    queue_time : float
+        Seconds the job waited for resources.
+    skipped : bool
+        ``True`` if the program was not run because its outputs were
+        already up to date.
+    """
+    def __init__(self, job, returncode, log, cpus, start, wall_time,
+            queue_time, skipped=False):
+        super(JobResult, self).__init__()
+        self.job = job
+        self.returncode = returncode
+        self.log = log
+        self.cpus = cpus
+        self.start = start
+        self.wall_time = wall_time
+        self.queue_time = queue_time
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        """``True`` if the program exited with status 0."""
+        return self.returncode == 0
+
+    def __repr__(self):
+        return "<JobResult %s returncode=%s wall_time=%.1fs>" % (
+            self.job.name, self.returncode, self.wall_time)
+
+
+class JobExecutor(object):
+    """Run jobs concurrently within limits on CPU slots and memory.
+
+    Jobs wait until both enough CPU slots and enough memory are free. A job
+    that asks for more than the whole budget runs once nothing else is
+    running.
+
+    Multi-threaded jobs (with ``max_cpus``) are granted, when they start, an
+    equal share of the CPU slots not used by running jobs among themselves
+    and the jobs still waiting. Jobs count as waiting from the moment they
+    are submitted (or :meth:`run` is called), so a job starting first does
+    not take the CPUs of jobs submitted with it. A large run submitted alone
+    gets the whole machine, while concurrent jobs of a batch split it.
+
+    Parameters
+    ----------
+
+    cpus : int
+        Number of CPU slots shared by all jobs. Defaults to the number of
+        CPUs of the machine.
+    memory : float
+        Memory budget shared by all jobs, in MB. ``None`` means unlimited.
+    max_jobs : int
+        Maximum number of jobs running at once. Defaults to ``cpus``.
+    """
+    def __init__(self, cpus=None, memory=None, max_jobs=None):
+        super(JobExecutor, self).__init__()
+        if cpus is None:
+            cpus = multiprocessing.cpu_count()
+        self.cpus = cpus
+        self.memory = memory
+        self.max_jobs = max_jobs or cpus
+        self.log = logging.getLogger('moastro')
+        self._cond = threading.Condition()
+        self._cpus_used = 0
+        self._memory_used = 0.
+        self._running = 0
+        self._waiting = 0  # jobs submitted or in run() that have not started
+        self._pool = None
+
+    @property
+    def cpus_free(self):
+        """Number of CPU slots not claimed by running jobs."""
+        with self._cond:
+            return max(self.cpus - self._cpus_used, 0)
+
+    @property
+    def running(self):
+        """Number of jobs currently running."""
+        with self._cond:
+            return self._running
+
+    def submit(self, job, callback=None):
+        """Queue a job, returning immediately.
+
+        Parameters
+        ----------
+
+        job : :class:`Job`
+            Job to run.
+        callback : callable
+            (optional) Called with the :class:`JobResult` when the job ends.
+
+        Returns
+        -------
+
+        result : :class:`multiprocessing.pool.AsyncResult`
+            Call ``result.get()`` to wait for the :class:`JobResult`.
+        """
+        with self._cond:
+            if self._pool is None:
+                self._pool = ThreadPool(processes=self.max_jobs)
+            pool = self._pool
+            self._waiting += 1
+        return pool.apply_async(self._run, (job,), callback=callback)
+
+    def map(self, jobs):
+        """Run jobs, yielding their :class:`JobResult` as they finish."""
+        jobs = list(jobs)
+        with self._cond:
+            if self._pool is None:
+                self._pool = ThreadPool(processes=self.max_jobs)
+            pool = self._pool
+            self._waiting += len(jobs)
+        return pool.imap_unordered(self._run, jobs)
+
+    def run(self, job):
+        """Run a job in the calling thread once its resources are free.
+
+        Returns
+        -------
+
+        result : :class:`JobResult`
+        """
+        with self._cond:
+            self._waiting += 1
+        return self._run(job)
+
+    def _run(self, job):
+        """Run a job already counted as waiting."""
+        queued = time.time()
+        cpus, memory = self._acquire(job)
+        argv = list(job.argv)
+        if job.thread_arg is not None:
+            argv.extend([job.thread_arg, str(cpus)])
+        start = time.time()
+        try:
+            returncode, log = self._execute(job, argv)
+        finally:
+            self._release(cpus, memory)
+        end = time.time()
+        if returncode != 0:
+            self.log.warning("%s exited with status %s" % (job.name,
+                returncode))
+        return JobResult(job, returncode, log, cpus, start, end - start,
+                start - queued)
+
+    def shutdown(self):
+        """Wait for queued jobs and stop the executor's threads."""
+        with self._cond:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _fits(self, cpus, memory):
+        """``True`` if a job with these requirements can start now."""
+        if self._running == 0:
+            return True
+        if self._running >= self.max_jobs:
+            return False
+        if self._cpus_used + cpus > self.cpus:
+            return False
+        if self.memory is not None \
+                and self._memory_used + memory > self.memory:
+            return False
+        return True
+
+    def _acquire(self, job):
+        """Block until the job's resources are free, and claim them. The job
+        is counted in ``_waiting`` until it starts.
+        """
+        cpus = min(max(job.cpus, 1), self.cpus)
+        memory = job.memory or 0.
+        with self._cond:
+            while not self._fits(cpus, memory):
+                self._cond.wait()
+            self._waiting -= 1
+            if job.max_cpus is not None and job.max_cpus > cpus:
+                free = self.cpus - self._cpus_used
+                share = free // (self._waiting + 1)
+                cpus = min(max(share, cpus), job.max_cpus, self.cpus)
+            self._cpus_used += cpus
+            self._memory_used += memory
+            self._running += 1
+        return cpus, memory
+
+    def _release(self, cpus, memory):
+        with self._cond:
+            self._cpus_used -= cpus
+            self._memory_used -= memory
+            self._running -= 1
+            self._cond.notify_all()
+
+    def _execute(self, job, argv):
+        """Run the program, returning its exit status and output."""
+        self.log.info(" ".join(argv))
+        try:
+            p = subprocess.Popen(argv, cwd=job.cwd, env=job.env,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            return None, str(e)
+        output = p.communicate()[0]
+        if not isinstance(output, str):
+            output = output.decode('utf-8', 'replace')
+        if job.log_path is not None:
+            with open(job.log_path, 'w') as f:
+                f.write(output)
+        return p.returncode, output
+
+
+class CostModel(object):
+    """Runtime estimates used to schedule batches longest-first.
+
+    A job's cost is its ``size`` (e.g. the number of pixels of an image or
+    the bytes of its input catalogs) times a rate in seconds per unit of
+    size, kept for each ``kind`` of job. Rates are updated from measured
+    runtimes as exponential moving averages, and can be saved to a JSON
+    file to improve later estimates.
+
+    Parameters
+    ----------
+
+    path : str
+        (optional) JSON file the rates are loaded from, and saved to by
+        :meth:`save`.
+    alpha : float
+        Weight of a new measurement in the moving average.
+    default_rate : float
+        Rate assumed for kinds of jobs that were never measured.
+    """
+    def __init__(self, path=None, alpha=0.3, default_rate=1e-6):
+        super(CostModel, self).__init__()
+        self.path = path
+        self.alpha = alpha
+        self.default_rate = default_rate
+        self.rates = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.rates = json.load(f)
+            except ValueError:
+                self.rates = {}
+
+    def estimate(self, kind, size):
+        """Estimated runtime, in seconds, of a job."""
+        with self._lock:
+            return self.rates.get(kind, self.default_rate) * size
+
+    def record(self, kind, size, seconds):
+        """Update the rate of ``kind`` with a measured runtime."""
+        if size <= 0:
+            return
+        rate = float(seconds) / size
+        with self._lock:
+            if kind in self.rates:
+                rate = (1. - self.alpha) * self.rates[kind] + self.alpha * rate
+            self.rates[kind] = rate
+
+    def longest_first(self, jobs):
+        """Sort ``(kind, size, job)`` tuples by decreasing estimated runtime,
+        returning the jobs.
+        """
+        ordered = sorted(jobs, key=lambda j: self.estimate(j[0], j[1]),
+                reverse=True)
+        return [j[2] for j in ordered]
+
+    def save(self):
+        """Write the rates to ``path``, replacing the file atomically."""
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock:
+            rates = dict(self.rates)
+        fd, tmpPath = tempfile.mkstemp(dir=directory, prefix=".costmodel")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(rates, f)
+        os.rename(tmpPath, self.path)
+
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+
+def default_executor():
+    """The process-wide :class:`JobExecutor`, created on first use with one
+    CPU slot per CPU and no memory limit.
+    """
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = JobExecutor()
+        return _default_executor
+
+
+def set_default_executor(executor):
+    """Replace the process-wide executor returned by
+    :func:`default_executor`, e.g. to set a memory budget.
+    """
+    global _default_executor
+    with _default_lock:
+        _default_executor = executor
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Filesystem helpers for the files referenced by an image log.
+
+Moving files within one filesystem is done with :func:`os.rename`, which
+costs a single metadata operation. Copies, and moves between filesystems,
+try a copy-on-write reflink first, then the kernel's ``copy_file_range``,
+and finally fall back to :func:`shutil.copyfile`. Copies are always
+independent of their source; they are never hardlinks.
+
+Functions
+---------
+
+- :func:`same_filesystem`
+- :func:`relocate_file`
+- :func:`copy_file`
+- :func:`file_size`
+- :func:`file_stat`
+- :func:`file_checksum`
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number for FICLONE (reflink) on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+
+def same_filesystem(path, directory):
+    """``True`` if ``path`` and ``directory`` reside on the same device.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to an existing file.
+    directory : str
+        Path to an existing directory.
+    """
+    try:
+        return os.stat(path).st_dev == os.stat(directory).st_dev
+    except OSError:
+        return False
+
+
+def file_size(path):
+    """Size of the file at ``path`` in bytes, or 0 if it does not exist."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def file_stat(path, checksum=False):
+    """Identity of a file, used to detect changes between ingests.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to an existing file.
+    checksum : bool
+        If ``True``, the SHA-1 hash of the file contents is included.
+
+    Returns
+    -------
+
+    stat : dict
+        Dictionary with the absolute ``path``, ``size`` (bytes), ``mtime``
+        (seconds since the epoch) and ``inode`` of the file, plus ``sha1``
+        if `checksum` is ``True``.
+    """
+    st = os.stat(path)
+    stat = {"path": os.path.abspath(path), "size": st.st_size,
+            "mtime": st.st_mtime, "inode": st.st_ino}
+    if checksum:
+        stat['sha1'] = file_checksum(path)
+    return stat
+
+
+def file_checksum(path):
+    """SHA-1 hex digest of the contents of the file at ``path``."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(4 * 1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def relocate_file(src, dst, copy=False, same_fs=None):
+    """Move or copy ``src`` to ``dst``, using the cheapest available method.
+
+    Parameters
+    ----------
+
+    src : str
+        Path of the existing file.
+    dst : str
+        Destination path. An existing file at ``dst`` is overwritten.
+    copy : bool
+        If ``True``, ``src`` is left in place and ``dst`` is an independent
+        copy of it.
+    same_fs : bool
+        Whether ``src`` and ``dst`` share a filesystem. Computed if ``None``.
+
+    Returns
+    -------
+
+    method : str
+        Name of the method used: ``'rename'``, ``'reflink'``,
+        ``'copy_file_range'`` or ``'copy'``.
+    """
+    if same_fs is None:
+        same_fs = same_filesystem(src, os.path.dirname(os.path.abspath(dst)))
+    if same_fs and not copy:
+        os.rename(src, dst)
+        return 'rename'
+    method = copy_file(src, dst)
+    if not copy:
+        os.remove(src)
+    return method
+
+
+def copy_file(src, dst):
+    """Copy file contents and permission bits from ``src`` to ``dst``.
+
+    Returns the name of the copy method that succeeded.
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if _reflink(fsrc, fdst):
+                method = 'reflink'
+            elif _copy_file_range(fsrc, fdst):
+                method = 'copy_file_range'
+            else:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, 16 * 1024 * 1024)
+                method = 'copy'
+    shutil.copymode(src, dst)
+    return method
+
+
+def _reflink(fsrc, fdst):
+    """Clone ``fsrc`` into ``fdst`` with the FICLONE ioctl (btrfs, XFS)."""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _copy_file_range(fsrc, fdst):
+    """Copy using ``os.copy_file_range``, where the platform provides it."""
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is None:
+        return False
+    remaining = os.fstat(fsrc.fileno()).st_size
+    try:
+        while remaining > 0:
+            n = copy_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if n == 0:
+                break
+            remaining -= n
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                errno.EOPNOTSUPP):
+            return False
+        raise
+    return remaining == 0
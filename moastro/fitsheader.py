@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Fast, header-only reading of FITS files.
+
+:func:`scan_headers` reads only the 2880-byte header blocks of each HDU in a
+FITS file, seeking over the data sections, and parses keyword values
+directly from the 80-character cards. No pixel data is read or decompressed.
+Headers of tile-compressed images (e.g. ``.fits.fz`` files written by
+``fpack``) are translated to describe the uncompressed image, so that
+``NAXIS1`` etc. refer to the image rather than the binary table holding it.
+
+Functions
+---------
+
+- :func:`scan_headers`
+- :func:`parse_header`
+
+Classes
+-------
+
+- :class:`ScannedHeader`
+"""
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Commentary keywords, whose cards carry no value
+COMMENTARY_KEYS = ('COMMENT', 'HISTORY', '')
+
+# Binary table keywords that do not apply to a decompressed image
+TABLE_KEYS = ('TFIELDS', 'THEAP')
+TABLE_KEY_PREFIXES = ('TTYPE', 'TFORM', 'TUNIT', 'TDIM', 'TNULL', 'TSCAL',
+        'TZERO', 'TDISP')
+
+
+class ScannedHeader(dict):
+    """Keyword values of one HDU header, as read by :func:`scan_headers`.
+
+    As a ``dict`` of keyword: value it supports the read-only uses of
+    :class:`astropy.io.fits.Header` common in image log hooks (``h[key]``,
+    ``h.get(key)``, ``key in h``). For commentary cards and comments, use
+    :meth:`to_header`. Duplicated keywords keep their first value.
+
+    Attributes
+    ----------
+
+    text : str
+        The header's cards, up to and including ``END``.
+    header_offset : int
+        Byte offset of the header in the file.
+    data_offset : int
+        Byte offset of the HDU's data section in the file.
+    data_size : int
+        Size of the data section in bytes, excluding padding.
+    compressed : bool
+        ``True`` if this HDU is a tile-compressed image. The keyword values
+        describe the uncompressed image, while ``text`` is unmodified.
+    """
+    text = ""
+    header_offset = 0
+    data_offset = 0
+    data_size = 0
+    compressed = False
+
+    def to_header(self):
+        """Build the :class:`astropy.io.fits.Header` for this HDU.
+
+        For compressed images the image (``Z``-prefixed) keywords are
+        translated, as done by :class:`astropy.io.fits.CompImageHDU`.
+        """
+        import astropy.io.fits
+        header = astropy.io.fits.Header.fromstring(self.text)
+        if self.compressed:
+            _translate_compressed(header)
+        return header
+
+
+def scan_headers(path, exts=None):
+    """Read the headers of the HDUs in a FITS file without reading data.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to the FITS file.
+    exts : sequence
+        (optional) HDU indices that are needed. The file is only scanned up
+        to the last of these. By default all HDUs are read.
+
+    Returns
+    -------
+
+    headers : list
+        :class:`ScannedHeader` instances for each HDU, indexed by HDU
+        number (the primary HDU being 0).
+    """
+    if exts is not None and len(exts) > 0:
+        last = max(int(ext) for ext in exts)
+    else:
+        last = None
+    headers = []
+    with open(path, 'rb') as f:
+        while last is None or len(headers) <= last:
+            offset = f.tell()
+            text = _read_header_text(f)
+            if text is None:
+                break
+            header = parse_header(text)
+            header.header_offset = offset
+            header.data_offset = f.tell()
+            header.data_size = _data_size(header)
+            if header.get('ZIMAGE') is True:
+                header.compressed = True
+                _translate_compressed(header)
+            headers.append(header)
+            padded = -(-header.data_size // BLOCK_SIZE) * BLOCK_SIZE
+            f.seek(header.data_offset + padded)
+    if len(headers) == 0:
+        raise IOError("No FITS header found in %s" % path)
+    return headers
+
+
+def parse_header(text):
+    """Parse header card text into a :class:`ScannedHeader`.
+
+    Parameters
+    ----------
+
+    text : str
+        Concatenated 80-character header cards.
+    """
+    header = ScannedHeader()
+    header.text = text
+    ncards = len(text) // CARD_SIZE
+    i = 0
+    while i < ncards:
+        card = text[i * CARD_SIZE:(i + 1) * CARD_SIZE]
+        i += 1
+        key = card[:8].rstrip()
+        if key == 'END':
+            break
+        if key == 'HIERARCH':
+            key, sep, field = card[9:].partition('=')
+            if not sep:
+                continue
+            key = key.strip()
+        elif key in COMMENTARY_KEYS or card[8:10] != '= ':
+            continue
+        else:
+            field = card[10:]
+        value = _parse_value(field)
+        # Long strings continued with CONTINUE cards
+        while isinstance(value, _LongString) and i < ncards \
+                and text[i * CARD_SIZE:i * CARD_SIZE + 8] == 'CONTINUE':
+            card = text[i * CARD_SIZE:(i + 1) * CARD_SIZE]
+            i += 1
+            more = _parse_value(card[8:])
+            value = _join_string(value, more)
+        if isinstance(value, _LongString):
+            value = value.rstrip('&')
+        if key not in header:
+            header[key] = value
+    return header
+
+
+class _LongString(str):
+    """A string value ending with ``&``, to be continued."""
+
+
+def _join_string(value, more):
+    """Join a continued long string value with its continuation."""
+    joined = value[:-1] + (more or "")
+    if isinstance(more, _LongString):
+        return _LongString(joined)
+    return str(joined)
+
+
+def _parse_value(field):
+    """Parse the value of a card from the text following ``= ``."""
+    field = field.lstrip()
+    if field.startswith("'"):
+        chars = []
+        j = 1
+        while j < len(field):
+            c = field[j]
+            if c == "'":
+                if field[j + 1:j + 2] == "'":
+                    chars.append("'")
+                    j += 2
+                    continue
+                break
+            chars.append(c)
+            j += 1
+        value = "".join(chars).rstrip()
+        if value.endswith('&'):
+            return _LongString(value)
+        return str(value)
+    token = field.split('/', 1)[0].strip()
+    if token == 'T':
+        return True
+    elif token == 'F':
+        return False
+    elif token == '':
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token.replace('D', 'E').replace('d', 'e'))
+    except ValueError:
+        return token
+
+
+def _read_header_text(f):
+    """Read header blocks up to the ``END`` card from the file position.
+
+    Returns ``None`` at the end of the file.
+    """
+    blocks = []
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            if len(blocks) == 0 or len(block) == 0:
+                return None
+            raise IOError("Truncated FITS header")
+        block = block.decode('ascii')
+        blocks.append(block)
+        for j in range(0, BLOCK_SIZE, CARD_SIZE):
+            if block[j:j + 8] == 'END     ':
+                text = "".join(blocks)
+                return text[:(len(blocks) - 1) * BLOCK_SIZE + j + CARD_SIZE]
+
+
+def _data_size(header):
+    """Size in bytes of the data section described by a header."""
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    start = 1
+    if header.get('GROUPS') is True and header.get('NAXIS1') == 0:
+        start = 2  # random groups
+    npix = 1
+    for i in range(start, naxis + 1):
+        npix *= header.get('NAXIS%i' % i, 0)
+    bits = abs(header.get('BITPIX', 8)) * header.get('GCOUNT', 1) \
+        * (header.get('PCOUNT', 0) + npix)
+    return bits // 8
+
+
+def _translate_compressed(header):
+    """Replace binary table keywords of a compressed image HDU with those
+    of the uncompressed image. Works on any mutable mapping of keywords.
+    """
+    keys = list(header.keys())
+    for key in keys:
+        if key in TABLE_KEYS or key.startswith(TABLE_KEY_PREFIXES):
+            del header[key]
+    for i in range(1, header.get('NAXIS', 0) + 1):
+        if 'NAXIS%i' % i in header:
+            del header['NAXIS%i' % i]
+    header['XTENSION'] = header.get('ZTENSION', 'IMAGE')
+    header['BITPIX'] = header.get('ZBITPIX')
+    header['NAXIS'] = header.get('ZNAXIS', 0)
+    for i in range(1, header['NAXIS'] + 1):
+        header['NAXIS%i' % i] = header.get('ZNAXIS%i' % i)
+    header['PCOUNT'] = header.get('ZPCOUNT', 0)
+    header['GCOUNT'] = header.get('ZGCOUNT', 1)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tools for working with image footprints on the sky.
+
+Footprints are stored in image log documents under the ``footprint`` key as
+lists of ``[RA, Dec]`` vertices, in degrees. For spatial queries they are
+also stored as GeoJSON geometries under ``footprint_geo``, which MongoDB
+can index with a ``2dsphere`` index.
+
+Functions
+---------
+
+- :func:`polygon_to_geojson`
+- :func:`point_to_geojson`
+- :func:`spherical_hull`
+- :func:`linear_footprints`
+"""
+
+import numpy as np
+
+
+def _lon(ra):
+    """Convert RA in [0, 360) to a GeoJSON longitude in [-180, 180]."""
+    ra = float(ra) % 360.
+    if ra > 180.:
+        ra -= 360.
+    return ra
+
+
+def polygon_to_geojson(polygon):
+    """Convert a footprint polygon into a GeoJSON ``Polygon``.
+
+    Parameters
+    ----------
+
+    polygon : list
+        Sequence of ``(RA, Dec)`` vertices in degrees.
+
+    Returns
+    -------
+
+    geometry : dict
+        GeoJSON ``Polygon`` with a single closed ring. Edges of the polygon
+        are interpreted by MongoDB as great circle arcs.
+    """
+    ring = []
+    for ra, dec in polygon:
+        vertex = [_lon(ra), float(dec)]
+        if len(ring) > 0 and vertex == ring[-1]:
+            continue  # MongoDB rejects repeated vertices
+        ring.append(vertex)
+    if ring[0] != ring[-1]:
+        ring.append(list(ring[0]))
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def point_to_geojson(ra, dec):
+    """Convert an RA, Dec position (degrees) into a GeoJSON ``Point``."""
+    return {"type": "Point", "coordinates": [_lon(ra), float(dec)]}
+
+
+def spherical_hull(points):
+    """Spherical convex hull of a set of sky positions.
+
+    The points are projected gnomonically about their mean direction. The
+    gnomonic projection maps great circles to straight lines, so the planar
+    convex hull of the projected points is the spherical convex hull. This is
+    correct across RA = 0/360 and at the celestial poles, as long as all the
+    points lie within a hemisphere.
+
+    Parameters
+    ----------
+
+    points : array_like
+        ``(N, 2)`` sequence of ``(RA, Dec)`` positions in degrees, e.g. the
+        corners of all chip footprints of a mosaic camera.
+
+    Returns
+    -------
+
+    polygon : list
+        Hull vertices as ``[RA, Dec]`` lists, in degrees, counter-clockwise
+        about the outward normal of the celestial sphere.
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    ra = np.radians(points[:, 0])
+    dec = np.radians(points[:, 1])
+    xyz = np.column_stack((np.cos(dec) * np.cos(ra),
+                           np.cos(dec) * np.sin(ra),
+                           np.sin(dec)))
+    center = xyz.sum(axis=0)
+    norm = np.sqrt(np.dot(center, center))
+    if norm < 1e-10:
+        raise ValueError("Points do not lie within a hemisphere")
+    center /= norm
+    # Tangent plane basis at the center; east is undefined at the poles
+    east = np.cross([0., 0., 1.], center)
+    if np.dot(east, east) < 1e-20:
+        east = np.array([0., 1., 0.])
+    east /= np.sqrt(np.dot(east, east))
+    north = np.cross(center, east)
+
+    cosc = np.dot(xyz, center)
+    if np.any(cosc <= 0.):
+        raise ValueError("Points do not lie within a hemisphere")
+    x = np.dot(xyz, east) / cosc
+    y = np.dot(xyz, north) / cosc
+    hull = _planar_hull(x, y)
+
+    v = center[np.newaxis, :] + x[hull, np.newaxis] * east \
+        + y[hull, np.newaxis] * north
+    v /= np.sqrt((v ** 2).sum(axis=1))[:, np.newaxis]
+    hull_ra = np.degrees(np.arctan2(v[:, 1], v[:, 0])) % 360.
+    hull_dec = np.degrees(np.arcsin(np.clip(v[:, 2], -1., 1.)))
+    return np.column_stack((hull_ra, hull_dec)).tolist()
+
+
+def _planar_hull(x, y):
+    """Indices of the convex hull vertices of planar points, in
+    counter-clockwise order (Andrew's monotone chain).
+    """
+    order = np.lexsort((y, x))
+    if len(order) < 3:
+        return order
+
+    def cross(o, a, b):
+        return (x[a] - x[o]) * (y[b] - y[o]) - (y[a] - y[o]) * (x[b] - x[o])
+
+    lower = []
+    for i in order:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], i) <= 0.:
+            lower.pop()
+        lower.append(i)
+    upper = []
+    for i in order[::-1]:
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], i) <= 0.:
+            upper.pop()
+        upper.append(i)
+    return np.array(lower[:-1] + upper[:-1], dtype=int)
+
+
+# Keywords whose presence means a header has distortions, or a celestial
+# system, that :func:`linear_footprints` does not model.
+_DISTORTION_KEYS = ('A_ORDER', 'B_ORDER', 'CPDIS1', 'CPDIS2', 'D2IMDIS1',
+        'D2IMDIS2', 'CROTA2', 'CROTA1')
+
+
+def linear_footprints(headers):
+    """Compute the sky footprints of several image headers at once.
+
+    The four corner pixels of every image are projected together with
+    NumPy, for the common case of a linear (``CD`` or ``PC``/``CDELT``)
+    transformation to a gnomonic (``TAN``, or ``TPV`` without distortion
+    terms) projection in equatorial coordinates. The corners and vertex
+    order match :meth:`astropy.wcs.WCS.calc_footprint`.
+
+    Parameters
+    ----------
+
+    headers : sequence
+        FITS headers (:class:`astropy.io.fits.Header`, or any mapping of
+        keyword values).
+
+    Returns
+    -------
+
+    footprints : list
+        For each header, the footprint as a length-4 list of ``[RA, Dec]``
+        vertices in degrees, or ``None`` if the header's WCS is not
+        supported and needs to be evaluated with :mod:`astropy.wcs`.
+    """
+    footprints = [None] * len(headers)
+    idx = [i for i, h in enumerate(headers) if _is_linear_tan(h)]
+    if len(idx) == 0:
+        return footprints
+    n = len(idx)
+    crpix = np.empty((n, 2))
+    crval = np.empty((n, 2))
+    naxis = np.empty((n, 2))
+    cd = np.empty((n, 2, 2))
+    lonpole = np.empty(n)
+    for k, i in enumerate(idx):
+        h = headers[i]
+        crpix[k] = h['CRPIX1'], h['CRPIX2']
+        crval[k] = h['CRVAL1'], h['CRVAL2']
+        naxis[k] = h['NAXIS1'], h['NAXIS2']
+        cd[k] = _cd_matrix(h)
+        lonpole[k] = h.get('LONPOLE', 180. if crval[k, 1] < 90. else 0.)
+
+    # Corner pixels (1-based), as in astropy's calc_footprint
+    corners = np.ones((n, 4, 2))
+    corners[:, 1, 1] = naxis[:, 1]
+    corners[:, 2, :] = naxis
+    corners[:, 3, 0] = naxis[:, 0]
+    # Intermediate world coordinates, in degrees
+    xy = np.einsum('nij,nkj->nki', cd, corners - crpix[:, np.newaxis, :])
+    x = xy[:, :, 0]
+    y = xy[:, :, 1]
+    # Gnomonic deprojection to native spherical coordinates
+    phi = np.arctan2(x, -y)
+    theta = np.arctan2(180. / np.pi, np.hypot(x, y))
+    # Native to celestial rotation (Calabretta & Greisen 2002, eq. 2)
+    ra0 = np.radians(crval[:, 0])[:, np.newaxis]
+    dec0 = np.radians(crval[:, 1])[:, np.newaxis]
+    dphi = phi - np.radians(lonpole)[:, np.newaxis]
+    sin_t = np.sin(theta)
+    cos_t = np.cos(theta)
+    ra = ra0 + np.arctan2(-cos_t * np.sin(dphi),
+            sin_t * np.cos(dec0) - cos_t * np.sin(dec0) * np.cos(dphi))
+    dec = np.arcsin(np.clip(sin_t * np.sin(dec0)
+            + cos_t * np.cos(dec0) * np.cos(dphi), -1., 1.))
+    radec = np.dstack((np.degrees(ra) % 360., np.degrees(dec)))
+    for k, i in enumerate(idx):
+        footprints[i] = radec[k].tolist()
+    return footprints
+
+
+def _is_linear_tan(header):
+    """``True`` if :func:`linear_footprints` can evaluate this header."""
+    ctype1 = str(header.get('CTYPE1', ''))
+    ctype2 = str(header.get('CTYPE2', ''))
+    if not (ctype1.startswith('RA--') and ctype2.startswith('DEC-')):
+        return False
+    proj = ctype1[4:].strip('-')
+    if proj not in ('TAN', 'TPV') or ctype2[4:].strip('-') != proj:
+        return False
+    if header.get('NAXIS', 0) < 2 or header.get('WCSAXES', 2) != 2:
+        return False
+    for key in ('CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2', 'NAXIS1', 'NAXIS2'):
+        if key not in header:
+            return False
+    for key in _DISTORTION_KEYS:
+        if key in header:
+            return False
+    for unit in ('CUNIT1', 'CUNIT2'):
+        if str(header.get(unit, 'deg')).strip() not in ('deg', ''):
+            return False
+    # TPV is linear only if its polynomial is the identity
+    for key in header.keys():
+        if key.startswith('PV') and '_' in key:
+            value = header[key]
+            if key in ('PV1_1', 'PV2_1'):
+                if value != 1.:
+                    return False
+            elif value != 0.:
+                return False
+    return True
+
+
+def _cd_matrix(header):
+    """The linear transformation matrix, in degrees per pixel."""
+    if 'CD1_1' in header or 'CD1_2' in header or 'CD2_1' in header \
+            or 'CD2_2' in header:
+        return np.array([[header.get('CD1_1', 0.), header.get('CD1_2', 0.)],
+                         [header.get('CD2_1', 0.), header.get('CD2_2', 0.)]])
+    pc = np.array([[header.get('PC1_1', 1.), header.get('PC1_2', 0.)],
+                   [header.get('PC2_1', 0.), header.get('PC2_2', 1.)]])
+    cdelt = np.array([header.get('CDELT1', 1.), header.get('CDELT2', 1.)])
+    return cdelt[:, np.newaxis] * pc
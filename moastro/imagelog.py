@@ -1,14 +1,37 @@
 import os
-import shutil
+import re
 import subprocess
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import itertools
 import warnings
 import fnmatch
+import traceback
+import zlib
+import collections
 
+import pymongo
+from bson.binary import Binary
+from bson.son import SON
 import astropy.io.fits
+import astropy.table
 import astropy.wcs
 
-from .dbtools import DotReachable, make_connection
+from .dbtools import make_connection, reachable_collection, bulk_update
+from . import fileops
+from .footprint import polygon_to_geojson, point_to_geojson, \
+    spherical_hull, linear_footprints
+from .fitsheader import scan_headers, ScannedHeader
+from .crawler import crawl, read_manifest
+from .imagestats import sample_pixels
+
+
+# Base image fields copied onto chip documents by default
+CHIP_BASE_KEYS = ['OBJECT', 'FILTER', 'INSTRUME', 'EXPTIME', 'MJDATE']
+
+# Key carrying packed headers from MEFImporter._build_document to
+# MEFImporter.write_documents; never written to the image log itself.
+HEADER_STORE_KEY = '_headers'
 
 
 class ImageLog(object):
@@ -38,19 +61,45 @@ class ImageLog(object):
         URL of MongoDB server.
     port : int
         Port of MongoDB server.
+    chip_cname : str
+        (optional) Name of a MongoDB collection holding a normalized view of
+        the image log with one document per chip (image extension). Chip
+        documents carry the extension's fields, the base fields listed in
+        ``chipBaseKeys`` and the ``queryMask`` fields, plus ``image`` and
+        ``ext`` fields referring back to the image document. This allows
+        chip-level queries (:meth:`find_chips`) to use a single index.
+    header_cname : str
+        (optional) Name of the MongoDB collection where :class:`MEFImporter`
+        stored the full, compressed FITS headers of each image (see
+        :meth:`header`).
+    header_cache_size : int
+        Number of headers kept in memory by :meth:`header`.
     """
-    def __init__(self, dbname, cname, server=None, url="localhost", port=27017):
+    def __init__(self, dbname, cname, server=None, url="localhost", port=27017,
+            chip_cname=None, header_cname=None, header_cache_size=128):
         super(ImageLog, self).__init__()
         connection = make_connection(server=server, url=url, port=port)
         self.db = connection[dbname]
-        self.db.add_son_manipulator(DotReachable())
-        self.c = self.db[cname]
+        self.c = reachable_collection(self.db, cname)
         self.dbname = dbname
         self.cname = cname
         self.url = connection.host
         self.port = connection.port
         self.queryMask = {}
         self.exts = ["0"]
+        if chip_cname is not None:
+            self.chips = reachable_collection(self.db, chip_cname)
+        else:
+            self.chips = None
+        self.chip_cname = chip_cname
+        self.chipBaseKeys = list(CHIP_BASE_KEYS)
+        if header_cname is not None:
+            self.headers = self.db[header_cname]
+        else:
+            self.headers = None
+        self.header_cname = header_cname
+        self.header_cache_size = header_cache_size
+        self._header_cache = collections.OrderedDict()
     
     def __getitem__(self, key):
         """:return: a document (`dict` type) for the image named `key`"""
@@ -70,23 +119,192 @@ class ImageLog(object):
     
     def set(self, imageKey, key, value, ext=None):
         """Updates an image record by setting the `key` field to the given
-        `value`.
+        `value`. The chip collection, if used, is kept in sync.
         """
         if ext == None:
             self.c.update({"_id": imageKey}, {"$set": {key: value}})
+            if self.chips is not None and key in self._chip_base_keys():
+                self.chips.update({"image": imageKey}, {"$set": {key: value}},
+                        multi=True)
         else:
             self.c.update({"_id": imageKey},
                     {"$set": {".".join((str(ext), key)): value}})
+            if self.chips is not None:
+                self.chips.update({"_id": chip_id(imageKey, ext)},
+                        {"$set": {key: value}})
     
     def set_frames(self, key, data):
         """Does an update of data into the `key` field for data of an arbitrary
-        collection of detectors.
+        collection of detectors. Updates are sent as bulk writes to both the
+        image log and the chip collection, if used.
         
         :param data: a dictionary of `frame: datum`, where `frame` is a tuple
-            of (imageKey, ext)
+            of (imageKey, ext). A sequence of `(frame, datum)` pairs is also
+            accepted.
         """
+        if isinstance(data, dict):
+            data = data.items()
+        imageUpdates = []
+        chipUpdates = []
         for (imageKey, ext), datum in data:
-            self.set(imageKey, key, datum, ext=ext)
+            imageUpdates.append(({"_id": imageKey},
+                {"$set": {".".join((str(ext), key)): datum}}))
+            chipUpdates.append(({"_id": chip_id(imageKey, ext)},
+                {"$set": {key: datum}}))
+        bulk_update(self.c, imageUpdates)
+        if self.chips is not None:
+            bulk_update(self.chips, chipUpdates)
+
+    def set_images(self, data):
+        """Sets fields of several image records with a single bulk write.
+        Chip documents, if used, are updated for base keys.
+        
+        :param data: a dictionary of `imageKey: fields`, where `fields` is a
+            dictionary of `key: value` to set. A sequence of
+            `(imageKey, fields)` pairs is also accepted.
+        """
+        if isinstance(data, dict):
+            data = data.items()
+        imageUpdates = []
+        chipUpdates = []
+        if self.chips is not None:
+            baseKeys = self._chip_base_keys()
+        else:
+            baseKeys = []
+        for imageKey, fields in data:
+            imageUpdates.append(({"_id": imageKey}, {"$set": dict(fields)}))
+            chipFields = dict((k, v) for k, v in fields.items()
+                    if k in baseKeys)
+            if len(chipFields) > 0:
+                chipUpdates.append((imageKey, chipFields))
+        bulk_update(self.c, imageUpdates)
+        for imageKey, chipFields in chipUpdates:
+            self.chips.update({"image": imageKey}, {"$set": chipFields},
+                    multi=True)
+    
+    def find_chips(self, selector, images=None, exts=None, one=False,
+            **mdbArgs):
+        """Wrapper around MongoDB `find()` on the chip collection.
+
+        The query mask is applied to the chip documents, so the masked
+        fields must be present there (see `chipBaseKeys`).
+
+        :param selector: search selector dictionary for chip fields.
+        :param images: (optional) list of image keys to draw from.
+        :param exts: (optional) list of extensions to draw from.
+        :return: a cursor of chip documents, or a single document if `one`.
+        """
+        self._require_chips()
+        selector = self._insert_query_mask(selector)
+        if images is not None:
+            selector.update({"image": {"$in": images}})
+        if exts is not None:
+            selector.update({"ext": {"$in": [str(ext) for ext in exts]}})
+        if one:
+            return self.chips.find_one(selector, **mdbArgs)
+        else:
+            return self.chips.find(selector, **mdbArgs)
+
+    def find_frames(self, selector, images=None, exts=None):
+        """Get the `(imageKey, ext)` frames of chips matching the selector.
+
+        :param selector: search selector dictionary for chip fields.
+        :param images: (optional) list of image keys to draw from.
+        :param exts: (optional) list of extensions to draw from.
+        """
+        docs = self.find_chips(selector, images=images, exts=exts,
+                fields=["image", "ext"])
+        frames = [(doc['image'], doc['ext']) for doc in docs]
+        frames.sort()
+        return frames
+
+    def ensure_chip_index(self, key, direction=pymongo.ASCENDING):
+        """Build an index on the chip collection.
+
+        :param key: chip field to index.
+        :param direction: a PyMongo index direction or type, such as
+            ``pymongo.ASCENDING`` or ``pymongo.GEOSPHERE``.
+        """
+        self._require_chips()
+        self.chips.ensure_index([(key, direction)])
+
+    def sync_chips(self, selector=None, batch_size=500):
+        """(Re)build the chip collection documents from the image log.
+
+        This is needed after bulk edits made outside of :meth:`set` and
+        :meth:`set_frames`, such as :meth:`rename_field`. Chips of extensions
+        that an image no longer has are deleted.
+
+        :param selector: (optional) search selector dictionary for the images
+            whose chips are rebuilt.
+        :param batch_size: number of chip documents per bulk write.
+        """
+        self._require_chips()
+        if selector is None:
+            selector = {}
+        self.chips.ensure_index([("image", pymongo.ASCENDING)])
+        exts = self._chip_exts()
+        baseKeys = self._chip_base_keys()
+        updates = []
+        stale = []  # selectors of chips not rebuilt, per image
+        for doc in self.find(selector):
+            chipIds = []
+            for chip in chip_documents(doc, exts, baseKeys):
+                updates.append(({"_id": chip['_id']}, chip))
+                chipIds.append(chip['_id'])
+            stale.append({"image": doc['_id'], "_id": {"$nin": chipIds}})
+            if len(updates) >= batch_size or len(stale) >= batch_size:
+                bulk_update(self.chips, updates, upsert=True)
+                self.chips.remove({"$or": stale})
+                updates = []
+                stale = []
+        bulk_update(self.chips, updates, upsert=True)
+        if len(stale) > 0:
+            self.chips.remove({"$or": stale})
+        self.chips.ensure_index([("footprint_geo", pymongo.GEOSPHERE)])
+
+    def _require_chips(self):
+        if self.chips is None:
+            raise ValueError("ImageLog was created without a chip_cname")
+
+    def _chip_base_keys(self):
+        """Base document fields that are copied onto chip documents."""
+        keys = list(self.chipBaseKeys)
+        for key in self.queryMask:
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    def header(self, imageKey, ext=0):
+        """Get the full FITS header of an image extension from the header
+        collection, without reading the FITS file.
+
+        Recently used headers are cached in memory (up to
+        ``header_cache_size`` of them).
+
+        :param imageKey: image key (``_id``) of the image.
+        :param ext: HDU index of the header; ``0`` is the primary header.
+        :return: a copy of the :class:`astropy.io.fits.Header`.
+        """
+        if self.headers is None:
+            raise ValueError("ImageLog was created without a header_cname")
+        key = (imageKey, str(ext))
+        try:
+            header = self._header_cache.pop(key)
+        except KeyError:
+            header = self._load_header(imageKey, str(ext))
+        self._header_cache[key] = header
+        while len(self._header_cache) > self.header_cache_size:
+            self._header_cache.popitem(last=False)
+        return header.copy()
+
+    def _load_header(self, imageKey, ext):
+        """Read and unpack a header from the header collection."""
+        hduKey = ".".join(("hdus", ext))
+        doc = self.headers.find_one({"_id": imageKey}, fields=[hduKey])
+        if doc is None or ext not in doc.get('hdus', {}):
+            raise KeyError("No header stored for %s[%s]" % (imageKey, ext))
+        return unpack_header(doc['hdus'][ext])
 
     def find(self, selector, images=None, one=False, **mdbArgs):
         """Wrapper around MongoDB `find()`."""
@@ -124,9 +342,222 @@ class ImageLog(object):
     def distinct(self, field, selector, images=None):
         """Return the set of distinct values a field takes over the
         selection.
+
+        The query is run server-side with MongoDB's ``distinct`` command, so
+        only the distinct values are transferred.
+        """
+        selector = self._insert_query_mask(selector)
+        if images is not None:
+            selector.update({"_id": {"$in": images}})
+        result = self.db.command("distinct", self.cname, key=field,
+                query=selector)
+        return result['values']
+
+    def summarize(self, group_by, metrics=None, selector=None, images=None):
+        """Summarize the selected images with a server-side aggregation.
+
+        Images are grouped by the values of the `group_by` fields, and each
+        group is reduced to an image count and the requested `metrics`. For
+        example, the number of frames and total exposure time per filter
+        and object is::
+
+            log.summarize(["OBJECT", "FILTER"], metrics={"EXPTIME": "sum"})
+
+        :param group_by: field, or sequence of fields, to group by. Fields
+            can use dot syntax.
+        :param metrics: (optional) dictionary of `field: operator`, where the
+            operator is the name of a MongoDB ``$group`` accumulator (``sum``,
+            ``avg``, ``min``, ``max``, ``first``, ``last``, ``addToSet``).
+            A sequence of operators can also be given for a field.
+        :param selector: (optional) search selector dictionary
+        :param images: (optional) list of image keys to draw from
+        :return: an :class:`astropy.table.Table` with one row per group. The
+            columns are the `group_by` fields, ``count``, and a
+            ``FIELD_operator`` column for each metric.
+        """
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+        if selector is None:
+            selector = {}
+        pipeline, names = self._summary_pipeline(group_by, metrics or {},
+                selector, images)
+        rows = []
+        for result in self._aggregate(pipeline):
+            row = [result['_id'].get("g%i" % i)
+                   for i in xrange(len(group_by))]
+            row += [result["m%i" % i]
+                    for i in xrange(len(names) - len(group_by))]
+            rows.append(row)
+        if len(rows) == 0:
+            return astropy.table.Table(names=names)
+        return astropy.table.Table(rows=rows, names=names)
+
+    def _summary_pipeline(self, group_by, metrics, selector, images):
+        """Compile the aggregation pipeline for :meth:`summarize`.
+
+        Field names are replaced with positional aliases (``g0``, ``m0``,
+        ...) inside the pipeline since ``$group`` does not accept dotted
+        output names.
+
+        :return: tuple of (pipeline, column names)
         """
-        cursor = self.find(selector, images=images, fields=[field])
-        return cursor.distinct(field)
+        selector = self._insert_query_mask(selector)
+        if images is not None:
+            selector.update({"_id": {"$in": images}})
+        # SON keeps the group fields in order, so rows sort by them in turn
+        group = {"_id": SON([("g%i" % i, "$" + field)
+                             for i, field in enumerate(group_by)])}
+        names = list(group_by)
+        group["m0"] = {"$sum": 1}
+        names.append("count")
+        for field in sorted(metrics.keys()):
+            ops = metrics[field]
+            if isinstance(ops, basestring):
+                ops = [ops]
+            for op in ops:
+                group["m%i" % (len(names) - len(group_by))] = \
+                    {"$" + op: "$" + field}
+                names.append("_".join((field, op)))
+        pipeline = [{"$match": selector},
+                    {"$group": group},
+                    {"$sort": {"_id": 1}}]
+        return pipeline, names
+
+    def _aggregate(self, pipeline):
+        """Run an aggregation pipeline, returning an iterable of results
+        regardless of the PyMongo version's return type.
+        """
+        result = self.c.aggregate(pipeline)
+        if isinstance(result, dict):
+            return result['result']
+        return result
+
+    def ensure_footprint_index(self, exts=None, batch_size=500):
+        """Build ``2dsphere`` indexes on the image and chip footprints.
+
+        GeoJSON versions of the ``footprint`` polygons are stored under
+        ``footprint_geo`` (for the base document and each extension) for any
+        images that lack them, and a ``2dsphere`` index is built on each.
+        :class:`MEFImporter` writes ``footprint_geo`` directly, so this only
+        needs to be run once for image logs ingested before it did.
+
+        :param exts: (optional) extensions whose footprints are indexed.
+            Defaults to `exts`.
+        :param batch_size: number of documents updated per bulk write.
+        """
+        keys = [""] + ["%s." % ext for ext in self._chip_exts(exts)]
+        for prefix in keys:
+            polyKey = prefix + "footprint"
+            geoKey = prefix + "footprint_geo"
+            selector = {polyKey: {"$exists": 1}, geoKey: {"$exists": 0}}
+            updates = []
+            for doc in self.c.find(selector, fields=[polyKey]):
+                geo = polygon_to_geojson(doc[polyKey])
+                updates.append(({"_id": doc['_id']}, {"$set": {geoKey: geo}}))
+                if len(updates) >= batch_size:
+                    bulk_update(self.c, updates)
+                    updates = []
+            bulk_update(self.c, updates)
+            self.c.ensure_index([(geoKey, pymongo.GEOSPHERE)])
+
+    def find_covering(self, ra, dec, selector=None, images=None):
+        """Get keys of images whose footprint covers a position.
+
+        :param ra: right ascension, in degrees.
+        :param dec: declination, in degrees.
+        :param selector: (optional) search selector dictionary
+        :param images: (optional) list of image keys to draw from
+        :return: sorted list of image keys.
+        """
+        geometry = point_to_geojson(ra, dec)
+        return self._find_intersecting("footprint_geo", geometry,
+                selector, images)
+
+    def find_overlapping(self, region, selector=None, images=None):
+        """Get keys of images whose footprint overlaps a region.
+
+        For example, to select the inputs of a mosaic, pass the result to
+        :meth:`moastro.astromatic.Swarp.from_db`::
+
+            imageKeys = log.find_overlapping(targetWCS, {"FILTER": "Ks"})
+
+        :param region: sequence of ``(RA, Dec)`` polygon vertices in
+            degrees, or an :class:`astropy.wcs.WCS` whose footprint is used.
+        :param selector: (optional) search selector dictionary
+        :param images: (optional) list of image keys to draw from
+        :return: sorted list of image keys.
+        """
+        geometry = polygon_to_geojson(_region_polygon(region))
+        return self._find_intersecting("footprint_geo", geometry,
+                selector, images)
+
+    def find_covering_chips(self, ra, dec, selector=None, images=None,
+            exts=None):
+        """Get the chips whose footprint covers a position.
+
+        :param ra: right ascension, in degrees.
+        :param dec: declination, in degrees.
+        :param selector: (optional) search selector dictionary, applied to
+            the base image document.
+        :param images: (optional) list of image keys to draw from
+        :param exts: (optional) extensions to search. Defaults to `exts`.
+        :return: sorted list of `(imageKey, ext)` frame tuples.
+        """
+        geometry = point_to_geojson(ra, dec)
+        return self._find_intersecting_chips(geometry, selector, images, exts)
+
+    def find_overlapping_chips(self, region, selector=None, images=None,
+            exts=None):
+        """Get the chips whose footprint overlaps a region.
+
+        :param region: sequence of ``(RA, Dec)`` polygon vertices in
+            degrees, or an :class:`astropy.wcs.WCS` whose footprint is used.
+        :param selector: (optional) search selector dictionary, applied to
+            the base image document.
+        :param images: (optional) list of image keys to draw from
+        :param exts: (optional) extensions to search. Defaults to `exts`.
+        :return: sorted list of `(imageKey, ext)` frame tuples.
+        """
+        geometry = polygon_to_geojson(_region_polygon(region))
+        return self._find_intersecting_chips(geometry, selector, images, exts)
+
+    def _find_intersecting(self, geoKey, geometry, selector, images):
+        """Image keys where the geometry at `geoKey` intersects `geometry`."""
+        if selector is None:
+            selector = {}
+        selector = dict(selector)
+        selector[geoKey] = {"$geoIntersects": {"$geometry": geometry}}
+        return self.find_images(selector, images=images)
+
+    def _find_intersecting_chips(self, geometry, selector, images, exts):
+        """Frames whose chip footprint intersects `geometry`. One indexed
+        query is made per extension.
+        """
+        exts = self._chip_exts(exts)
+        if self.chips is not None and len(exts) > 0:
+            if selector is None:
+                selector = {}
+            selector = dict(selector)
+            selector["footprint_geo"] = {"$geoIntersects":
+                {"$geometry": geometry}}
+            return self.find_frames(selector, images=images, exts=exts)
+        if len(exts) == 0:
+            return [(imageKey, 0) for imageKey in self._find_intersecting(
+                "footprint_geo", geometry, selector, images)]
+        frames = []
+        for ext in exts:
+            geoKey = "%s.footprint_geo" % ext
+            for imageKey in self._find_intersecting(geoKey, geometry,
+                    selector, images):
+                frames.append((imageKey, ext))
+        frames.sort()
+        return frames
+
+    def _chip_exts(self, exts=None):
+        """Extension names holding chip sub-documents (i.e., not ``0``)."""
+        if exts is None:
+            exts = self.exts
+        return [str(ext) for ext in exts if str(ext) != "0"]
 
     def compress_fits(self, path_key, selector={},
                       alg="Rice", q=4, delete=False):
@@ -260,58 +691,150 @@ class ImageLog(object):
         self.c.update(selector, {"$unset": {dataKey: 1}},
                 multi=multi)
     
-    def move_files(self, pathKey, newDir, selector=None, copy=False):
+    def move_files(self, pathKey, newDir, selector=None, copy=False,
+            nthreads=1, dry_run=False, batch_size=500):
         """Moves a file whose path is found under `pathKey` to the `newDir`
         directory. The directory is created if necessary. Old files are
         overwritten if necessary.
-        
+
+        Files on the same filesystem as `newDir` are renamed; other files,
+        and all files if `copy` is ``True``, are copied with a reflink or
+        ``copy_file_range`` when the platform supports it. Path changes
+        are written back to the image log in bulk, including those of files
+        moved before an error or an interruption.
+
         :param dataKey: field of path for files to be moved
         :param newDir: directory where files should be moved to.
         :param selector: (optional) search selector dictionary
+        :param copy: set to True to leave the original files in place.
+        :param nthreads: number of I/O threads moving files concurrently.
+        :param dry_run: if True, nothing is moved; instead a plan is returned.
+        :param batch_size: number of path updates per bulk database write.
+        :return: if `dry_run`, a dictionary with the list of
+            ``(imageKey, origPath, newPath)`` moves under ``moves`` and the
+            total size under ``bytes``. Otherwise a dictionary of
+            `imageKey: error message` for files that could not be moved.
         """
-        if os.path.exists(newDir) is False:
-            os.makedirs(newDir)
-        
         if selector is None:
             selector = {}
         selector = self._insert_query_mask(selector)
-        for rec in self.getiter(selector, pathKey):
-            imageKey = rec['_id']
+        selector.update({pathKey: {"$exists": 1}})
+        moves = []
+        for rec in self.c.find(selector, fields=[pathKey]):
             origPath = rec[pathKey]
             newPath = os.path.join(newDir, os.path.basename(origPath))
             if newPath == origPath:
                 continue
-            print origPath, "->", newPath
-            # if os.path.exists(newPath):
-            #     os.remove(newPath)
-            
-            if copy:
-                shutil.copy(origPath, newPath)
+            moves.append((rec['_id'], origPath, newPath))
+
+        if dry_run:
+            nbytes = sum(fileops.file_size(m[1]) for m in moves)
+            return {"moves": moves, "bytes": nbytes}
+
+        if os.path.exists(newDir) is False:
+            os.makedirs(newDir)
+
+        args = [(key, src, dst, copy) for key, src, dst in moves]
+        if nthreads > 1:
+            pool = ThreadPool(processes=nthreads)
+            results = pool.imap_unordered(_move_worker, args)
+        else:
+            pool = None
+            results = itertools.imap(_move_worker, args)
+
+        errors = {}
+        updates = []
+
+        def record(imageKey, newPath, error):
+            if error is not None:
+                errors[imageKey] = error
             else:
-                shutil.move(origPath, newPath)
-                
-            self.c.update({"_id": imageKey}, {"$set": {pathKey: newPath}})
-    
-    def delete_files(self, pathKey, selector=None):
+                updates.append(({"_id": imageKey},
+                    {"$set": {pathKey: newPath}}))
+
+        try:
+            for result in results:
+                record(*result)
+                if len(updates) >= batch_size:
+                    bulk_update(self.c, updates)
+                    del updates[:]
+        finally:
+            # Record the files already moved, even if interrupted
+            if pool is not None:
+                pool.close()
+                pool.join()
+                for result in results:
+                    record(*result)
+            if len(updates) > 0:
+                bulk_update(self.c, updates)
+        return errors
+
+    def delete_files(self, pathKey, selector=None, nthreads=1,
+            dry_run=False, batch_size=500):
         """Deletes all files stored under pathKey, and the reference in the
         image log.
-        
+
         :param pathKey: data key for path. Can include dot syntax.
         :param selector: (optional) MongoDB query dictionay.
+        :param nthreads: number of I/O threads deleting files concurrently.
+        :param dry_run: if True, nothing is deleted; instead a plan is
+            returned.
+        :param batch_size: number of references removed per bulk write.
+        :return: if `dry_run`, a dictionary with the list of
+            ``(imageKey, path)`` deletions under ``deletes`` and the total
+            size under ``bytes``. Otherwise a dictionary of
+            `imageKey: error message` for files that could not be deleted.
         """
         if selector is None:
             selector = {}
         selector = self._insert_query_mask(selector)
         selector.update({pathKey: {"$exists": 1}})
+        deletes = []
         for doc in self.c.find(selector, fields=[pathKey]):
-            imageKey = doc['_id']
             try:
                 path = str(doc[pathKey])
             except:
                 continue
-            if os.path.exists(path):
-                os.remove(path)
-            self.c.update({"_id": imageKey}, {"$unset": {pathKey: 1}})
+            deletes.append((doc['_id'], path))
+
+        if dry_run:
+            nbytes = sum(fileops.file_size(d[1]) for d in deletes)
+            return {"deletes": deletes, "bytes": nbytes}
+
+        if nthreads > 1:
+            pool = ThreadPool(processes=nthreads)
+            results = pool.imap_unordered(_delete_worker, deletes)
+        else:
+            pool = None
+            results = itertools.imap(_delete_worker, deletes)
+
+        errors = {}
+        updates = []
+
+        def record(imageKey, error):
+            if error is not None:
+                errors[imageKey] = error
+            else:
+                updates.append(({"_id": imageKey},
+                    {"$unset": {pathKey: 1}}))
+
+        try:
+            for result in results:
+                record(*result)
+                if len(updates) >= batch_size:
+                    bulk_update(self.c, updates)
+                    del updates[:]
+        finally:
+            # Remove the references of files already deleted, even if
+            # interrupted
+            if pool is not None:
+                pool.close()
+                pool.join()
+                for result in results:
+                    record(*result)
+            if len(updates) > 0:
+                bulk_update(self.c, updates)
+        return errors
     
     def print_rec(self, imageKey):
         """Pretty-prints the record of `imageKey`"""
@@ -423,9 +946,6 @@ class ImageLog(object):
         """Get the set of unique values of data key for images that meet the
         specified selector.
         
-        .. note:: This doesn't actually use the `distinct` aggregation commmand
-            in PyMongo, since it doesn't yet support queries itself.
-        
         :param dataKey: data field whose values will compiled into a set of
             unique values.
         :param selector: (optional) dictionary for data keys: data values that
@@ -440,18 +960,8 @@ class ImageLog(object):
         warnings.warn(
             'find_unique() is deprecated, use distinct() instead',
             stacklevel=2)
-        records = self.getiter(selector, dataKey, candidateImages=candidateImages)
-        itemList = [rec[dataKey] for rec in records]
-        filteredItemList = []
-        for item in itemList:
-            if type(item) is unicode:
-                filteredItemList.append(str(item))
-            else:
-                filteredItemList.append(item)
-        print "all items:", filteredItemList
-        valueSet = list(set(itemList))
+        valueSet = self.distinct(dataKey, selector, images=candidateImages)
         valueSet.sort()
-        print "value set:", valueSet
         return valueSet
 
 
@@ -462,6 +972,92 @@ def _funpack_worker(args):
     return imageKey, outputPath
 
 
+def chip_id(imageKey, ext):
+    """The ``_id`` of the chip document for extension `ext` of an image."""
+    return "%s.%s" % (imageKey, ext)
+
+
+def chip_documents(doc, exts, baseKeys=()):
+    """Split an image document into normalized chip documents.
+
+    :param doc: image log document.
+    :param exts: extensions to build chip documents for.
+    :param baseKeys: base document fields copied onto each chip document.
+    :return: list of chip documents.
+    """
+    chips = []
+    for ext in exts:
+        ext = str(ext)
+        if ext not in doc:
+            continue
+        chip = dict(doc[ext])
+        for key in baseKeys:
+            if key in doc:
+                chip[key] = doc[key]
+        chip['_id'] = chip_id(doc['_id'], ext)
+        chip['image'] = doc['_id']
+        chip['ext'] = ext
+        chips.append(chip)
+    return chips
+
+
+def pack_header(header):
+    """Compress a FITS header for storage in the header collection.
+
+    :param header: a :class:`moastro.fitsheader.ScannedHeader` or an
+        :class:`astropy.io.fits.Header`.
+    :return: dict with the zlib-compressed header ``cards`` and whether the
+        header belongs to a tile-``compressed`` image (in which case the
+        cards are those of the binary table holding the image).
+    """
+    if isinstance(header, ScannedHeader):
+        text = header.text
+        compressed = header.compressed
+    else:
+        text = header.tostring()
+        compressed = False
+    return {"cards": Binary(zlib.compress(text.encode('ascii'))),
+            "compressed": compressed}
+
+
+def unpack_header(packed):
+    """Rebuild the :class:`astropy.io.fits.Header` of a header packed with
+    :func:`pack_header`.
+    """
+    header = ScannedHeader()
+    header.text = zlib.decompress(bytes(packed['cards'])).decode('ascii')
+    header.compressed = packed.get('compressed', False)
+    return header.to_header()
+
+
+def _region_polygon(region):
+    """Polygon vertices for a region given as a vertex list or WCS."""
+    if hasattr(region, 'calc_footprint'):
+        return region.calc_footprint().tolist()
+    return region
+
+
+def _move_worker(args):
+    """Worker function for moving or copying a file."""
+    imageKey, origPath, newPath, copy = args
+    try:
+        fileops.relocate_file(origPath, newPath, copy=copy)
+    except (IOError, OSError) as e:
+        return imageKey, newPath, str(e)
+    return imageKey, newPath, None
+
+
+def _delete_worker(args):
+    """Worker function for deleting a file."""
+    imageKey, path = args
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        return imageKey, str(e)
+    return imageKey, None
+
+
 class MEFImporter(object):
     """Base class for importing MEF (multi-extension FITS) into an imagelog.
     
@@ -483,6 +1079,27 @@ class MEFImporter(object):
        from that in the FITS header.
     6. (optional) Implement ``post_ext_ingest`` to modify the document for
        each image extension after the extension header keys are imported.
+    7. (optional) Set ``fast_headers`` to ``True`` to read headers with
+       :func:`moastro.fitsheader.scan_headers` instead of
+       :func:`astropy.io.fits.open`. Only the header blocks of each HDU are
+       read, and compressed (``.fz``) images are never decompressed. The
+       ``header`` passed to the hooks is then a
+       :class:`moastro.fitsheader.ScannedHeader` (a ``dict`` of keyword
+       values) rather than an :class:`astropy.io.fits.Header`.
+    8. (optional) Set ``checksum`` to ``True`` to record the SHA-1 hash of
+       each file with its size and modification time. Incremental ingests
+       then skip files that were touched but whose contents are unchanged.
+    9. (optional) Pass ``header_cname`` to store the full headers of the
+       primary HDU and each extension in ``exts``, zlib-compressed, in a
+       side collection. :meth:`ImageLog.header` then returns any header
+       keyword without opening the FITS file.
+    10. (optional) Append statistics hooks to ``stats_hooks``, such as
+        :func:`moastro.imagestats.sky_stats`. A hook is called as
+        ``hook(pixels, header)`` for each image HDU, where ``pixels`` is a
+        strided sample of ``stats_sample`` (rows, columns) pixels read by
+        :func:`moastro.imagestats.sample_pixels`, and returns a dict of
+        fields added to the extension's document. Hooks run in the ingest
+        worker processes.
 
     Parameters
     ----------
@@ -499,22 +1116,44 @@ class MEFImporter(object):
         URL of MongoDB server.
     port : int
         Port of MongoDB server.
+    chip_cname : str
+        (optional) Name of the chip collection kept by :class:`ImageLog`.
+        If set, a chip document is written for each imported extension,
+        carrying the base fields listed in ``chip_base_keys``.
+    header_cname : str
+        (optional) Name of a MongoDB collection where the full headers of
+        each image are stored, see :meth:`ImageLog.header`.
     """
     def __init__(self, dbname, cname, server=None,
-            url="localhost", port=27017):
+            url="localhost", port=27017, chip_cname=None, header_cname=None):
         super(MEFImporter, self).__init__()
         self.connection = make_connection(server=server, url=url, port=port)
         self.db = self.connection[dbname]
-        self.db.add_son_manipulator(DotReachable())
-        self.c = self.db[cname]
+        self.c = reachable_collection(self.db, cname)
+        if chip_cname is not None:
+            self.chips = reachable_collection(self.db, chip_cname)
+        else:
+            self.chips = None
+        if header_cname is not None:
+            self.headers = self.db[header_cname]
+        else:
+            self.headers = None
 
         # Defaults
         self.exts = []
         self.copy_keys = ['OBJECT', 'FILTER', 'MJDATE',
-            'EXPTIME', 'INSTRUME', 'RA', 'DEC', 'AIRMASS', 'UTC-OBS']
-        self.copy_ext_keys = []
+            'EXPTIME', 'INSTRUME', 'RA', 'DEC', 'AIRMASS', 'UTC-OBS',
+            'NAXIS1', 'NAXIS2']
+        self.copy_ext_keys = ['NAXIS1', 'NAXIS2']
+        self.chip_base_keys = list(CHIP_BASE_KEYS)
+        self.fast_headers = False
+        self.checksum = False
+        self.stats_hooks = []
+        self.stats_sample = (64, 512)
     
-    def ingest(self, base_dir, suffix=".fits", recursive=True, preview=False):
+    def ingest(self, base_dir, suffix=".fits", recursive=True, preview=False,
+            nproc=1, batch_size=100, incremental=False, mark_missing=False,
+            nthreads=8, manifest=None):
         """Runs the import pipeline.
         
         Parameters
@@ -533,11 +1172,201 @@ class MEFImporter(object):
         preview : bool
             If `True` then the documents are *not* inserted into MongoDB,
             but only printed. Useful for debugging the ingest.
+        nproc : int
+            Number of processes reading FITS files and building documents.
+            Documents, including the output of the user hooks, are built in
+            the worker processes and written to MongoDB by this process.
+        batch_size : int
+            Number of documents written per unordered bulk upsert.
+        incremental : bool
+            If `True`, only files that are new, or whose size, modification
+            time or inode changed since they were last ingested, are read.
+            See :meth:`load_stat_index`.
+        mark_missing : bool
+            If `True`, documents of files under ``base_dir`` that were
+            ingested previously but no longer exist are flagged with
+            ``ingest_stat.missing``. Other fields are not touched. Files
+            that exist but were not listed by this ingest (in
+            subdirectories when not `recursive`, with another suffix or
+            absent from the manifest) are not flagged.
+        nthreads : int
+            Number of threads listing directories while searching
+            ``base_dir``. Ingest starts as soon as the first directory is
+            listed.
+        manifest : str
+            (optional) Path to a file listing the FITS files to ingest, one
+            per line, which is read instead of searching ``base_dir``.
+            Relative paths are relative to ``base_dir``.
+
+        Returns
+        -------
+
+        failures : dict
+            Dictionary of `path: error message` for files that could not be
+            ingested.
+        """
+        if manifest is not None:
+            paths = read_manifest(manifest, suffix=suffix, root=base_dir)
+        else:
+            paths = crawl(base_dir, suffix=suffix, recursive=recursive,
+                    nthreads=nthreads)
+        if not (incremental or mark_missing):
+            return self.ingest_paths(paths, preview=preview, nproc=nproc,
+                    batch_size=batch_size)
+
+        index = self.load_stat_index(base_dir)
+        seen = set()
+        paths = self._changed_paths(paths, index, seen, incremental)
+        failures = self.ingest_paths(paths, preview=preview, nproc=nproc,
+                batch_size=batch_size)
+        if mark_missing and not preview:
+            self.mark_missing(stat for path, stat in index.iteritems()
+                if path not in seen and not os.path.exists(path))
+        return failures
+
+    def ingest_paths(self, paths, preview=False, nproc=1, batch_size=100):
+        """Ingest a sequence of FITS files.
+
+        Parameters
+        ----------
+
+        paths : iterable
+            Paths to the FITS images.
+        preview : bool
+            If `True` then the documents are *not* inserted into MongoDB,
+            but only printed. Useful for debugging the ingest.
+        nproc : int
+            Number of processes reading FITS files and building documents.
+        batch_size : int
+            Number of documents written per unordered bulk upsert.
+
+        Returns
+        -------
+
+        failures : dict
+            Dictionary of `path: error message` for files that could not be
+            ingested.
         """
-        for path in MEFImporter.all_files(base_dir, "*" + suffix,
-                single_level=recursive):
+        if nproc > 1:
+            pool = self.worker_pool(nproc)
+            results = pool.imap_unordered(_ingest_worker, paths)
+        else:
+            pool = None
+            results = itertools.imap(self.build_document, paths)
+
+        failures = {}
+        docs = []
+        for path, doc, error in results:
+            if error is not None:
+                print "Could not ingest %s" % path
+                print error
+                failures[path] = error
+                continue
             print path
-            self._import_fits(path, preview)
+            if preview:
+                print doc
+                print doc.keys()
+                continue
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                self.write_documents(docs)
+                docs = []
+        self.write_documents(docs)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return failures
+
+    def load_stat_index(self, base_dir=None):
+        """Load the file identities recorded at the last ingest of each file.
+
+        Each ingested document records the absolute ``path``, ``size``,
+        ``mtime`` and ``inode`` of its file under the ``ingest_stat`` field
+        (plus ``sha1`` if ``checksum`` is set on the importer). The whole
+        index is read with a single query, on an index of
+        ``ingest_stat.path`` that is built if needed.
+
+        Parameters
+        ----------
+
+        base_dir : str
+            (optional) Only files under this directory are loaded.
+
+        Returns
+        -------
+
+        index : dict
+            Dictionary of `path: ingest_stat` dictionaries. Each also holds
+            the ``_id`` of its document.
+        """
+        self.c.ensure_index([("ingest_stat.path", pymongo.ASCENDING)])
+        selector = {"ingest_stat.path": {"$exists": 1}}
+        if base_dir is not None:
+            root = os.path.join(os.path.abspath(base_dir), "")
+            selector["ingest_stat.path"] = {
+                "$regex": "^" + re.escape(root)}
+        index = {}
+        for doc in self.c.find(selector, fields=["ingest_stat"]):
+            stat = dict(doc['ingest_stat'])
+            stat['_id'] = doc['_id']
+            index[stat['path']] = stat
+        return index
+
+    def mark_missing(self, stats, batch_size=500):
+        """Flag the documents of deleted files with ``ingest_stat.missing``.
+        Documents that are already flagged are skipped.
+
+        Parameters
+        ----------
+
+        stats : iterable
+            ``ingest_stat`` dictionaries of the deleted files, from
+            :meth:`load_stat_index`.
+        batch_size : int
+            Number of documents updated per bulk write.
+        """
+        updates = []
+        for stat in stats:
+            if stat.get('missing', False):
+                continue
+            print "Missing %s" % stat['path']
+            updates.append(({"_id": stat['_id']},
+                {"$set": {"ingest_stat.missing": True}}))
+            if len(updates) >= batch_size:
+                bulk_update(self.c, updates)
+                updates = []
+        bulk_update(self.c, updates)
+
+    def _changed_paths(self, paths, index, seen, incremental):
+        """Yield the paths that are new or changed relative to the `index`.
+
+        Every path is added to the `seen` set. If `incremental` is false,
+        all paths are yielded.
+        """
+        for path in paths:
+            abspath = os.path.abspath(path)
+            seen.add(abspath)
+            if not incremental or self._is_changed(abspath,
+                    index.get(abspath)):
+                yield path
+
+    def _is_changed(self, path, stat):
+        """``True`` if the file at ``path`` differs from its recorded stat."""
+        if stat is None or stat.get('missing', False):
+            return True
+        st = os.stat(path)
+        if st.st_size == stat['size'] and st.st_mtime == stat['mtime'] \
+                and st.st_ino == stat.get('inode', st.st_ino):
+            return False
+        if self.checksum and 'sha1' in stat \
+                and st.st_size == stat['size']:
+            if fileops.file_checksum(path) == stat['sha1']:
+                # Touched, but identical; record the new stat
+                self.c.update({"_id": stat['_id']},
+                    {"$set": {"ingest_stat": fileops.file_stat(path,
+                        checksum=True)}})
+                return False
+        return True
 
     def ingest_one(self, path, preview=False):
         """Ingest a single FITS file at ``path``.
@@ -553,41 +1382,148 @@ class MEFImporter(object):
         self._import_fits(path, preview)
 
     @staticmethod
-    def all_files(root, pattern, single_level=False):
+    def all_files(root, pattern, single_level=False, nthreads=8):
         """Yield file paths matching a pattern.
-        
-        Adapted from Python Cookbook, 2nd Ed. 2.16.
+
+        Patterns of the form ``'*suffix'`` are matched by suffix alone;
+        other patterns are matched with :func:`fnmatch.fnmatch`. See
+        :func:`moastro.crawler.crawl`.
         """
-        for path, subdirs, files in os.walk(root):
-            files.sort()
-            for name in files:
-                if fnmatch.fnmatch(name, pattern):
-                    yield os.path.join(path, name)
-                    # break
-            if single_level:
-                break
+        if pattern.startswith("*") and not any(c in pattern[1:]
+                for c in "*?["):
+            return crawl(root, suffix=pattern[1:],
+                    recursive=not single_level, nthreads=nthreads)
+        paths = crawl(root, suffix="", recursive=not single_level,
+                nthreads=nthreads)
+        return (path for path in paths
+                if fnmatch.fnmatch(os.path.basename(path), pattern))
 
     def _import_fits(self, path, preview):
         """Import a FITS file at ``path``."""
+        doc = self._build_document(path)
+        if preview:
+            print doc
+            print doc.keys()
+        else:
+            self.write_documents([doc])
+
+    def _build_document(self, path):
+        """Build the image log document for the FITS file at ``path``."""
         doc = {}
-        f = astropy.io.fits.open(path)
-        doc['_id'] = self.generate_id(path, f[0].header)
-        doc.update(self._ingest_fits_base(path, f[0].header, f))
+        if self.fast_headers:
+            f = None
+            headers = scan_headers(path, exts=self.exts)
+        else:
+            f = astropy.io.fits.open(path)
+            headers = dict((ext, f[ext].header) for ext in [0] + self.exts)
+        footprints = self._chip_footprints(headers, f)
+        doc['_id'] = self.generate_id(path, headers[0])
+        doc.update(self._ingest_fits_base(path, headers[0], f,
+                footprint=footprints.get(0)))
         for ext in self.exts:
-            doc[str(ext)] = self._ingest_fits_ext(f[ext].header, f)
+            doc[str(ext)] = self._ingest_fits_ext(headers[ext], f,
+                    footprint=footprints[ext])
         # Put an overall footprint into doc root
         if len(self.exts) == 1:
-            doc['footprint'] = MEFImporter.chip_footprint_polygon(
-                f[self.exts[0]].header, f)
+            doc['footprint'] = footprints[self.exts[0]]
         elif len(self.exts) > 1:
             doc['footprint'] = self._combine_footprint(doc)
-        f.close()
-        if preview:
-            print doc
-            print doc.keys()
+        if self.headers is not None:
+            doc[HEADER_STORE_KEY] = dict((str(ext), pack_header(headers[ext]))
+                    for ext in [0] + self.exts)
+        if len(self.stats_hooks) > 0:
+            self._ingest_stats(path, headers, f, doc)
+        if f is not None:
+            f.close()
+        doc['ingest_stat'] = fileops.file_stat(path, checksum=self.checksum)
+        # GeoJSON footprints for 2dsphere indexing
+        if 'footprint' in doc:
+            doc['footprint_geo'] = polygon_to_geojson(doc['footprint'])
+        for ext in self.exts:
+            doc[str(ext)]['footprint_geo'] = polygon_to_geojson(
+                doc[str(ext)]['footprint'])
+        return doc
+
+    def _ingest_stats(self, path, headers, hdulist, doc):
+        """Run the statistics hooks on sampled pixels of each image HDU."""
+        if len(self.exts) == 0:
+            targets = [(0, doc)]
         else:
-            # Insert into MongoDB
-            self.c.save(doc)
+            targets = [(ext, doc[str(ext)]) for ext in self.exts]
+        opened = None
+        nrows, ncols = self.stats_sample
+        for ext, target in targets:
+            header = headers[ext]
+            hdu = None
+            if hdulist is not None:
+                hdu = hdulist[ext]
+            elif header.compressed:
+                # Scanned headers of .fz images: decompress sampled tiles
+                if opened is None:
+                    opened = astropy.io.fits.open(path)
+                hdu = opened[ext]
+            pixels = sample_pixels(path, header, hdu=hdu, nrows=nrows,
+                    ncols=ncols)
+            if pixels is None:
+                continue
+            for hook in self.stats_hooks:
+                target.update(hook(pixels, header))
+        if opened is not None:
+            opened.close()
+
+    def build_document(self, path):
+        """Build the image document of a FITS file, capturing any failure.
+        The document is written with :meth:`write_documents`.
+
+        :return: tuple of ``(path, doc, error)``, where ``error`` is ``None``
+            on success or the formatted traceback on failure.
+        """
+        try:
+            return path, self._build_document(path), None
+        except Exception:
+            return path, None, traceback.format_exc()
+
+    def worker_pool(self, nproc):
+        """A pool of worker processes building documents with this importer
+        (see :meth:`build_async`). The importer is inherited by the forked
+        workers rather than pickled.
+
+        :param nproc: number of worker processes.
+        :return: a :class:`multiprocessing.pool.Pool`.
+        """
+        return multiprocessing.Pool(processes=nproc,
+                initializer=_init_ingest_worker, initargs=(self,))
+
+    def build_async(self, pool, path):
+        """Build the document of a FITS file in a :meth:`worker_pool`.
+
+        :return: a :class:`multiprocessing.pool.AsyncResult` of the
+            :meth:`build_document` tuple.
+        """
+        return pool.apply_async(_ingest_worker, (path,))
+
+    def write_documents(self, docs):
+        """Upsert image documents (and chip and header documents) in bulk on
+        ``_id``.
+        """
+        headerDocs = []
+        for doc in docs:
+            if HEADER_STORE_KEY in doc:
+                headerDocs.append({"_id": doc['_id'],
+                                   "hdus": doc.pop(HEADER_STORE_KEY)})
+        if self.headers is not None and len(headerDocs) > 0:
+            bulk_update(self.headers,
+                    [({"_id": d['_id']}, d) for d in headerDocs], upsert=True)
+        bulk_update(self.c, [({"_id": doc['_id']}, doc) for doc in docs],
+                upsert=True)
+        if self.chips is not None:
+            chips = []
+            for doc in docs:
+                chips.extend(chip_documents(doc, self.exts,
+                                            self.chip_base_keys))
+            bulk_update(self.chips,
+                    [({"_id": chip['_id']}, chip) for chip in chips],
+                    upsert=True)
 
     def generate_id(self, path, header):
         """Generate the object id for this image.
@@ -597,13 +1533,32 @@ class MEFImporter(object):
         """
         raise NotImplementedError
 
-    def _ingest_fits_base(self, path, header, hdulist):
+    def _chip_footprints(self, headers, hdulist):
+        """Footprints of all imported image HDUs, keyed by extension.
+
+        Footprints of headers with a linear TAN/TPV WCS are computed
+        together with :func:`moastro.footprint.linear_footprints`; only
+        other headers have an :class:`astropy.wcs.WCS` built.
+        """
+        exts = self.exts if len(self.exts) > 0 else [0]
+        polygons = linear_footprints([headers[ext] for ext in exts])
+        footprints = {}
+        for ext, polygon in zip(exts, polygons):
+            if polygon is None:
+                polygon = MEFImporter.chip_footprint_polygon(headers[ext],
+                        hdulist)
+            footprints[ext] = polygon
+        return footprints
+
+    def _ingest_fits_base(self, path, header, hdulist, footprint=None):
         """Build document from base FITS header."""
         doc = {}
         # Create a footprint if this is an image extension
         if len(self.exts) == 0:
-            doc['footprint'] = MEFImporter.chip_footprint_polygon(header,
-                    hdulist)
+            if footprint is None:
+                footprint = MEFImporter.chip_footprint_polygon(header,
+                        hdulist)
+            doc['footprint'] = footprint
         for key in self.copy_keys:
             try:
                 doc[key] = header[key]
@@ -623,10 +1578,12 @@ class MEFImporter(object):
         """
         pass
 
-    def _ingest_fits_ext(self, header, hdulist):
+    def _ingest_fits_ext(self, header, hdulist, footprint=None):
         """Build document for an individual extension/chip."""
         doc = {}
-        doc['footprint'] = MEFImporter.chip_footprint_polygon(header, hdulist)
+        if footprint is None:
+            footprint = MEFImporter.chip_footprint_polygon(header, hdulist)
+        doc['footprint'] = footprint
         for key in self.copy_ext_keys:
             try:
                 doc[key] = header[key]
@@ -647,25 +1604,48 @@ class MEFImporter(object):
         pass
 
     def _combine_footprint(self, doc):
-        """Build a footprint to encompass all detectors."""
-        ras = []
-        decs = []
+        """Build a footprint to encompass all detectors.
+
+        The footprint is the spherical convex hull of all chip corners (see
+        :func:`moastro.footprint.spherical_hull`), which handles RA
+        wrapping and the poles.
+        """
+        corners = []
         for ext in self.exts:
-            poly = doc[str(ext)]['footprint']
-            for (ra, dec) in poly:
-                ras.append(ra)
-                decs.append(dec)
-        output_poly = [[min(ras), min(decs)], [max(ras), min(decs)],
-                [max(ras), max(decs)], [min(ras), max(decs)]]
-        return output_poly
+            corners.extend(doc[str(ext)]['footprint'])
+        return spherical_hull(corners)
     
     @staticmethod
     def chip_footprint_polygon(header, hdulist):
         """Create a Mongo-compatible polygon representing the chip footprint
         in equatorial cordinates. The polygon is a length-4 list, populated
         with length-2 lists of RA, Dec vertices.
+
+        ``hdulist`` may be ``None`` if the header was read with
+        :func:`moastro.fitsheader.scan_headers`.
         """
+        if isinstance(header, ScannedHeader):
+            header = header.to_header()
         wcs = astropy.wcs.WCS(header=header, fobj=hdulist)
         footprint = wcs.calc_footprint(header=header)
         footprint_lst = footprint.tolist()  # cast as a list of floats
         return footprint_lst
+
+
+# Importer used by ingest worker processes; set by _init_ingest_worker
+_ingest_importer = None
+
+
+def _init_ingest_worker(importer):
+    """Initializer for ingest worker processes.
+
+    The importer is inherited by the forked worker, rather than pickled.
+    """
+    global _ingest_importer
+    _ingest_importer = importer
+
+
+def _ingest_worker(path):
+    """Worker function for building an image document in parallel ingests.
+    """
+    return _ingest_importer.build_document(path)
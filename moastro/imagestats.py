@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cheap image statistics from a sparse sample of pixels.
+
+:func:`sample_pixels` reads a strided grid of pixels from an image HDU:
+a few evenly spaced rows, and every n-th pixel along each row. Uncompressed
+images are memory-mapped, so only the pages holding those rows are read.
+For tile-compressed images only the tiles holding the sampled rows are
+decompressed (with ``astropy`` versions whose ``CompImageHDU`` has a
+``section`` attribute).
+
+:func:`sky_stats` is a statistics hook for
+:class:`moastro.imagelog.MEFImporter` that measures the sky level, sky noise
+and saturated fraction from such a sample.
+
+Functions
+---------
+
+- :func:`sample_pixels`
+- :func:`sky_stats`
+"""
+
+import numpy as np
+
+from .fitsheader import ScannedHeader
+
+# numpy dtypes of FITS BITPIX values (FITS data are big-endian)
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                 -32: '>f4', -64: '>f8'}
+
+
+def sample_pixels(path, header, hdu=None, nrows=64, ncols=512):
+    """Read a strided grid of pixel values from a 2D image.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to the FITS file.
+    header : :class:`moastro.fitsheader.ScannedHeader` or Header
+        Header of the image HDU. A ``ScannedHeader`` of an uncompressed
+        image gives the data offset needed to memory-map the pixels
+        directly.
+    hdu : astropy HDU
+        (optional) The opened HDU. Required unless ``header`` is a
+        ``ScannedHeader`` of an uncompressed image.
+    nrows : int
+        Number of rows to sample.
+    ncols : int
+        Approximate number of pixels to sample along each row.
+
+    Returns
+    -------
+
+    pixels : ndarray
+        ``(nrows, ~ncols)`` array of (scaled) pixel values as ``float64``,
+        or ``None`` if the HDU does not hold a 2D image.
+    """
+    if header.get('NAXIS', 0) != 2:
+        return None
+    nx = header['NAXIS1']
+    ny = header['NAXIS2']
+    if nx == 0 or ny == 0:
+        return None
+    rows = np.unique(np.linspace(0, ny - 1, min(nrows, ny)).astype(int))
+    step = max(1, nx // ncols)
+
+    if hdu is None and isinstance(header, ScannedHeader) \
+            and not header.compressed:
+        data = np.memmap(path, dtype=BITPIX_DTYPES[header['BITPIX']],
+                mode='r', offset=header.data_offset, shape=(ny, nx))
+        pixels = data[rows, ::step].astype(np.float64)
+        del data
+        bscale = header.get('BSCALE', 1.)
+        bzero = header.get('BZERO', 0.)
+        if bscale != 1.:
+            pixels *= bscale
+        if bzero != 0.:
+            pixels += bzero
+        return pixels
+
+    if hdu is None:
+        raise ValueError("An opened HDU is needed to sample %s" % path)
+    section = getattr(hdu, 'section', None)
+    if section is None:
+        # Older CompImageHDU: the whole image is decompressed
+        return hdu.data[rows, ::step].astype(np.float64)
+    return np.vstack([np.asarray(section[int(row), :])[::step]
+                      for row in rows]).astype(np.float64)
+
+
+def sky_stats(pixels, header, saturate_key='SATURATE', nsigma=3.,
+        niter=5):
+    """Statistics hook measuring the sky level and noise of an image.
+
+    The sky level is the median of the sampled pixels after iterative
+    ``nsigma`` clipping, and the noise is the normalized median absolute
+    deviation of the clipped pixels.
+
+    Parameters
+    ----------
+
+    pixels : ndarray
+        Sampled pixel values, from :func:`sample_pixels`.
+    header : mapping
+        Image header, giving the saturation level.
+    saturate_key : str
+        Header keyword holding the saturation level. If absent, ``sat_frac``
+        is not measured.
+
+    Returns
+    -------
+
+    stats : dict
+        ``sky``, ``sky_rms``, ``sat_frac`` (fraction of sampled pixels at or
+        above saturation) and ``n_sample`` (number of finite pixels
+        sampled).
+    """
+    values = pixels[np.isfinite(pixels)].ravel()
+    stats = {"n_sample": int(values.size)}
+    if values.size == 0:
+        return stats
+    saturate = header.get(saturate_key)
+    if saturate is not None:
+        stats['sat_frac'] = float(np.mean(values >= saturate))
+    clipped = values
+    for i in range(niter):
+        median = np.median(clipped)
+        rms = 1.4826 * np.median(np.abs(clipped - median))
+        if rms == 0.:
+            break
+        keep = np.abs(clipped - median) < nsigma * rms
+        if keep.all():
+            break
+        clipped = clipped[keep]
+    median = np.median(clipped)
+    stats['sky'] = float(median)
+    stats['sky_rms'] = float(1.4826 * np.median(np.abs(clipped - median)))
+    return stats
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A long-running service that ingests new FITS files as they arrive.
+
+:class:`IngestDaemon` watches an archive directory and ingests new or
+modified FITS files into an image log with a
+:class:`moastro.imagelog.MEFImporter`. New files are detected with inotify if
+the optional ``pyinotify`` package is installed, and otherwise by polling.
+Polling only re-lists directories whose modification time changed since the
+last poll.
+
+A file is ingested once its size and modification time have been stable for
+``settle`` seconds (and, with inotify, once it has been closed after
+writing). Documents are built by a pool of worker processes and written to
+MongoDB in micro-batches.
+
+Example::
+
+    importer = WIRCamImporter("m31", "wircam")
+    daemon = IngestDaemon(importer, "/archive/wircam", suffix=".fits.fz")
+    daemon.run()
+
+Classes
+-------
+
+- :class:`IngestDaemon`
+"""
+
+import os
+import time
+import logging
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from .crawler import list_dir
+
+
+class IngestDaemon(object):
+    """Continuously ingest new files under a directory into an image log.
+
+    Parameters
+    ----------
+
+    importer : :class:`moastro.imagelog.MEFImporter`
+        Importer used to build and write image documents.
+    base_dir : str
+        Directory to watch (recursively).
+    suffix : str
+        Suffix of files to import.
+    settle : float
+        Seconds a file's size and modification time must be unchanged
+        before it is ingested.
+    poll_interval : float
+        Seconds between scans of the directory tree when polling, and
+        between checks of pending files.
+    nproc : int
+        Number of worker processes building documents. At most
+        ``2 * nproc`` files are being read at any time.
+    batch_size : int
+        Maximum number of documents per bulk write.
+    batch_wait : float
+        Maximum seconds a built document waits to be written.
+    use_inotify : bool
+        Use inotify when ``pyinotify`` is available. If ``False``, polling
+        is always used. With inotify the tree is still scanned every
+        ``30 * poll_interval`` seconds, to catch files missed while new
+        directories were being added to the watch.
+    """
+    def __init__(self, importer, base_dir, suffix=".fits", settle=5.,
+            poll_interval=10., nproc=2, batch_size=50, batch_wait=2.,
+            use_inotify=True):
+        super(IngestDaemon, self).__init__()
+        self.importer = importer
+        self.base_dir = os.path.abspath(base_dir)
+        self.suffix = (suffix,)
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.nproc = nproc
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.use_inotify = use_inotify and pyinotify is not None
+        self.log = logging.getLogger('moastro')
+
+        # path: (size, mtime) of files that were ingested (or failed)
+        self._known = {}
+        # path: [size, mtime, time of last change] of files being written
+        self._pending = {}
+        # directory: (mtime, subdirs) from the last poll
+        self._dirs = {}
+        # paths reported by inotify, guarded by _lock
+        self._events = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.failures = {}
+        self._metrics = {"ingested": 0, "failed": 0, "batches": 0,
+                "lag_total": 0., "lag_max": 0., "lag_last": 0.,
+                "started": None}
+
+    def run(self, duration=None):
+        """Run the ingest loop until :meth:`stop` is called.
+
+        Files that were already ingested (according to their
+        ``ingest_stat``) are not ingested again when the daemon starts.
+
+        Parameters
+        ----------
+
+        duration : float
+            (optional) Number of seconds to run for.
+        """
+        self._metrics['started'] = time.time()
+        for path, stat in self.importer.load_stat_index(self.base_dir) \
+                .iteritems():
+            if not stat.get('missing', False):
+                self._known[path] = (stat['size'], stat['mtime'])
+        notifier = self._start_inotify()
+        pool = self.importer.worker_pool(self.nproc)
+        inflight = []
+        docs = []
+        lags = []
+        batchStart = None
+        lastPoll = 0.
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                if duration is not None \
+                        and now - self._metrics['started'] > duration:
+                    break
+                # With inotify, an occasional scan catches files written
+                # to new directories before they were watched.
+                interval = self.poll_interval
+                if notifier is not None:
+                    interval *= 30
+                if now - lastPoll > interval:
+                    self._poll()
+                    lastPoll = now
+                self._collect_events()
+
+                # Dispatch settled files, bounding the files in flight
+                for path in self._settled_files(now):
+                    if len(inflight) >= 2 * self.nproc:
+                        break
+                    size, mtime = self._pending.pop(path)[:2]
+                    self._known[path] = (size, mtime)
+                    inflight.append((mtime,
+                        self.importer.build_async(pool, path)))
+
+                # Gather built documents
+                stillRunning = []
+                for mtime, result in inflight:
+                    if not result.ready():
+                        stillRunning.append((mtime, result))
+                        continue
+                    if self._gather(result.get(), mtime, docs, lags) \
+                            and batchStart is None:
+                        batchStart = time.time()
+                inflight = stillRunning
+
+                # Write a micro-batch
+                if len(docs) > 0 and (len(docs) >= self.batch_size
+                        or time.time() - batchStart > self.batch_wait):
+                    self._write(docs, lags)
+                    docs, lags, batchStart = [], [], None
+
+                if len(inflight) == 0 and len(docs) == 0:
+                    self._stop.wait(min(self.settle, self.poll_interval) / 2.)
+                else:
+                    time.sleep(0.05)
+            for mtime, result in inflight:
+                self._gather(result.get(), mtime, docs, lags)
+            self._write(docs, lags)
+        finally:
+            pool.close()
+            pool.join()
+            if notifier is not None:
+                notifier.stop()
+
+    def stop(self):
+        """Stop the ingest loop started by :meth:`run`."""
+        self._stop.set()
+
+    def metrics(self):
+        """Ingest throughput and lag metrics.
+
+        Returns
+        -------
+
+        metrics : dict
+            Dictionary with the number of files ``ingested`` and ``failed``,
+            the number of bulk writes (``batches``), the number of files
+            ``pending`` (being written, or waiting to settle),
+            ``throughput`` (files ingested per second since the daemon
+            started) and the ``lag_mean``, ``lag_max`` and ``lag_last``
+            seconds between a file's last modification and its document
+            being written.
+        """
+        m = self._metrics
+        elapsed = time.time() - (m['started'] or time.time())
+        return {"ingested": m['ingested'], "failed": m['failed'],
+                "batches": m['batches'], "pending": len(self._pending),
+                "throughput": m['ingested'] / elapsed if elapsed > 0 else 0.,
+                "lag_mean": m['lag_total'] / max(m['ingested'], 1),
+                "lag_max": m['lag_max'], "lag_last": m['lag_last']}
+
+    def _gather(self, built, mtime, docs, lags):
+        """Queue a built document for writing, or record its failure.
+        ``True`` if a document was queued.
+        """
+        path, doc, error = built
+        if error is not None:
+            self.log.warning("Could not ingest %s" % path)
+            self.failures[path] = error
+            self._metrics['failed'] += 1
+            return False
+        docs.append(doc)
+        lags.append(mtime)
+        return True
+
+    def _write(self, docs, mtimes):
+        """Write a batch of documents and update the lag metrics."""
+        if len(docs) == 0:
+            return
+        self.importer.write_documents(docs)
+        now = time.time()
+        m = self._metrics
+        m['batches'] += 1
+        for mtime in mtimes:
+            lag = now - mtime
+            m['ingested'] += 1
+            m['lag_total'] += lag
+            m['lag_max'] = max(m['lag_max'], lag)
+            m['lag_last'] = lag
+        self.log.info("Ingested %i files; lag %.1f s" % (len(docs),
+                m['lag_last']))
+
+    def _settled_files(self, now):
+        """Update pending files and list those that stopped changing."""
+        settled = []
+        for path, state in list(self._pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._pending[path]  # removed before it settled
+                continue
+            if (st.st_size, st.st_mtime) != (state[0], state[1]):
+                self._pending[path] = [st.st_size, st.st_mtime, now]
+            elif now - state[2] >= self.settle:
+                settled.append(path)
+        return settled
+
+    def _add_candidate(self, path, now):
+        """Track a new or changed file until it settles."""
+        if path in self._pending:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if self._known.get(path) == (st.st_size, st.st_mtime):
+            return
+        self._pending[path] = [st.st_size, st.st_mtime, now]
+
+    def _poll(self):
+        """Scan the tree, re-listing only directories that changed."""
+        now = time.time()
+        stack = [self.base_dir]
+        seen = set()
+        while len(stack) > 0:
+            d = stack.pop()
+            seen.add(d)
+            try:
+                mtime = os.stat(d).st_mtime
+            except OSError:
+                continue
+            cached = self._dirs.get(d)
+            if cached is not None and cached[0] == mtime:
+                stack.extend(cached[1])
+                continue
+            files, subdirs = list_dir(d, self.suffix)
+            self._dirs[d] = (mtime, subdirs)
+            for path in files:
+                self._add_candidate(path, now)
+            stack.extend(subdirs)
+        for d in list(self._dirs.keys()):
+            if d not in seen:
+                del self._dirs[d]
+
+    def _collect_events(self):
+        """Move paths reported by inotify into the pending set."""
+        with self._lock:
+            events = self._events
+            self._events = set()
+        now = time.time()
+        for path in events:
+            self._add_candidate(path, now)
+
+    def _start_inotify(self):
+        """Start an inotify watch thread, or return ``None`` if unavailable.
+        """
+        if not self.use_inotify:
+            return None
+        daemon = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.dir or not event.pathname.endswith(daemon.suffix):
+                    return
+                with daemon._lock:
+                    daemon._events.add(event.pathname)
+
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        notifier = pyinotify.ThreadedNotifier(wm, Handler())
+        notifier.daemon = True
+        notifier.start()
+        wm.add_watch(self.base_dir, mask, rec=True, auto_add=True)
+        return notifier
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Run multi-stage processing of an image log as a dependency graph.
+
+A :class:`Pipeline` is made of :class:`Stage` instances, each declaring the
+image log fields it reads (``inputs``) and writes (``outputs``). A stage runs
+once per image, or once per group of images. The pipeline expands stages into
+units of work, and a unit depends on the units of earlier stages that write
+its inputs for its images. Units start as soon as their own dependencies are
+met, so e.g. PSFex can model the PSF of one group while Source Extractor is
+still running on images of another group.
+
+Units whose outputs are already in the image log are not run again, so an
+interrupted pipeline resumes where it stopped. Stages for the astromatic.net
+tools are made by :func:`moastro.astromatic.source_extractor_stage`,
+:func:`moastro.astromatic.psfex_stage`, :func:`moastro.astromatic.scamp_stage`
+and :func:`moastro.astromatic.swarp_stage`::
+
+    pipeline = Pipeline(imagelog, imageKeys, [
+        source_extractor_stage("se", "path", "cat0"),
+        psfex_stage("psfex", "cat0", "psf", group_by="FILTER"),
+        source_extractor_stage("se_psf", "path", "cat", psfKey="psf",
+                               catPostfix="psf_cat"),
+        scamp_stage("scamp", "cat", "scamp", group_by="FILTER"),
+        swarp_stage("swarp", "path", "mosaic", group_by="FILTER",
+                    scampHeadKey="scamp")])
+    failures = pipeline.run()
+
+Classes
+-------
+
+- :class:`Pipeline`
+- :class:`Stage`
+"""
+
+import logging
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+class Stage(object):
+    """A step of a :class:`Pipeline`, defined by the image log fields it
+    reads and writes.
+
+    Parameters
+    ----------
+
+    name : str
+        Name of the stage.
+    run : callable
+        Called as ``run(imageLog, unitName, imageKeys, executor)`` to process
+        one unit of work: a single image (``unitName`` is its image key) or a
+        group of images (``unitName`` is the group name). It writes the
+        ``outputs`` fields of those images to the image log. An exception
+        marks the unit as failed.
+    inputs : list
+        Fields every image of a unit needs before the unit can run.
+    outputs : list
+        Fields the stage writes for every image of a unit. A unit whose
+        images all have these fields is done.
+    group_by : str or dict
+        (optional) If ``None`` the stage runs once per image. If a field
+        name, images with the same value of that field are processed
+        together. A dict maps group names to image keys.
+    """
+    def __init__(self, name, run, inputs=None, outputs=None, group_by=None):
+        super(Stage, self).__init__()
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.group_by = group_by
+
+
+class _Unit(object):
+    """One run of a stage, on one image or group of images."""
+    def __init__(self, stage, name, imageKeys):
+        self.stage = stage
+        self.name = name
+        self.imageKeys = list(imageKeys)
+        self.key = (stage.name, name)
+        self.deps = set()
+
+
+class Pipeline(object):
+    """Run stages over images of an image log, following the dependencies
+    between the image log fields they read and write.
+
+    Parameters
+    ----------
+
+    imageLog : :class:`moastro.imagelog.ImageLog`
+        The image log.
+    imageKeys : list
+        Images to process.
+    stages : list
+        :class:`Stage` instances, in the order of the processing chain. A
+        stage only depends on earlier stages.
+    executor : :class:`moastro.executor.JobExecutor`
+        (optional) Executor passed to the stages for running programs.
+    nthreads : int
+        Maximum number of units running at once. Programs are further
+        limited by the executor's CPU and memory budget.
+    """
+    def __init__(self, imageLog, imageKeys, stages, executor=None,
+            nthreads=multiprocessing.cpu_count()):
+        super(Pipeline, self).__init__()
+        self.imageLog = imageLog
+        self.imageKeys = list(imageKeys)
+        self.stages = list(stages)
+        self.executor = executor
+        self.nthreads = nthreads
+        self.log = logging.getLogger('moastro')
+        self._docs = {}
+
+    def run(self, force=False):
+        """Run all units that are not done.
+
+        Parameters
+        ----------
+
+        force : bool
+            If ``True``, units are run even if their outputs exist.
+
+        Returns
+        -------
+
+        failures : dict
+            Errors keyed by ``(stageName, unitName)``, for units that
+            failed and for units that could not run because their inputs
+            were never produced.
+        """
+        self._refresh(self.imageKeys)
+        units = self._make_units()
+        pending = [u for u in units if force or not self._is_done(u)]
+        self._link(pending)
+
+        failures = {}
+        finished = queue.Queue()
+        running = set()
+        pool = ThreadPool(processes=self.nthreads)
+        try:
+            while True:
+                for unit in list(pending):
+                    if len(unit.deps) > 0 or not self._has_inputs(unit):
+                        continue
+                    pending.remove(unit)
+                    running.add(unit)
+                    self.log.info("Starting %s %s" % unit.key)
+                    pool.apply_async(self._run_unit, (unit,),
+                            callback=finished.put)
+                if len(running) == 0:
+                    break
+                unit, error = finished.get()
+                running.discard(unit)
+                if error is not None:
+                    self.log.warning("%s %s failed" % unit.key)
+                    failures[unit.key] = error
+                    continue
+                self._refresh(unit.imageKeys)
+                for other in pending:
+                    other.deps.discard(unit)
+        finally:
+            pool.close()
+            pool.join()
+        for unit in pending:
+            failures[unit.key] = "Inputs were not produced"
+        return failures
+
+    def _run_unit(self, unit):
+        """Run a unit in a pool thread, returning ``(unit, error)``."""
+        try:
+            unit.stage.run(self.imageLog, unit.name, unit.imageKeys,
+                    self.executor)
+        except Exception:
+            return unit, traceback.format_exc()
+        return unit, None
+
+    def _fields(self):
+        """All fields read or written by the stages."""
+        fields = set()
+        for stage in self.stages:
+            fields.update(stage.inputs)
+            fields.update(stage.outputs)
+            if isinstance(stage.group_by, basestring):
+                fields.add(stage.group_by)
+        return list(fields)
+
+    def _refresh(self, imageKeys):
+        """Re-read the pipeline's fields of these images."""
+        docs = self.imageLog.find_dict({}, images=list(imageKeys),
+                fields=self._fields())
+        self._docs.update(docs)
+
+    def _make_units(self):
+        """Expand the stages into units of work."""
+        units = []
+        for stage in self.stages:
+            if stage.group_by is None:
+                groups = [(k, [k]) for k in self.imageKeys]
+            elif isinstance(stage.group_by, dict):
+                groups = sorted(stage.group_by.items())
+            else:
+                byValue = {}
+                for k in self.imageKeys:
+                    value = _get_field(self._docs.get(k, {}), stage.group_by)
+                    byValue.setdefault(value, []).append(k)
+                groups = sorted(byValue.items())
+            for name, imageKeys in groups:
+                units.append(_Unit(stage, name, imageKeys))
+        return units
+
+    def _link(self, units):
+        """Make each unit depend on the earlier units writing its inputs
+        for any of its images.
+        """
+        writers = {}  # (imageKey, field): units writing it
+        for unit in units:
+            for imageKey in unit.imageKeys:
+                for field in unit.stage.inputs:
+                    unit.deps.update(writers.get((imageKey, field), ()))
+            for imageKey in unit.imageKeys:
+                for field in unit.stage.outputs:
+                    writers.setdefault((imageKey, field), []).append(unit)
+
+    def _has_inputs(self, unit):
+        return all(_has_field(self._docs.get(k, {}), field)
+                   for k in unit.imageKeys for field in unit.stage.inputs)
+
+    def _is_done(self, unit):
+        if len(unit.stage.outputs) == 0:
+            return False
+        return all(_has_field(self._docs.get(k, {}), field)
+                   for k in unit.imageKeys for field in unit.stage.outputs)
+
+
+def _get_field(doc, key):
+    """Value of a dotted field of a document, or ``None``."""
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _has_field(doc, key):
+    return _get_field(doc, key) is not None
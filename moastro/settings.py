@@ -17,6 +17,19 @@ A basic ``.moastro.json`` file looks like this::
 Server definitions are stored as a hash under the ``servers`` key. Here we
 define one server named ``marvin`` that is connected to as ``localhost:27017``.
 
+Options for the PyMongo client, such as connection pool sizes and
+timeouts, can be set under a ``client`` key, either at the top level (applying
+to all servers) or within a server definition (overriding the top level)::
+
+    {"servers":
+        {"marvin": {"url": "localhost", "port": 27017,
+                    "client": {"maxPoolSize": 20}}},
+     "client": {"connectTimeoutMS": 5000, "socketTimeoutMS": 60000}
+    }
+
+The ``client`` options are passed as keyword arguments to
+:class:`pymongo.MongoClient`, so they follow that class's naming.
+
 In the future we will add ``remote_url`` and ``remote_port`` to the settings
 schema to facilitate SSH port forwarding.
 
@@ -26,6 +39,7 @@ Functions
 
 - :func:`read_settings`
 - :func:`locate_server`
+- :func:`client_options`
 """
 
 import os
@@ -87,3 +101,27 @@ def locate_server(servername):
         url = 'localhost'  # try defaults
         port = 27017
     return url, port
+
+
+def client_options(servername=None):
+    """Return the PyMongo client options for a named server.
+
+    Parameters
+    ----------
+
+    servername : str
+        Name of the server, matching that in the ``.moastro.json`` file.
+        If ``None``, only the top-level ``client`` options are returned.
+
+    Returns
+    -------
+
+    options : dict
+        Keyword arguments for :class:`pymongo.MongoClient`.
+    """
+    conf = read_settings()
+    options = dict(conf.get('client', {}))
+    if servername is not None:
+        server = conf.get('servers', {}).get(servername, {})
+        options.update(server.get('client', {}))
+    return options
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Stage the inputs of external programs on fast local storage.
+
+Programs such as Source Extractor and Swarp read their inputs many times, and
+reading them from a network filesystem stalls the runs. A
+:class:`ScratchSpace` keeps local copies of input files in a scratch
+directory (a local disk or a tmpfs), decompressing ``.fz`` tile-compressed
+images on the way. Its size is capped: copies that are not in use are evicted
+least recently used first.
+
+A :class:`Stager` copies upcoming inputs ahead of time, keeping a bounded
+number of prefetched files, and moves outputs written to the scratch
+directory back to their final location in background threads. Final paths
+are then written to the image log::
+
+    stager = Stager(ScratchSpace("/scratch/moastro", max_bytes=50e9))
+    batch = BatchSourceExtractor(imagelog, imageKeys, "path", "cat")
+    failures = batch.run(stager=stager)
+
+Classes
+-------
+
+- :class:`ScratchSpace`
+- :class:`Stager`
+
+Functions
+---------
+
+- :func:`decompress_fits`
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import traceback
+import collections
+from multiprocessing.pool import ThreadPool
+
+from .fileops import copy_file, relocate_file, file_size
+
+
+class _Entry(object):
+    """A file staged in a :class:`ScratchSpace`."""
+    def __init__(self, path, size, state):
+        self.path = path
+        self.size = size
+        self.state = state
+        self.pins = 0
+        self.ready = False
+
+
+class ScratchSpace(object):
+    """Local copies of input files, capped in size with least recently used
+    eviction.
+
+    Copies are pinned while they are used (see :meth:`acquire_all` and
+    :meth:`release`), and only unpinned copies are evicted. When the cap is
+    reached and every copy is pinned, :meth:`acquire_all` waits for copies
+    to be released. Files larger than the cap are used from their source
+    instead of being staged.
+
+    A copy keeps the file name of its source (without a ``.fz`` suffix), so
+    that programs name their outputs as they would for the source. It is
+    made again if the source's size or modification time changes.
+
+    Parameters
+    ----------
+
+    path : str
+        (optional) Scratch directory. Defaults to ``$MOASTROSCRATCH``, or a
+        new directory in the system's temporary directory.
+    max_bytes : float
+        (optional) Maximum total size of the staged copies, in bytes.
+        ``None`` means unlimited.
+    """
+    def __init__(self, path=None, max_bytes=None):
+        super(ScratchSpace, self).__init__()
+        if path is None:
+            path = os.getenv('MOASTROSCRATCH')
+        if path is None:
+            path = tempfile.mkdtemp(prefix="moastro-scratch-")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # source path: _Entry
+        self._bytes = 0
+        self._cond = threading.Condition()
+
+    @property
+    def nbytes(self):
+        """Total size of the staged copies, in bytes."""
+        with self._cond:
+            return self._bytes
+
+    def local_path(self, src):
+        """Path of the local copy of ``src``."""
+        src = os.path.abspath(src)
+        digest = hashlib.sha1(os.path.dirname(src).encode('utf-8'))
+        name = os.path.basename(src)
+        if name.endswith('.fz'):
+            name = name[:-3]
+        return os.path.join(self.path, "in", digest.hexdigest()[:12], name)
+
+    def acquire(self, src):
+        """Stage a file and pin its local copy.
+
+        Parameters
+        ----------
+
+        src : str
+            Path of the source file.
+
+        Returns
+        -------
+
+        path : str
+            Path of the local copy, or ``src`` itself if the file is larger
+            than the scratch space. Call :meth:`release` with ``src`` when
+            it is no longer used.
+        """
+        return self.acquire_all([src]).get(src, src)
+
+    def acquire_all(self, srcs):
+        """Stage files used together and pin their local copies.
+
+        Room is reserved for all the files at once: the call waits until
+        they all fit, without pinning any of them while it waits, so runs
+        holding their inputs never wait on each other. Files whose total
+        size is larger than the scratch space are not staged.
+
+        Parameters
+        ----------
+
+        srcs : list
+            Paths of the source files.
+
+        Returns
+        -------
+
+        staged : dict
+            Paths of the local copies, keyed by source path. Empty if the
+            files do not fit in the scratch space, in which case they are
+            used from their source. Call :meth:`release` with each staged
+            source when it is no longer used.
+        """
+        states = collections.OrderedDict()  # absolute source path: state
+        names = {}
+        for src in srcs:
+            path = os.path.abspath(src)
+            st = os.stat(path)
+            states[path] = (st.st_size, st.st_mtime)
+            names[path] = src
+        if self.max_bytes is not None \
+                and sum(size for size, mtime in states.values()) \
+                > self.max_bytes:
+            return {}
+        copies = []
+        with self._cond:
+            while not self._reserve(states, copies):
+                self._cond.wait()
+            staged = dict((names[path], self._entries[path].path)
+                          for path in states)
+
+        try:
+            for path, entry in copies:
+                self._copy(path, entry)
+        except:
+            with self._cond:
+                for path, entry in copies:
+                    if not entry.ready:
+                        del self._entries[path]
+                        self._bytes -= entry.size
+                for path in states:
+                    entry = self._entries.get(path)
+                    if entry is not None and entry.pins > 0:
+                        entry.pins -= 1
+                self._cond.notify_all()
+            raise
+        return staged
+
+    def release(self, src):
+        """Unpin the local copy of ``src``, making it evictable."""
+        src = os.path.abspath(src)
+        with self._cond:
+            entry = self._entries.get(src)
+            if entry is not None and entry.pins > 0:
+                entry.pins -= 1
+                self._cond.notify_all()
+
+    def clear(self):
+        """Remove all unpinned copies."""
+        with self._cond:
+            for src in list(self._entries):
+                entry = self._entries[src]
+                if entry.pins == 0 and entry.ready:
+                    self._evict(src)
+
+    def _reserve(self, states, copies):
+        """Pin the copies of all the sources in ``states`` if they fit,
+        adding entries for the sources to copy to ``copies``. ``False`` if
+        the sources must wait for room, or for another thread staging them.
+        Called with the lock held.
+        """
+        size = 0
+        for src, state in states.items():
+            entry = self._entries.get(src)
+            if entry is not None and entry.state != state:
+                if entry.pins > 0 or not entry.ready:
+                    return False  # the old copy is still in use
+                self._evict(src)  # the source changed
+                entry = None
+            if entry is None:
+                size += state[0]
+            elif not entry.ready:
+                return False
+        if not self._make_room(size, keep=states):
+            return False
+        for src, state in states.items():
+            entry = self._entries.get(src)
+            if entry is None:
+                entry = _Entry(self.local_path(src), state[0], state)
+                self._entries[src] = entry
+                self._bytes += entry.size
+                copies.append((src, entry))
+            else:
+                self._touch(src)
+            entry.pins += 1
+        return True
+
+    def _copy(self, src, entry):
+        """Write the local copy of a reserved entry."""
+        directory = os.path.dirname(entry.path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        tmpPath = entry.path + ".part"
+        if src.endswith('.fz'):
+            decompress_fits(src, tmpPath)
+        else:
+            copy_file(src, tmpPath)
+        os.rename(tmpPath, entry.path)
+        with self._cond:
+            size = file_size(entry.path)
+            self._bytes += size - entry.size
+            entry.size = size
+            entry.ready = True
+            self._cond.notify_all()
+
+    def _touch(self, src):
+        """Mark a copy as most recently used."""
+        self._entries[src] = self._entries.pop(src)
+
+    def _make_room(self, size, keep=()):
+        """Evict unpinned copies, least recently used first and except those
+        of the sources in ``keep``, until ``size`` more bytes fit. ``True``
+        if they fit.
+        """
+        if self.max_bytes is None:
+            return True
+        for src in list(self._entries):
+            if self._bytes + size <= self.max_bytes:
+                break
+            entry = self._entries[src]
+            if entry.pins == 0 and entry.ready and src not in keep:
+                self._evict(src)
+        return self._bytes + size <= self.max_bytes
+
+    def _evict(self, src):
+        entry = self._entries.pop(src)
+        self._bytes -= entry.size
+        if os.path.exists(entry.path):
+            os.remove(entry.path)
+
+
+class Stager(object):
+    """Prefetch inputs into a :class:`ScratchSpace` and move outputs back
+    asynchronously.
+
+    Inputs announced with :meth:`prefetch` are staged in background threads,
+    in order, with at most ``depth`` staged files waiting to be used. A
+    prefetched file is unpinned until :meth:`acquire` is called, so it can
+    still be evicted if the scratch space runs short.
+
+    :meth:`finish` removes all the output directories of the stager, so a
+    stager serves one batch at a time; concurrent batches can share a
+    :class:`ScratchSpace` through stagers of their own.
+
+    Parameters
+    ----------
+
+    scratch : :class:`ScratchSpace`
+        Where the inputs are staged and the outputs written.
+    depth : int
+        Maximum number of prefetched files waiting to be used.
+    nthreads : int
+        Number of threads copying inputs, and number of threads moving
+        outputs back.
+    """
+    def __init__(self, scratch, depth=4, nthreads=2):
+        super(Stager, self).__init__()
+        self.scratch = scratch
+        self.depth = depth
+        self.nthreads = nthreads
+        self._lock = threading.Lock()
+        self._upcoming = collections.deque()
+        self._inflight = {}  # source path: AsyncResult of its prefetch
+        self._stagePool = None
+        self._movePool = None
+        self._moved = {}  # imageKey: {key: final path}
+        self._failures = {}
+        self._outputDirs = []
+
+    def prefetch(self, paths):
+        """Announce inputs, in the order they will be acquired. ``None``
+        paths are ignored.
+        """
+        with self._lock:
+            self._upcoming.extend(os.path.abspath(p) for p in paths
+                                  if p is not None)
+            self._fill()
+
+    def acquire(self, src):
+        """Local copy of an input (see :meth:`acquire_all`), or ``src``
+        itself if it is larger than the scratch space. Call :meth:`release`
+        when it is no longer used.
+        """
+        return self.acquire_all([src]).get(src, src)
+
+    def acquire_all(self, srcs):
+        """Local copies of the inputs of a run, reserved together (see
+        :meth:`ScratchSpace.acquire_all`), waiting for their prefetches if
+        they are running.
+
+        Returns
+        -------
+
+        staged : dict
+            Paths of the local copies, keyed by source path. Inputs missing
+            from it are used from their source. Call :meth:`release` with
+            each staged source when it is no longer used.
+        """
+        prefetched = []
+        with self._lock:
+            for src in srcs:
+                path = os.path.abspath(src)
+                if path in self._inflight:
+                    prefetched.append(self._inflight.pop(path))
+                if path in self._upcoming:
+                    self._upcoming.remove(path)
+        for result in prefetched:
+            result.wait()  # errors are raised again by acquire_all()
+        try:
+            return self.scratch.acquire_all(srcs)
+        finally:
+            with self._lock:
+                self._fill()
+
+    def cancel(self, srcs):
+        """Withdraw announced inputs that will not be acquired, e.g. those
+        of a run that is skipped or fails before staging its inputs, so
+        that they stop taking prefetch slots. ``None`` paths are ignored.
+        """
+        with self._lock:
+            for src in srcs:
+                if src is None:
+                    continue
+                path = os.path.abspath(src)
+                self._inflight.pop(path, None)
+                if path in self._upcoming:
+                    self._upcoming.remove(path)
+            self._fill()
+
+    def release(self, src):
+        """Unpin the local copy of an input."""
+        self.scratch.release(src)
+
+    def output_dir(self, name):
+        """A new local directory for the outputs of a run. It is removed by
+        :meth:`finish`.
+        """
+        root = os.path.join(self.scratch.path, "out")
+        if not os.path.exists(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+        path = tempfile.mkdtemp(prefix=str(name) + "-", dir=root)
+        with self._lock:
+            self._outputDirs.append(path)
+        return path
+
+    def move_back(self, localPath, finalPath, imageKey=None, key=None):
+        """Move an output to its final location in a background thread.
+
+        Parameters
+        ----------
+
+        localPath : str
+            Path of the output in the scratch space.
+        finalPath : str
+            Destination path.
+        imageKey : str
+            (optional) Image whose `key` field is set to ``finalPath`` by
+            :meth:`flush` once the file is moved.
+        key : str
+            (optional) Image log field of the output.
+        """
+        return self.move_all([(localPath, finalPath, key)], imageKey=imageKey)
+
+    def move_all(self, moves, imageKey=None, callback=None):
+        """Move the outputs of a run to their final location in a
+        background thread (see :meth:`move_back`).
+
+        Parameters
+        ----------
+
+        moves : list
+            ``(localPath, finalPath, key)`` tuples; ``key`` is the image log
+            field of the output, or ``None``.
+        imageKey : str
+            (optional) Image whose fields are set by :meth:`flush` once the
+            files are moved.
+        callback : callable
+            (optional) Called without arguments once all the files are
+            moved, e.g. to record the fingerprint of the run against its
+            final outputs.
+        """
+        with self._lock:
+            if self._movePool is None:
+                self._movePool = ThreadPool(processes=self.nthreads)
+            pool = self._movePool
+        return pool.apply_async(self._move, (moves, imageKey, callback))
+
+    def flush(self, imageLog):
+        """Write the final paths of the outputs moved so far to the image
+        log.
+        """
+        with self._lock:
+            moved = self._moved
+            self._moved = {}
+        if len(moved) > 0:
+            imageLog.set_images(moved)
+
+    def finish(self, imageLog=None):
+        """Wait for all outputs to be moved back, write their final paths to
+        the image log and remove the output directories. Inputs announced
+        but not acquired are withdrawn, and the stager's threads are
+        stopped.
+
+        Returns
+        -------
+
+        failures : dict
+            Errors of the outputs that could not be moved, keyed by image
+            key (or by local path for outputs without an image key).
+        """
+        with self._lock:
+            self._upcoming.clear()
+            self._inflight = {}
+            pools = [self._stagePool, self._movePool]
+            self._stagePool = None
+            self._movePool = None
+        for pool in pools:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if imageLog is not None:
+            self.flush(imageLog)
+        with self._lock:
+            failures = self._failures
+            self._failures = {}
+            outputDirs = self._outputDirs
+            self._outputDirs = []
+        for path in outputDirs:
+            shutil.rmtree(path, ignore_errors=True)
+        return failures
+
+    def _fill(self):
+        """Start prefetching upcoming inputs, up to ``depth``. Called with
+        the lock held.
+        """
+        while len(self._inflight) < self.depth and len(self._upcoming) > 0:
+            src = self._upcoming.popleft()
+            if src in self._inflight:
+                continue
+            if self._stagePool is None:
+                self._stagePool = ThreadPool(processes=self.nthreads)
+            self._inflight[src] = self._stagePool.apply_async(
+                self._prefetch_one, (src,))
+
+    def _prefetch_one(self, src):
+        for path in self.scratch.acquire_all([src]):
+            self.scratch.release(path)
+
+    def _move(self, moves, imageKey, callback):
+        localPath = None
+        try:
+            for localPath, finalPath, key in moves:
+                directory = os.path.dirname(os.path.abspath(finalPath))
+                if not os.path.exists(directory):
+                    try:
+                        os.makedirs(directory)
+                    except OSError:
+                        if not os.path.isdir(directory):
+                            raise
+                relocate_file(localPath, finalPath)
+                if imageKey is not None and key is not None:
+                    with self._lock:
+                        self._moved.setdefault(imageKey, {})[key] = finalPath
+            if callback is not None:
+                callback()
+        except Exception:
+            with self._lock:
+                self._failures[imageKey or localPath] = traceback.format_exc()
+
+
+def decompress_fits(src, dst):
+    """Write an uncompressed copy of a tile-compressed (``.fz``) FITS file.
+
+    Parameters
+    ----------
+
+    src : str
+        Path of the compressed FITS file.
+    dst : str
+        Path of the uncompressed copy.
+    """
+    try:
+        from astropy.io import fits
+    except ImportError:
+        import pyfits as fits
+    hdulist = fits.open(src)
+    try:
+        hdus = [fits.PrimaryHDU(data=hdulist[0].data,
+                                header=hdulist[0].header)]
+        for hdu in hdulist[1:]:
+            if isinstance(hdu, fits.CompImageHDU):
+                hdu = fits.ImageHDU(data=hdu.data, header=hdu.header)
+            hdus.append(hdu)
+        fits.HDUList(hdus).writeto(dst)
+    finally:
+        hdulist.close()
@@ -0,0 +1,353 @@
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import pytest
+
+from .. import astromatic
+from ..astromatic import Astromatic, BatchSourceExtractor, \
+    SourceExtractor, Swarp, TiledSwarp, _allocate_fits_image, pyfits
+from ..executor import CostModel, JobExecutor, JobResult
+from ..staging import ScratchSpace, Stager
+
+
+class _Tool(Astromatic):
+    def __init__(self, outputs):
+        super(_Tool, self).__init__()
+        self.outputs = outputs
+
+    def output_paths(self):
+        return self.outputs
+
+
+def test_fingerprints_of_tools_sharing_a_stem():
+    tmp = tempfile.mkdtemp()
+    catalog = os.path.join(tmp, "image.cat")
+    mosaic = os.path.join(tmp, "image.fits")
+    for path in (catalog, mosaic):
+        with open(path, 'w') as f:
+            f.write("data")
+    sex = _Tool([catalog])
+    swarp = _Tool([mosaic])
+    assert sex.fingerprint_path("sex") \
+        == os.path.join(tmp, "image.sex.fingerprint.json")
+    assert swarp.fingerprint_path("swarp") \
+        == os.path.join(tmp, "image.swarp.fingerprint.json")
+
+    sex.save_fingerprint("a", "sex")
+    swarp.save_fingerprint("b", "swarp")
+    assert sex.is_current("a", "sex")
+    assert swarp.is_current("b", "swarp")
+    assert not swarp.is_current("a", "swarp")
+
+
+class _ImageLog(object):
+    def __init__(self, docs, exts=("0",)):
+        self.docs = docs
+        self.exts = list(exts)
+        self.updates = []
+
+    def find_dict(self, selector, images=None, fields=None):
+        return dict((k, self.docs[k]) for k in images if k in self.docs)
+
+    def set_images(self, updates):
+        self.updates.append(updates)
+
+
+def test_batch_source_extractor_reads_dotted_keys(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    imagePath = os.path.join(tmp, "a.fits")
+    weightPath = os.path.join(tmp, "a.weight.fits")
+    for path in (imagePath, weightPath):
+        with open(path, 'w') as f:
+            f.write("data")
+    calls = []
+
+    def work(args):
+        calls.append(args)
+        return {"image": args[0], "catalog": "a.cat", "checks": {},
+                "error": None, "skipped": False, "wall_time": 1.}
+
+    monkeypatch.setattr(astromatic, "_workSE", work)
+    log = _ImageLog({"a": {"stack": {"path": imagePath,
+                                     "weight": weightPath}}})
+    batch = BatchSourceExtractor(log, ["a"], "stack.path", "cat",
+                                 weightKey="stack.weight", workDir=tmp)
+    costModel = CostModel(path=os.path.join(tmp, "rates.json"))
+    failures = batch.run(debug=True, costModel=costModel)
+    assert failures == {}
+    assert [c[1:3] for c in calls] == [(imagePath, weightPath)]
+    assert log.updates == [{"a": {"cat": "a.cat"}}]
+
+
+def test_batch_source_extractor_reads_pixels_from_log(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    paths = {}
+    for name in ("a", "b"):
+        paths[name] = os.path.join(tmp, name + ".fits")
+        with open(paths[name], 'w') as f:
+            f.write("data")
+    scanned = []
+    monkeypatch.setattr(astromatic, "image_pixels",
+                        lambda path: scanned.append(path) or 10)
+    calls = []
+
+    def work(args):
+        calls.append(args[0])
+        return {"image": args[0], "catalog": "cat", "checks": {},
+                "error": None, "skipped": False, "wall_time": 1.}
+
+    monkeypatch.setattr(astromatic, "_workSE", work)
+    log = _ImageLog({"a": {"path": paths["a"],
+                           "1": {"NAXIS1": 100, "NAXIS2": 100},
+                           "2": {"NAXIS1": 100, "NAXIS2": 100}},
+                     "b": {"path": paths["b"]}}, exts=["1", "2"])
+    batch = BatchSourceExtractor(log, ["b", "a"], "path", "cat",
+                                 workDir=tmp)
+    costModel = CostModel(path=os.path.join(tmp, "rates.json"))
+    assert batch.run(nthreads=2, costModel=costModel) == {}
+    assert scanned == [paths["b"]]
+    assert astromatic.logged_pixels(log.docs["a"], log.exts) == 20000
+    assert astromatic.logged_pixels({"NAXIS1": 5, "NAXIS2": 4}, ["0"]) == 20
+
+
+def _target_header(nx, ny):
+    header = pyfits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = 150.
+    header['CRVAL2'] = 2.
+    header['CRPIX1'] = 125.5
+    header['CRPIX2'] = 65.5
+    header['CD1_1'] = -1e-4
+    header['CD2_2'] = 1e-4
+    return header
+
+
+def test_tiles_split_target_header():
+    tiled = TiledSwarp(None, _target_header(250, 130), "path", "field.fits",
+                       tileSize=(100, 100), overlap=10, workDir="mosaic")
+    tiles = dict((t['name'], t) for t in tiled.tiles())
+    assert sorted(tiles) == ["field_%i_%i" % (i, j)
+                             for i in range(3) for j in range(2)]
+    first = tiles["field_0_0"]
+    assert first['core'] == (0, 100, 0, 100)
+    assert first['extent'] == (0, 110, 0, 110)
+    assert first['header']['CRPIX1'] == 125.5
+    middle = tiles["field_1_1"]
+    assert middle['core'] == (100, 200, 100, 130)
+    assert middle['extent'] == (90, 210, 90, 130)
+    assert (middle['header']['NAXIS1'], middle['header']['NAXIS2']) \
+        == (120, 40)
+    assert middle['header']['CRPIX1'] == 125.5 - 90
+    assert middle['header']['CRPIX2'] == 65.5 - 90
+    last = tiles["field_2_1"]
+    assert last['core'] == (200, 250, 100, 130)
+    assert last['extent'] == (190, 250, 90, 130)
+    assert tiled.targetHeader['NAXIS1'] == 250
+
+
+def test_assemble_tiles_round_trip():
+    workDir = tempfile.mkdtemp()
+    target = _target_header(250, 130)
+    image = np.arange(250 * 130, dtype=np.float32).reshape(130, 250)
+    tiled = TiledSwarp(None, target, "path", "field", tileSize=(100, 100),
+                       overlap=10, workDir=workDir)
+    for tile in tiled.tiles():
+        if tile['name'] == "field_2_0":
+            continue  # a tile without inputs
+        ex0, ex1, ey0, ey1 = tile['extent']
+        tileDir = os.path.join(workDir, tile['name'])
+        os.makedirs(tileDir)
+        # Overlaps hold values that must not reach the mosaic
+        data = image[ey0:ey1, ex0:ex1] + 0.5
+        x0, x1, y0, y1 = tile['core']
+        data[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0] -= 0.5
+        pyfits.PrimaryHDU(data).writeto(
+            os.path.join(tileDir, tile['name'] + ".fits"))
+    path, weightPath = tiled.assemble(weightPath=False)
+    assert weightPath is None
+    assert os.path.getsize(path) % 2880 == 0
+    mosaic = pyfits.open(path)
+    expected = image.copy()
+    expected[0:100, 200:250] = 0.
+    assert np.all(mosaic[0].data == expected)
+    assert mosaic[0].header['CRPIX1'] == 125.5
+    assert mosaic[0].header['CTYPE1'] == 'RA---TAN'
+    mosaic.close()
+
+
+def test_allocate_fits_image_is_sparse():
+    path = os.path.join(tempfile.mkdtemp(), "mosaic.fits")
+    data = _allocate_fits_image(path, _target_header(1000, 1001))
+    assert data.shape == (1001, 1000)
+    data[0, 0] = 1.
+    data[-1, -1] = 2.
+    data.flush()
+    del data
+    st = os.stat(path)
+    assert st.st_size % 2880 == 0
+    assert st.st_size >= 1000 * 1001 * 4
+    assert st.st_blocks * 512 < st.st_size
+    mosaic = pyfits.open(path)
+    assert mosaic[0].data[0, 0] == 1.
+    assert mosaic[0].data[-1, -1] == 2.
+    assert mosaic[0].data.sum() == 3.
+    mosaic.close()
+
+
+def _swarp(workDir, configs=None):
+    swarp = Swarp([os.path.join(workDir, "a.fits"),
+                   os.path.join(workDir, "b.fits")], "field",
+                  configs=configs, workDir=workDir)
+    swarp.set_target_header(_target_header(250, 130))
+    return swarp
+
+
+def test_target_fingerprint():
+    workDir = tempfile.mkdtemp()
+    swarp = Swarp([], "field", workDir=workDir)
+    with pytest.raises(ValueError):
+        swarp.target_fingerprint()
+    swarp = _swarp(workDir)
+    fingerprint = swarp.target_fingerprint()
+    # Non-WCS keywords and combine configs do not change the grid
+    header = _target_header(250, 130)
+    header['OBJECT'] = 'field'
+    swarp.set_target_header(header)
+    swarp.configs = {"COMBINE_TYPE": "MEDIAN"}
+    assert swarp.target_fingerprint() == fingerprint
+    swarp.configs = {"RESAMPLING_TYPE": "NEAREST"}
+    assert swarp.target_fingerprint() != fingerprint
+    swarp.configs = None
+    header['CRPIX1'] = 10.
+    swarp.set_target_header(header)
+    assert swarp.target_fingerprint() != fingerprint
+
+
+def test_is_wcs_key():
+    for key in ('NAXIS1', 'CTYPE1', 'CRVAL2', 'CRPIX1', 'CD1_1', 'PC2_1',
+                'PV1_10', 'RADESYS', 'EQUINOX'):
+        assert astromatic._is_wcs_key(key)
+    for key in ('NAXIS', 'OBJECT', 'EXPTIME', 'CDFILTER', 'PCOUNT'):
+        assert not astromatic._is_wcs_key(key)
+
+
+def test_resampled_valid():
+    tmp = tempfile.mkdtemp()
+    paths = {}
+    for name in ("a.fits", "a.weight.fits", "a.resamp.fits",
+                 "a.resamp.weight.fits"):
+        paths[name] = os.path.join(tmp, name)
+        with open(paths[name], 'w') as f:
+            f.write("data")
+    db = {'path': paths["a.fits"], 'weight': paths["a.weight.fits"],
+          'head': None}
+    record = {"image": {"0": paths["a.resamp.fits"]},
+              "weight": {"0": paths["a.resamp.weight.fits"]},
+              "inputs": astromatic._input_states(db)}
+    assert astromatic._resampled_valid(record, db)
+    with open(paths["a.weight.fits"], 'w') as f:
+        f.write("changed")
+    assert not astromatic._resampled_valid(record, db)
+    record['inputs'] = astromatic._input_states(db)
+    os.remove(paths["a.resamp.fits"])
+    assert not astromatic._resampled_valid(record, db)
+    assert not astromatic._resampled_valid({"image": {}, "weight": {},
+        "inputs": record['inputs']}, db)
+
+
+def test_resample_dirs_per_image(monkeypatch):
+    workDir = tempfile.mkdtemp()
+    swarp = _swarp(workDir)
+    swarp.imageLog = _ImageLog({"k1": {}, "k2": {}})
+    swarp.imageKeys = ["k1", "k2"]
+    dirs = {}
+
+    def work(args):
+        imageKey, db, resampler, executor = args
+        dirs[imageKey] = resampler.configs["RESAMPLE_DIR"]
+        return imageKey, {"image": {}, "weight": {}, "inputs": {}}, None
+
+    monkeypatch.setattr(astromatic, "_resample_worker", work)
+    assert swarp.resample() == {}
+    root = os.path.join(workDir, "resamp", swarp.target_fingerprint())
+    assert dirs == {"k1": os.path.join(root, "k1"),
+                    "k2": os.path.join(root, "k2")}
+    key = "resamp.%s" % swarp.target_fingerprint()
+    assert sorted(swarp.imageLog.updates[0]) == ["k1", "k2"]
+    assert key in swarp.imageLog.updates[0]["k1"]
+
+
+def test_staged_runs_check_fingerprints_against_final_paths(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    imagePath = os.path.join(tmp, "a.fits")
+    with open(imagePath, 'w') as f:
+        f.write("data")
+    counter = os.path.join(tmp, "runs")
+
+    def make_command(self):
+        return "%s -c \"import sys; open(sys.argv[1], 'w').write('cat'); " \
+            "open(sys.argv[2], 'a').write('x')\" %s %s" \
+            % (sys.executable, self.catalogPath, counter)
+
+    monkeypatch.setattr(SourceExtractor, "make_command", make_command)
+    monkeypatch.setattr(astromatic, "tool_version", lambda program: "1")
+    workDir = os.path.join(tmp, "se")
+    finalPath = os.path.join(workDir, "a_se_cat.fits")
+    for i in range(2):
+        log = _ImageLog({"a": {"path": imagePath}})
+        batch = BatchSourceExtractor(log, ["a"], "path", "cat",
+                                     workDir=workDir)
+        stager = Stager(ScratchSpace(os.path.join(tmp, "scratch")))
+        failures = batch.run(nthreads=1, executor=JobExecutor(cpus=1),
+                             costModel=CostModel(path=os.path.join(
+                                 tmp, "rates.json")), stager=stager)
+        assert failures == {}
+        assert log.updates == [{"a": {"cat": finalPath}}]
+    assert open(finalPath).read() == "cat"
+    assert open(counter).read() == "x"  # the second run was skipped
+
+
+def test_staged_swarp_leaves_sources_untouched(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    sources = os.path.join(tmp, "archive")
+    os.makedirs(sources)
+    imagePath = os.path.join(sources, "a.fits")
+    scampPath = os.path.join(tmp, "a.scamp.head")
+    defaultsPath = os.path.join(tmp, "default.swarp")
+    for path in (imagePath, scampPath, defaultsPath):
+        with open(path, 'w') as f:
+            f.write("data")
+    monkeypatch.setattr(astromatic, "tool_version", lambda program: "1")
+    runs = []
+
+    def execute(self, job, executor=None):
+        localImage = self.swarpInputs["a"]["path"]
+        runs.append(os.path.exists(os.path.splitext(localImage)[0] +
+                                   ".head"))
+        for path in (self.mosaicPath, self.mosaicWeightPath):
+            with open(path, 'w') as f:
+                f.write("mosaic")
+        self.result = JobResult(job, 0, "", 0, time.time(), 0., 0.)
+        return self.result
+
+    monkeypatch.setattr(Swarp, "execute", execute)
+    workDir = os.path.join(tmp, "mosaic")
+    os.makedirs(workDir)
+    for i in range(2):
+        swarp = Swarp([imagePath], "field", scampHeadPaths=[scampPath],
+                      defaultsPath=defaultsPath, workDir=workDir)
+        stager = Stager(ScratchSpace(os.path.join(tmp, "scratch")))
+        result = swarp.run(stager=stager)
+        assert result.ok
+        assert stager.finish() == {}
+        assert sorted(os.listdir(sources)) == ["a.fits"]
+        assert "IMAGEOUT_NAME" not in swarp.configs
+    assert runs == [True]  # the second run was skipped
+    assert open(os.path.join(workDir, "field.fits")).read() == "mosaic"
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+from ..crawler import crawl, read_manifest
+
+
+def _make_tree():
+    root = tempfile.mkdtemp()
+    for d in ("a", "a/b", "c"):
+        os.makedirs(os.path.join(root, d))
+    for name in ("x.fits", "a/y.fits", "a/b/z.fits", "c/w.fits.fz",
+                 "c/v.txt"):
+        open(os.path.join(root, name), 'w').close()
+    return root
+
+
+def test_crawl_recursive():
+    root = _make_tree()
+    for nthreads in (1, 4):
+        paths = sorted(crawl(root, ".fits", nthreads=nthreads))
+        assert paths == [os.path.join(root, p)
+                         for p in ("a/b/z.fits", "a/y.fits", "x.fits")]
+
+
+def test_crawl_single_level():
+    root = _make_tree()
+    paths = list(crawl(root, (".fits", ".fits.fz"), recursive=False))
+    assert paths == [os.path.join(root, "x.fits")]
+
+
+def test_read_manifest():
+    root = _make_tree()
+    manifest = os.path.join(root, "manifest.txt")
+    with open(manifest, 'w') as f:
+        f.write("# files\nx.fits\n\nc/v.txt\na/y.fits\n")
+    paths = list(read_manifest(manifest, suffix=".fits", root=root))
+    assert paths == [os.path.join(root, "x.fits"),
+                     os.path.join(root, "a/y.fits")]
@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import time
+
+from ..executor import Job, JobExecutor, CostModel
+
+
+def _sleep_job(seconds, **kwargs):
+    return Job([sys.executable, "-c",
+                "import time; print('hi'); time.sleep(%f)" % seconds],
+               **kwargs)
+
+
+def test_run_captures_output():
+    executor = JobExecutor(cpus=2)
+    result = executor.run(_sleep_job(0.))
+    assert result.ok
+    assert result.returncode == 0
+    assert result.log.strip() == 'hi'
+    assert result.wall_time >= 0.
+
+
+def test_missing_program():
+    executor = JobExecutor(cpus=1)
+    result = executor.run(Job(["/nonexistent/program"]))
+    assert not result.ok
+    assert result.returncode is None
+
+
+def test_cpu_limit_serializes_jobs():
+    executor = JobExecutor(cpus=2)
+    t0 = time.time()
+    results = list(executor.map([_sleep_job(0.3, cpus=2),
+                                 _sleep_job(0.3, cpus=2)]))
+    executor.shutdown()
+    assert all(r.ok for r in results)
+    assert time.time() - t0 >= 0.6
+    starts = sorted(r.start for r in results)
+    assert starts[1] - starts[0] >= 0.3
+
+
+def test_small_jobs_run_concurrently():
+    executor = JobExecutor(cpus=2, memory=100.)
+    results = list(executor.map([_sleep_job(0.3, memory=50.),
+                                 _sleep_job(0.3, memory=50.)]))
+    executor.shutdown()
+    starts = sorted(r.start for r in results)
+    assert starts[1] - starts[0] < 0.25
+
+
+def test_thread_share():
+    executor = JobExecutor(cpus=4)
+    job = Job([sys.executable, "-c", "import sys; print(sys.argv[1:])"],
+              max_cpus=8, thread_arg="-NTHREADS")
+    result = executor.run(job)
+    assert result.cpus == 4
+    assert result.log.strip() == "['-NTHREADS', '4']"
+
+
+def test_thread_share_with_running_jobs():
+    executor = JobExecutor(cpus=4)
+    busy = executor.submit(_sleep_job(0.5, cpus=3))
+    time.sleep(0.2)
+    result = executor.run(_sleep_job(0., max_cpus=4))
+    assert result.cpus == 1
+    assert busy.get().ok
+    executor.shutdown()
+
+
+def test_cost_model():
+    path = os.path.join(tempfile.mkdtemp(), "rates.json")
+    model = CostModel(path=path, alpha=0.5)
+    assert model.longest_first([("a", 1, "small"), ("a", 10, "big")]) \
+        == ["big", "small"]
+    model.record("a", 10, 20.)
+    assert model.estimate("a", 5) == 10.
+    model.record("a", 10, 40.)
+    assert model.estimate("a", 1) == 3.
+    model.save()
+    assert CostModel(path=path).estimate("a", 1) == 3.
+
+
+def test_thread_share_between_submitted_jobs():
+    executor = JobExecutor(cpus=4)
+    results = list(executor.map([_sleep_job(0.3, max_cpus=4),
+                                 _sleep_job(0.3, max_cpus=4)]))
+    executor.shutdown()
+    assert [r.cpus for r in results] == [2, 2]
+    starts = sorted(r.start for r in results)
+    assert starts[1] - starts[0] < 0.25
@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+from ..fileops import relocate_file, file_size
+
+
+def _write(path, data=b"pixels"):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_relocate_across_filesystems():
+    src = _write(os.path.join(tempfile.mkdtemp(), "a.fits"))
+    dst = os.path.join(tempfile.mkdtemp(), "a.fits")
+    method = relocate_file(src, dst, same_fs=False)
+    assert method in ('reflink', 'copy_file_range', 'copy')
+    assert not os.path.exists(src)
+    assert open(dst, 'rb').read() == b"pixels"
+
+
+def test_copy_across_filesystems_keeps_source():
+    src = _write(os.path.join(tempfile.mkdtemp(), "a.fits"))
+    dst = _write(os.path.join(tempfile.mkdtemp(), "a.fits"), b"old copy")
+    relocate_file(src, dst, copy=True, same_fs=False)
+    assert os.path.exists(src)
+    assert open(dst, 'rb').read() == b"pixels"
+
+
+def test_relocate_within_filesystem():
+    directory = tempfile.mkdtemp()
+    src = _write(os.path.join(directory, "a.fits"))
+    dst = os.path.join(directory, "b.fits")
+    assert relocate_file(src, dst) == 'rename'
+    assert not os.path.exists(src)
+    assert file_size(dst) == 6
+    assert file_size(src) == 0
+
+
+def test_copy_within_filesystem_is_independent():
+    directory = tempfile.mkdtemp()
+    src = _write(os.path.join(directory, "a.fits"))
+    dst = os.path.join(directory, "b.fits")
+    relocate_file(src, dst, copy=True)
+    assert os.stat(src).st_ino != os.stat(dst).st_ino
+    _write(dst, b"edited")
+    assert open(src, 'rb').read() == b"pixels"
@@ -0,0 +1,68 @@
+import os
+import tempfile
+
+from ..fitsheader import scan_headers, parse_header, BLOCK_SIZE
+
+
+def _card(key, value=None):
+    if value is None:
+        return key.ljust(80)
+    return ("%-8s= %20s" % (key, value)).ljust(80)
+
+
+def _block(cards):
+    text = "".join(cards) + "END".ljust(80)
+    padding = -len(text) % BLOCK_SIZE
+    return (text + " " * padding).encode('ascii')
+
+
+def _write_mef(path):
+    primary = _block([_card('SIMPLE', 'T'), _card('BITPIX', 8),
+        _card('NAXIS', 0), _card('EXTEND', 'T'),
+        _card('OBJECT', "'M31 field'"), _card('EXPTIME', '10.5'),
+        _card('COMMENT', None)])
+    ext1 = _block([_card('XTENSION', "'IMAGE   '"), _card('BITPIX', 16),
+        _card('NAXIS', 2), _card('NAXIS1', 10), _card('NAXIS2', 3),
+        _card('PCOUNT', 0), _card('GCOUNT', 1), _card('CRVAL1', '1.5D2')])
+    data = b"\0" * BLOCK_SIZE  # 10 * 3 * 2 bytes, padded
+    ext2 = _block([_card('XTENSION', "'BINTABLE'"), _card('BITPIX', 8),
+        _card('NAXIS', 2), _card('NAXIS1', 8), _card('NAXIS2', 1),
+        _card('PCOUNT', 0), _card('GCOUNT', 1), _card('TFIELDS', 1),
+        _card('TTYPE1', "'COMPRESSED_DATA'"), _card('ZIMAGE', 'T'),
+        _card('ZBITPIX', -32), _card('ZNAXIS', 2), _card('ZNAXIS1', 2048),
+        _card('ZNAXIS2', 4096)])
+    table = b"\0" * BLOCK_SIZE
+    with open(path, 'wb') as f:
+        f.write(primary + ext1 + data + ext2 + table)
+
+
+def test_scan_headers():
+    path = os.path.join(tempfile.mkdtemp(), "test.fits")
+    _write_mef(path)
+    headers = scan_headers(path)
+    assert len(headers) == 3
+    assert headers[0]['OBJECT'] == 'M31 field'
+    assert headers[0]['EXPTIME'] == 10.5
+    assert headers[0]['EXTEND'] is True
+    assert headers[1]['NAXIS1'] == 10
+    assert headers[1]['CRVAL1'] == 150.
+    assert headers[1].data_size == 60
+    assert headers[2].compressed
+    assert headers[2]['NAXIS1'] == 2048
+    assert headers[2]['BITPIX'] == -32
+    assert 'TTYPE1' not in headers[2]
+
+
+def test_scan_headers_stops_at_last_ext():
+    path = os.path.join(tempfile.mkdtemp(), "test.fits")
+    _write_mef(path)
+    headers = scan_headers(path, exts=[1])
+    assert len(headers) == 2
+
+
+def test_parse_continue_string():
+    text = _card('LONG', "'abc&'") + ("CONTINUE  'def'").ljust(80) \
+        + _card('QUOTE', "'it''s'") + "END".ljust(80)
+    header = parse_header(text)
+    assert header['LONG'] == 'abcdef'
+    assert header['QUOTE'] == "it's"
@@ -0,0 +1,138 @@
+import math
+
+from ..footprint import polygon_to_geojson, point_to_geojson, \
+    spherical_hull, linear_footprints
+
+
+def test_polygon_to_geojson_ring_closed():
+    poly = [[10., 1.], [11., 1.], [11., 2.], [10., 2.]]
+    geo = polygon_to_geojson(poly)
+    assert geo['type'] == 'Polygon'
+    ring = geo['coordinates'][0]
+    assert len(ring) == 5
+    assert ring[0] == ring[-1]
+
+
+def test_polygon_to_geojson_ra_wrap():
+    poly = [[359.5, -1.], [0.5, -1.], [0.5, 1.], [359.5, 1.]]
+    ring = polygon_to_geojson(poly)['coordinates'][0]
+    assert ring[0] == [-0.5, -1.]
+    assert ring[1] == [0.5, -1.]
+
+
+def test_point_to_geojson():
+    geo = point_to_geojson(200., 3.)
+    assert geo == {"type": "Point", "coordinates": [-160., 3.]}
+
+
+def _contains_vertex(polygon, vertex, tol=1e-8):
+    return any(abs(ra - vertex[0]) < tol and abs(dec - vertex[1]) < tol
+               for ra, dec in polygon)
+
+
+def test_spherical_hull_ra_wrap():
+    # Two chips either side of RA = 0
+    chips = [[359., -1.], [359.9, -1.], [359.9, 1.], [359., 1.],
+             [0.1, -1.], [1., -1.], [1., 1.], [0.1, 1.]]
+    hull = spherical_hull(chips)
+    assert len(hull) == 4
+    for vertex in ([359., -1.], [1., -1.], [1., 1.], [359., 1.]):
+        assert _contains_vertex(hull, vertex)
+
+
+def test_spherical_hull_drops_interior_points():
+    points = [[10., 10.], [11., 10.], [11., 11.], [10., 11.],
+              [10.5, 10.5]]
+    hull = spherical_hull(points)
+    assert len(hull) == 4
+    assert not _contains_vertex(hull, [10.5, 10.5])
+
+
+def test_spherical_hull_pole():
+    points = [[0., 89.], [90., 89.], [180., 89.], [270., 89.]]
+    hull = spherical_hull(points)
+    assert len(hull) == 4
+    for ra, dec in hull:
+        assert abs(dec - 89.) < 1e-8
+
+
+def _tan_header(**kwargs):
+    header = {'NAXIS': 2, 'NAXIS1': 101, 'NAXIS2': 201,
+              'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+              'CRPIX1': 51., 'CRPIX2': 101., 'CRVAL1': 10., 'CRVAL2': 0.,
+              'CD1_1': -0.01, 'CD1_2': 0., 'CD2_1': 0., 'CD2_2': 0.01}
+    header.update(kwargs)
+    return header
+
+
+def test_linear_footprints_tan():
+    footprint = linear_footprints([_tan_header()])[0]
+    assert len(footprint) == 4
+    # Corner pixel (1, 1) is 0.5 deg east (RA increases to -x) and 1 deg
+    # south of the reference point
+    ra, dec = footprint[0]
+    assert abs(ra - (10. + math.degrees(math.atan(0.5 * math.pi / 180.)))) \
+        < 1e-8
+    assert dec < 0.
+    # Footprint is symmetric about the reference point
+    for (ra1, dec1), (ra2, dec2) in ((footprint[0], footprint[1]),
+                                     (footprint[3], footprint[2])):
+        assert abs(ra1 - ra2) < 1e-10
+        assert abs(dec1 + dec2) < 1e-10
+
+
+def test_linear_footprints_pc_cdelt_matches_cd():
+    cd = _tan_header()
+    pc = _tan_header(CDELT1=-0.01, CDELT2=0.01, PC1_1=1., PC2_2=1.)
+    for key in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'):
+        del pc[key]
+    fp_cd, fp_pc = linear_footprints([cd, pc])
+    for (ra1, dec1), (ra2, dec2) in zip(fp_cd, fp_pc):
+        assert abs(ra1 - ra2) < 1e-10
+        assert abs(dec1 - dec2) < 1e-10
+
+
+def test_linear_footprints_unsupported():
+    headers = [_tan_header(A_ORDER=2),
+               _tan_header(CTYPE1='RA---SIN', CTYPE2='DEC--SIN'),
+               _tan_header(CTYPE1='RA---TPV', CTYPE2='DEC--TPV',
+                           PV1_1=1., PV1_4=1e-4),
+               _tan_header()]
+    footprints = linear_footprints(headers)
+    assert footprints[:3] == [None, None, None]
+    assert footprints[3] is not None
+
+
+def _astropy_footprint(header):
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    fitsHeader = fits.Header()
+    for key, value in header.items():
+        fitsHeader[key] = value
+    return WCS(fitsHeader).calc_footprint(header=fitsHeader)
+
+
+def _assert_same_footprint(footprint, expected, tol=1e-9):
+    for (ra1, dec1), (ra2, dec2) in zip(footprint, expected):
+        dra = (ra1 - ra2 + 180.) % 360. - 180.
+        assert abs(dra * math.cos(math.radians(dec2))) < tol
+        assert abs(dec1 - dec2) < tol
+
+
+def test_linear_footprints_match_astropy_tan():
+    # Rotated and skewed CD matrix, near the pole and across RA = 0
+    header = _tan_header(CRVAL1=359.8, CRVAL2=72.5, CD1_1=-0.0093,
+                         CD1_2=0.0021, CD2_1=0.0019, CD2_2=0.0088)
+    footprint = linear_footprints([header])[0]
+    _assert_same_footprint(footprint, _astropy_footprint(header))
+
+
+def test_linear_footprints_match_astropy_tpv():
+    header = _tan_header(CTYPE1='RA---TPV', CTYPE2='DEC--TPV',
+                         CRVAL1=150.1, CRVAL2=-32.4, CD1_1=-5e-5,
+                         CD1_2=1e-6, CD2_1=-2e-6, CD2_2=5e-5,
+                         PV1_0=0., PV1_1=1., PV1_2=0., PV2_0=0., PV2_1=1.,
+                         PV2_2=0.)
+    footprint = linear_footprints([header])[0]
+    assert footprint is not None
+    _assert_same_footprint(footprint, _astropy_footprint(header))
@@ -0,0 +1,247 @@
+import os
+import re
+import tempfile
+
+import pytest
+
+from ..imagelog import ImageLog, MEFImporter
+from ..fileops import file_stat
+
+
+class FakeBulk(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.selector = None
+
+    def find(self, selector):
+        self.selector = selector
+        return self
+
+    def upsert(self):
+        return self
+
+    def update_one(self, document):
+        self.collection.updates.append((self.selector, document))
+
+    def replace_one(self, document):
+        self.collection.updates.append((self.selector, document))
+
+    def execute(self):
+        return {}
+
+
+class FakeCollection(object):
+    """The parts of a PyMongo collection used by ImageLog's file methods."""
+    def __init__(self, docs):
+        self.docs = dict((doc['_id'], doc) for doc in docs)
+        self.updates = []
+        self.removed = []
+        self.indexes = []
+
+    def _get(self, doc, key):
+        for part in key.split('.'):
+            if not isinstance(doc, dict) or part not in doc:
+                return None
+            doc = doc[part]
+        return doc
+
+    def _matches(self, doc, selector):
+        for key, value in selector.items():
+            found = self._get(doc, key)
+            if isinstance(value, dict) and '$exists' in value:
+                if (found is not None) != bool(value['$exists']):
+                    return False
+            elif isinstance(value, dict) and '$regex' in value:
+                if found is None or not re.match(value['$regex'], found):
+                    return False
+            elif found != value:
+                return False
+        return True
+
+    def update(self, selector, document, **kwargs):
+        self.updates.append((selector, document))
+
+    def find(self, selector, fields=None, **kwargs):
+        return [dict(doc) for key, doc in sorted(self.docs.items())
+                if self._matches(doc, selector)]
+
+    def remove(self, spec):
+        self.removed.append(spec)
+
+    def ensure_index(self, keys):
+        self.indexes.append(keys)
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+    def initialize_ordered_bulk_op(self):
+        return FakeBulk(self)
+
+
+def _log(docs, chips=False):
+    log = ImageLog.__new__(ImageLog)
+    log.c = FakeCollection(docs)
+    log.queryMask = {}
+    log.exts = ["0"]
+    log.chipBaseKeys = ["FILTER"]
+    log.chips = FakeCollection([]) if chips else None
+    log.headers = None
+    return log
+
+
+def _files(*names):
+    directory = tempfile.mkdtemp()
+    paths = []
+    for name in names:
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(b"x" * 10)
+        paths.append(path)
+    return paths
+
+
+def test_move_files_dry_run():
+    a, b = _files("a.fits", "b.fits")
+    log = _log([{"_id": "a", "path": a}, {"_id": "b", "path": b}])
+    newDir = os.path.join(tempfile.mkdtemp(), "moved")
+    plan = log.move_files("path", newDir, dry_run=True)
+    assert plan['bytes'] == 20
+    assert sorted(m[0] for m in plan['moves']) == ["a", "b"]
+    assert os.path.exists(a) and os.path.exists(b)
+    assert not os.path.exists(newDir)
+    assert log.c.updates == []
+
+
+def test_move_files_reports_errors_per_file():
+    a, b = _files("a.fits", "b.fits")
+    os.remove(b)
+    log = _log([{"_id": "a", "path": a}, {"_id": "b", "path": b}])
+    newDir = tempfile.mkdtemp()
+    errors = log.move_files("path", newDir, nthreads=2)
+    assert list(errors.keys()) == ["b"]
+    newPath = os.path.join(newDir, "a.fits")
+    assert os.path.exists(newPath)
+    assert log.c.updates == [({"_id": "a"}, {"$set": {"path": newPath}})]
+
+
+class FlakyCollection(FakeCollection):
+    """A collection whose first bulk write fails."""
+    def __init__(self, docs):
+        super(FlakyCollection, self).__init__(docs)
+        self.failures = 1
+
+    def initialize_unordered_bulk_op(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("bulk write failed")
+        return FakeBulk(self)
+
+
+def test_move_files_records_moves_after_a_failed_write():
+    paths = _files("a.fits", "b.fits", "c.fits")
+    log = _log([])
+    log.c = FlakyCollection([{"_id": os.path.basename(p)[0], "path": p}
+                             for p in paths])
+    newDir = tempfile.mkdtemp()
+    with pytest.raises(RuntimeError):
+        log.move_files("path", newDir, nthreads=2, batch_size=1)
+    assert sorted(u[0]["_id"] for u in log.c.updates) == ["a", "b", "c"]
+    assert all(os.path.exists(os.path.join(newDir, os.path.basename(p)))
+               for p in paths)
+
+
+def test_delete_files_dry_run():
+    a, = _files("a.fits")
+    log = _log([{"_id": "a", "path": a}])
+    plan = log.delete_files("path", dry_run=True)
+    assert plan == {"deletes": [("a", a)], "bytes": 10}
+    assert os.path.exists(a)
+
+
+def test_summary_groups_sort_in_group_by_order():
+    log = _log([])
+    group_by = ["F%i" % i for i in range(12)]
+    pipeline, names = log._summary_pipeline(group_by, {"EXPTIME": "sum"},
+                                            {}, None)
+    groupId = pipeline[1]["$group"]["_id"]
+    assert list(groupId.keys()) == ["g%i" % i for i in range(12)]
+    assert list(groupId.values()) == ["$" + f for f in group_by]
+    assert names == group_by + ["count", "EXPTIME_sum"]
+
+
+def test_chip_methods_need_chip_collection():
+    log = _log([])
+    for call in (lambda: log.find_chips({}),
+                 lambda: log.ensure_chip_index("FILTER"),
+                 lambda: log.sync_chips()):
+        try:
+            call()
+        except ValueError as e:
+            assert "chip_cname" in str(e)
+        else:
+            assert False, "ValueError not raised"
+
+
+def test_sync_chips_removes_stale_chips():
+    log = _log([{"_id": "a", "FILTER": "J", "1": {"sky": 1.}}], chips=True)
+    log.exts = ["0", "1", "2"]
+    log.sync_chips()
+    chipIds = [selector["_id"] for selector, doc in log.chips.updates]
+    assert len(chipIds) == 1
+    assert log.chips.updates[0][1]["FILTER"] == "J"
+    assert log.chips.removed == [
+        {"$or": [{"image": "a", "_id": {"$nin": chipIds}}]}]
+
+
+def _importer(docs):
+    importer = MEFImporter.__new__(MEFImporter)
+    importer.c = FakeCollection(docs)
+    importer.checksum = True
+    importer.headers = None
+    importer.chips = None
+    return importer
+
+
+def test_stat_index_updates_by_id():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "a.fits")
+    with open(path, 'wb') as f:
+        f.write(b"x" * 10)
+    stat = file_stat(path, checksum=True)
+    stat['mtime'] -= 100.  # touched since the last ingest
+    importer = _importer([
+        {"_id": "a", "ingest_stat": stat},
+        {"_id": "b", "ingest_stat": {"path": "/elsewhere/b.fits"}}])
+    index = importer.load_stat_index(directory)
+    assert list(index.keys()) == [path]
+    assert index[path]['_id'] == "a"
+    assert importer.c.indexes == [[("ingest_stat.path", 1)]]
+    assert not importer._is_changed(path, index[path])
+    assert importer.c.updates[0][0] == {"_id": "a"}
+
+
+def test_mark_missing_skips_flagged_documents():
+    importer = _importer([])
+    importer.mark_missing([
+        {"_id": "a", "path": "/data/a.fits"},
+        {"_id": "b", "path": "/data/b.fits", "missing": True}])
+    assert importer.c.updates == [
+        ({"_id": "a"}, {"$set": {"ingest_stat.missing": True}})]
+
+
+def test_ingest_marks_only_deleted_files_missing():
+    base = tempfile.mkdtemp()
+    os.makedirs(os.path.join(base, "sub"))
+    stats = []
+    for i, name in enumerate(["a.fits", os.path.join("sub", "b.fits"),
+                              "c.fits.fz", "d.fits"]):
+        path = os.path.join(base, name)
+        with open(path, 'wb') as f:
+            f.write(b"x" * 10)
+        stats.append({"_id": str(i), "ingest_stat": file_stat(path)})
+    os.remove(os.path.join(base, "d.fits"))
+    importer = _importer(stats)
+    importer.build_document = lambda path: (path, None, "not FITS")
+    importer.ingest(base, recursive=False, mark_missing=True)
+    assert importer.c.updates == [
+        ({"_id": "3"}, {"$set": {"ingest_stat.missing": True}})]
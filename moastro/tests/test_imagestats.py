@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+import numpy as np
+
+from ..fitsheader import scan_headers, BLOCK_SIZE
+from ..imagestats import sample_pixels, sky_stats
+
+
+def _header(cards):
+    text = "".join(("%-8s= %20s" % (k, v)).ljust(80) for k, v in cards)
+    text += "END".ljust(80)
+    return (text + " " * (-len(text) % BLOCK_SIZE)).encode('ascii')
+
+
+def _write_image(path, data, bzero=None):
+    cards = [('SIMPLE', 'T'), ('BITPIX', 16), ('NAXIS', 2),
+             ('NAXIS1', data.shape[1]), ('NAXIS2', data.shape[0])]
+    if bzero is not None:
+        cards.append(('BZERO', bzero))
+    pixels = data.astype('>i2').tobytes()
+    with open(path, 'wb') as f:
+        f.write(_header(cards))
+        f.write(pixels + b"\0" * (-len(pixels) % BLOCK_SIZE))
+
+
+def test_sample_pixels_memmap():
+    data = np.arange(200 * 300).reshape(200, 300) % 1000
+    path = os.path.join(tempfile.mkdtemp(), "image.fits")
+    _write_image(path, data - 500, bzero=500)
+    header = scan_headers(path)[0]
+    pixels = sample_pixels(path, header, nrows=10, ncols=100)
+    rows = np.unique(np.linspace(0, 199, 10).astype(int))
+    assert np.array_equal(pixels, data[rows, ::3])
+
+
+def test_sky_stats():
+    rng = np.random.RandomState(1)
+    pixels = rng.normal(100., 5., size=(64, 512))
+    pixels[0, :20] = 60000.  # saturated stars
+    stats = sky_stats(pixels, {'SATURATE': 50000.})
+    assert abs(stats['sky'] - 100.) < 0.5
+    assert abs(stats['sky_rms'] - 5.) < 0.5
+    assert abs(stats['sat_frac'] - 20. / pixels.size) < 1e-12
+    assert stats['n_sample'] == pixels.size
@@ -0,0 +1,81 @@
+import os
+import time
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from ..ingestd import IngestDaemon
+
+
+class FakeImporter(object):
+    """The worker API of MEFImporter, building documents in threads."""
+    def __init__(self, fail=(), delay=0.):
+        self.fail = fail
+        self.delay = delay
+        self.written = []
+
+    def load_stat_index(self, base_dir=None):
+        return {}
+
+    def worker_pool(self, nproc):
+        return ThreadPool(processes=nproc)
+
+    def build_async(self, pool, path):
+        return pool.apply_async(self.build_document, (path,))
+
+    def build_document(self, path):
+        time.sleep(self.delay)
+        if os.path.basename(path) in self.fail:
+            return path, None, "bad file"
+        return path, {"_id": os.path.basename(path)}, None
+
+    def write_documents(self, docs):
+        self.written.extend(doc['_id'] for doc in docs)
+
+
+def _archive(*names):
+    directory = tempfile.mkdtemp()
+    for name in names:
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write("data")
+    return directory
+
+
+def _daemon(importer, directory):
+    return IngestDaemon(importer, directory, settle=0., poll_interval=0.05,
+                        nproc=2, batch_wait=0., use_inotify=False)
+
+
+def test_poll_ingest_and_stop():
+    directory = _archive("a.fits", "b.fits", "notes.txt")
+    importer = FakeImporter(fail=("b.fits",))
+    daemon = _daemon(importer, directory)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    deadline = time.time() + 5.
+    while daemon.metrics()['ingested'] + daemon.metrics()['failed'] < 2 \
+            and time.time() < deadline:
+        time.sleep(0.02)
+    # A file added while running is picked up by the next poll
+    with open(os.path.join(directory, "c.fits"), 'w') as f:
+        f.write("data")
+    while daemon.metrics()['ingested'] < 2 and time.time() < deadline:
+        time.sleep(0.02)
+    daemon.stop()
+    thread.join(5.)
+    assert not thread.is_alive()
+    assert sorted(importer.written) == ["a.fits", "c.fits"]
+    assert list(daemon.failures.keys()) == [os.path.join(directory,
+                                                         "b.fits")]
+    assert daemon.metrics()['failed'] == 1
+
+
+def test_shutdown_records_inflight_failures():
+    directory = _archive("a.fits", "b.fits")
+    importer = FakeImporter(fail=("b.fits",), delay=0.5)
+    daemon = _daemon(importer, directory)
+    daemon.run(duration=0.2)  # both files are still being built
+    assert importer.written == ["a.fits"]
+    assert list(daemon.failures.keys()) == [os.path.join(directory,
+                                                         "b.fits")]
+    assert daemon.metrics()['failed'] == 1
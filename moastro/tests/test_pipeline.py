@@ -0,0 +1,73 @@
+import threading
+
+from ..pipeline import Pipeline, Stage
+
+
+class FakeImageLog(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.lock = threading.Lock()
+
+    def find_dict(self, selector, images=None, fields=None):
+        with self.lock:
+            return dict((k, dict(self.docs[k])) for k in images)
+
+    def set(self, imageKey, key, value):
+        with self.lock:
+            self.docs[imageKey][key] = value
+
+
+def _writer(inputKey, outputKey, calls, fail=()):
+    def run(imageLog, name, imageKeys, executor):
+        calls.append(name)
+        if name in fail:
+            raise RuntimeError("failed")
+        for k in imageKeys:
+            imageLog.set(k, outputKey, "%s(%s)" % (outputKey, k))
+    return run
+
+
+def _log():
+    return FakeImageLog({"a1": {"path": "a1", "FILTER": "J"},
+                         "a2": {"path": "a2", "FILTER": "J"},
+                         "b1": {"path": "b1", "FILTER": "Ks"}})
+
+
+def test_pipeline_runs_in_dependency_order():
+    imageLog = _log()
+    calls = []
+    stages = [Stage("se", _writer("path", "cat", calls), inputs=["path"],
+                    outputs=["cat"]),
+              Stage("psf", _writer("cat", "psf", calls), inputs=["cat"],
+                    outputs=["psf"], group_by="FILTER")]
+    failures = Pipeline(imageLog, ["a1", "a2", "b1"], stages,
+                        nthreads=3).run()
+    assert failures == {}
+    assert imageLog.docs["a2"]["psf"] == "psf(a2)"
+    assert sorted(calls) == ["J", "Ks", "a1", "a2", "b1"]
+    # Groups only start after all their images are extracted
+    assert calls.index("J") > max(calls.index("a1"), calls.index("a2"))
+    assert calls.index("Ks") > calls.index("b1")
+
+
+def test_pipeline_resumes_and_blocks_on_failure():
+    imageLog = _log()
+    imageLog.docs["b1"]["cat"] = "done"
+    calls = []
+    stages = [Stage("se", _writer("path", "cat", calls, fail=("a2",)),
+                    inputs=["path"], outputs=["cat"]),
+              Stage("psf", _writer("cat", "psf", calls), inputs=["cat"],
+                    outputs=["psf"], group_by="FILTER")]
+    failures = Pipeline(imageLog, ["a1", "a2", "b1"], stages,
+                        nthreads=2).run()
+    assert "b1" not in calls  # already extracted
+    assert "Ks" in calls
+    assert "J" not in calls  # a2 failed
+    assert set(failures) == set([("se", "a2"), ("psf", "J")])
+
+
+def test_pipeline_reads_unicode_group_by_field():
+    stages = [Stage("psf", _writer("cat", "psf", []), inputs=["cat"],
+                    outputs=["psf"], group_by=u"FILTER")]
+    pipeline = Pipeline(_log(), ["a1", "a2", "b1"], stages)
+    assert u"FILTER" in pipeline._fields()
@@ -27,3 +27,46 @@ def test_locate_server():
     url, port = locate_server('local')
     assert url == 'localhost'
     assert port == 27017
+
+
+def test_client_options(monkeypatch):
+    from .. import settings
+    conf = {"servers": {"local": {"url": "localhost", "port": 27017,
+                                  "client": {"maxPoolSize": 20,
+                                             "socketTimeoutMS": 1000}}},
+            "client": {"connectTimeoutMS": 5000, "socketTimeoutMS": 60000}}
+    monkeypatch.setattr(settings, 'read_settings', lambda: conf)
+    assert settings.client_options('local') == {"maxPoolSize": 20,
+                                                "connectTimeoutMS": 5000,
+                                                "socketTimeoutMS": 1000}
+    assert settings.client_options() == {"connectTimeoutMS": 5000,
+                                         "socketTimeoutMS": 60000}
+    assert settings.client_options('other') == {"connectTimeoutMS": 5000,
+                                                "socketTimeoutMS": 60000}
+
+
+def test_make_connection_shares_clients_until_fork(monkeypatch):
+    from .. import dbtools
+
+    class FakeClient(object):
+        def __init__(self, url, port, **options):
+            self.url = url
+            self.port = port
+            self.options = options
+
+    monkeypatch.setattr(dbtools.pymongo, 'MongoClient', FakeClient)
+    monkeypatch.setattr(dbtools, 'client_options',
+                        lambda server: {"maxPoolSize": 5})
+    monkeypatch.setattr(dbtools, '_clients', {})
+    monkeypatch.setattr(dbtools, '_clients_pid', os.getpid())
+    client = dbtools.make_connection(url="db.example", port=27018)
+    assert client.options == {"maxPoolSize": 5}
+    assert dbtools.make_connection(url="db.example", port=27018) is client
+    assert dbtools.make_connection(url="db.example", port=27019) \
+        is not client
+
+    pid = os.getpid()
+    monkeypatch.setattr(dbtools.os, 'getpid', lambda: pid + 1)
+    forked = dbtools.make_connection(url="db.example", port=27018)
+    assert forked is not client
+    assert dbtools.make_connection(url="db.example", port=27018) is forked
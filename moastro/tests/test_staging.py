@@ -0,0 +1,111 @@
+import os
+import tempfile
+import threading
+
+from ..staging import ScratchSpace, Stager
+
+
+def _source(directory, name, nbytes):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b"x" * nbytes)
+    return path
+
+
+def test_scratch_lru_eviction():
+    sources = tempfile.mkdtemp()
+    scratch = ScratchSpace(tempfile.mkdtemp(), max_bytes=250)
+    a, b, c = [_source(sources, n, 100) for n in ("a.fits", "b.fits",
+                                                   "c.fits")]
+    localA = scratch.acquire(a)
+    assert os.path.basename(localA) == "a.fits"
+    scratch.release(a)
+    localB = scratch.acquire(b)
+    scratch.release(b)
+    scratch.acquire(a)  # a is now the most recently used
+    scratch.release(a)
+    localC = scratch.acquire(c)
+    assert os.path.exists(localA)
+    assert not os.path.exists(localB)
+    assert os.path.exists(localC)
+    assert scratch.nbytes == 200
+
+
+def test_stager_moves_outputs_back():
+    class FakeImageLog(object):
+        def __init__(self):
+            self.data = {}
+
+        def set_images(self, data):
+            self.data.update(data)
+
+    sources = tempfile.mkdtemp()
+    src = _source(sources, "image.fits", 10)
+    stager = Stager(ScratchSpace(tempfile.mkdtemp()), depth=2)
+    stager.prefetch([src, None])
+    local = stager.acquire(src)
+    assert open(local, 'rb').read() == b"x" * 10
+    stager.release(src)
+
+    outDir = stager.output_dir("image")
+    output = _source(outDir, "image_cat.fits", 5)
+    final = os.path.join(tempfile.mkdtemp(), "se", "image_cat.fits")
+    stager.move_back(output, final, imageKey="image", key="cat")
+    log = FakeImageLog()
+    assert stager.finish(log) == {}
+    assert os.path.exists(final)
+    assert not os.path.exists(outDir)
+    assert log.data == {"image": {"cat": final}}
+
+
+def test_scratch_reserves_input_sets():
+    sources = tempfile.mkdtemp()
+    a, b, c = [_source(sources, n, 100) for n in ("a.fits", "b.fits",
+                                                   "c.fits")]
+    # A set larger than the scratch space is used from its source
+    scratch = ScratchSpace(tempfile.mkdtemp(), max_bytes=150)
+    assert scratch.acquire_all([a, b]) == {}
+    assert scratch.nbytes == 0
+
+    # A set waits, holding nothing, until another run releases its inputs
+    scratch = ScratchSpace(tempfile.mkdtemp(), max_bytes=250)
+    held = scratch.acquire_all([a, b])
+    assert sorted(held) == [a, b]
+    acquired = []
+    thread = threading.Thread(
+        target=lambda: acquired.append(scratch.acquire_all([b, c])))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    scratch.release(a)
+    scratch.release(b)
+    thread.join(5.)
+    assert not thread.is_alive()
+    assert sorted(acquired[0]) == [b, c]
+    assert not os.path.exists(held[a])
+
+
+def test_stager_cancel_frees_prefetch_slots():
+    sources = tempfile.mkdtemp()
+    paths = [_source(sources, "%i.fits" % i, 10) for i in range(3)]
+    stager = Stager(ScratchSpace(tempfile.mkdtemp()), depth=1)
+    stager.prefetch(paths)
+    stager.cancel(paths[:2])
+    assert list(stager._inflight) == [paths[2]]
+    stager.finish()
+    assert stager._stagePool is None
+    assert stager._inflight == {}
+
+
+def test_stager_move_all_calls_back_after_moving():
+    stager = Stager(ScratchSpace(tempfile.mkdtemp()))
+    outDir = stager.output_dir("image")
+    outputs = [_source(outDir, n, 5) for n in ("a.fits", "b.fits")]
+    finalDir = tempfile.mkdtemp()
+    finals = [os.path.join(finalDir, os.path.basename(p)) for p in outputs]
+    moved = []
+    stager.move_all(list(zip(outputs, finals, [None, None])),
+                    callback=lambda: moved.extend(
+                        os.path.exists(p) for p in finals))
+    assert stager.finish() == {}
+    assert moved == [True, True]